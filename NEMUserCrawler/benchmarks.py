@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of the hot paths of the crawler, run by the `microbench` command.
+
+Each benchmark is a function registered by `benchmark`, which sets up what it needs from a `BenchmarkContext` and
+returns `(run, ops)`, where `run()` does `ops` operations and is what gets timed. Pages and API responses are
+synthesized to be of the size and shape of the real ones, with the same seed every time.
+"""
+import io
+import json
+import random
+import types
+from collections import deque
+
+from scrapy.http import HtmlResponse, Request, TextResponse
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from .common import nem_crypto, nem_json, nem_page
+from .common.sparse_presence_table import SparsePresenceTable
+from .items import Song, SongBatch, UserProfile
+from .pipelines import TxMongoPipeline
+
+BENCHMARKS = {}  # name -> function setting up the benchmark
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+class BenchmarkContext():
+    """What benchmarks are set up with: the project `settings`, the number of IDs to `fill` tables with and a seeded
+    `random`."""
+
+    def __init__(self, settings, fill=1000000, seed=0):
+        self.settings = settings
+        self.fill = fill
+        self.seed = seed
+        self.random = random.Random(seed)
+        self._spider = None
+
+    def user_ids(self, count):
+        """User IDs as found in the wild, mostly of 8 to 10 digits."""
+        return [self.random.choice((self.random.randint(10 ** 7, 10 ** 8 - 1),
+                                    self.random.randint(10 ** 8, 2 * 10 ** 9),
+                                    self.random.randint(10 ** 8, 2 * 10 ** 9)))
+                for _ in range(count)]
+
+    @property
+    def spider(self):
+        """A `UserSpider` with the project settings, but encrypting no weapi requests in callbacks, as that is
+        measured by itself, and with no edge log or dupefilter to change state across runs."""
+        if self._spider is None:
+            from .spiders.user import UserSpider
+            settings = self.settings.copy_to_dict()
+            settings.update(NEM_DEFER_WEAPI_ENCRYPTION=True, EDGE_LOG_PATH=None, JOBDIR=None, LOG_ENABLED=False,
+                            TWISTED_REACTOR=None)  # nothing runs in a reactor, whichever is installed
+            crawler = get_crawler(UserSpider, settings)
+            self._spider = crawler.spider = UserSpider.from_crawler(crawler)
+            crawler.engine = types.SimpleNamespace(slot=None)  # of no scheduler, so of no dupefilter either
+            crawler.stats.open_spider(self._spider)
+        return self._spider
+
+
+def consume(iterable):
+    deque(iterable, maxlen=0)
+
+
+# Synthesized pages and responses
+
+def _padding(rng, size):
+    """Markup of about `size` characters, standing for the navigation, scripts and such around what is parsed."""
+    parts = ['<script type="text/javascript">window.GRestrictive = true; var GUser = {}; var GAllowRejectComment = '
+             'false; ' + "".join("var _{0}=function(a){{return a*{0}}};".format(i) for i in range(size // 200)) +
+             '</script>']
+    length = len(parts[0])
+    while length < size:
+        i = rng.randint(0, 10 ** 9)
+        part = ('<div class="m-item f-cb"><a href="/discover/toplist?id={0}" class="s-fc1 f-thide" title="item {0}">'
+                '<img src="http://p1.music.126.net/{1:x}/{0}.jpg?param=40y40"/></a><span class="u-icn u-icn-{2}">'
+                '</span><p class="s-fc4">{0}</p></div>').format(i, rng.getrandbits(64), i % 90)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def user_page(rng, user_id):
+    """The `/user/home` page of `user_id`."""
+    name = "用户{}".format(user_id)
+    ld = {'@context': "https://ziyuan.baidu.com/contexts/cambrian.jsonld",
+          '@id': "http://music.163.com/user/home?id={}".format(user_id),
+          'appid': "1582028769404989",
+          'title': name,
+          'images': ["http://p1.music.126.net/{:x}/{}.jpg".format(rng.getrandbits(64), user_id)],
+          'description': "喜欢音乐，也喜欢安静。{0}的最近常听、歌单、DJ节目、音乐口味、动态。".format(name),
+          'pubDate': "2016-04-21T18:47:23"}
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{name} - 用户 - 网易云音乐</title>'
+            '<meta name="keywords" content="{name}"/><link rel="stylesheet" href="/style/web2/css/core.css">'
+            '<script type="application/ld+json">{ld}</script></head><body><div id="g-topbar">{head}</div>'
+            '<div class="g-bd"><div class="g-wrap p-prf"><h2 id="j-name-wrap" class="wrap f-fl f-cb">'
+            '<span class="tit f-ff2 s-fc0 f-thide">{name}</span></h2>{body}</div></div></body></html>'
+            ).format(name=name, ld=json.dumps(ld, ensure_ascii=False), head=_padding(rng, 20000),
+                     body=_padding(rng, 20000))
+
+
+def playlist_page(rng, playlist_id, songs=200):
+    """The `/playlist` page of `playlist_id`, listing `songs` songs."""
+    items = "".join('<li><a href="/song?id={}">歌曲 {} (Live)</a></li>'.format(rng.randint(10 ** 5, 2 * 10 ** 9), i)
+                    for i in range(songs))
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>我喜欢的音乐 - 歌单 - 网易云音乐</title></head>'
+            '<body><div id="g-topbar">{head}</div><div class="g-bd4 f-cb"><div id="song-list-pre-cache">'
+            '<ul class="f-hide">{items}</ul><textarea id="song-list-pre-data" style="display:none;">[]</textarea>'
+            '</div>{body}</div><a href="/playlist?id={id}">playlist</a></body></html>'
+            ).format(head=_padding(rng, 20000), items=items, body=_padding(rng, 10000), id=playlist_id)
+
+
+def follow_body(rng, user_ids, key="follow", more=True):
+    """A page of `/weapi/user/getfollows` (`key` of "follow") or `/weapi/user/getfolloweds` ("followeds")."""
+    users = [{'py': "yonghu{}".format(user_id), 'time': 1500000000000 + i, 'userType': 0, 'expertTags': None,
+              'remarkName': None, 'authStatus': 0, 'vipType': rng.choice((0, 0, 11)), 'experts': {},
+              'gender': rng.randint(0, 2), 'accountStatus': 0, 'userId': user_id, 'followed': False,
+              'mutual': False, 'nickname': "用户{}".format(user_id), 'signature': "喜欢音乐{}".format(i),
+              'avatarUrl': "http://p1.music.126.net/{:x}/{}.jpg".format(rng.getrandbits(64), user_id),
+              'follows': rng.randint(0, 300), 'followeds': int(rng.paretovariate(1.2)), 'eventCount': 12,
+              'playlistCount': 8, 'playlistBeSubscribedCount': 0,
+              'vipRights': {'associator': {'vipCode': 100, 'rights': True}, 'musicPackage': None, 'redVipAnnualCount': -1,
+                            'redVipLevel': 1},
+              'avatarDetail': None}
+             for i, user_id in enumerate(user_ids)]
+    return json.dumps({key: users, 'touchCount': len(users), 'more': more, 'code': 200}).encode("utf-8")
+
+
+def playlists_body(rng, user_id, count=5):
+    """A page of `/weapi/user/playlist` of `user_id`, the first playlist being the favorite one."""
+    creator = {'defaultAvatar': False, 'province': 110000, 'authStatus': 0, 'followed': False,
+               'avatarUrl': "http://p1.music.126.net/{:x}/{}.jpg".format(rng.getrandbits(64), user_id),
+               'accountStatus': 0, 'gender': 1, 'city': 110101, 'birthday': 820425600000, 'userId': user_id,
+               'userType': 0, 'nickname': "用户{}".format(user_id), 'signature': "喜欢音乐", 'description': "",
+               'detailDescription': "", 'backgroundUrl': "http://p1.music.126.net/bg.jpg", 'vipType': 0}
+    playlists = [{'subscribers': [], 'subscribed': False, 'creator': creator, 'artists': None, 'tracks': None,
+                  'updateFrequency': None, 'backgroundCoverId': 0, 'backgroundCoverUrl': None, 'titleImage': 0,
+                  'englishTitle': None, 'opRecommend': False, 'subscribedCount': 0, 'cloudTrackCount': 0,
+                  'userId': user_id, 'totalDuration': 0, 'coverImgId': rng.getrandbits(48), 'privacy': 0,
+                  'trackUpdateTime': 1600000000000, 'trackCount': rng.randint(0, 1000), 'updateTime': 1600000000000,
+                  'commentThreadId': "A_PL_0_{}".format(rng.getrandbits(32)), 'playCount': rng.randint(0, 10 ** 5),
+                  'trackNumberUpdateTime': 1600000000000, 'coverImgUrl': "http://p1.music.126.net/cover.jpg",
+                  'specialType': 5 if i == 0 else 0, 'anonimous': False, 'createTime': 1450000000000,
+                  'highQuality': False, 'newImported': False, 'tags': [], 'ordered': True, 'status': 0,
+                  'description': None, 'adType': 0, 'id': rng.randint(10 ** 8, 5 * 10 ** 9),
+                  'name': "用户{}喜欢的音乐".format(user_id) if i == 0 else "歌单 {}".format(i)}
+                 for i in range(count)]
+    return json.dumps({'more': True, 'playlist': playlists, 'code': 200}).encode("utf-8")
+
+
+# Dupefilter
+
+def filled_table(context):
+    table = SparsePresenceTable(10, 2)
+    for user_id in context.user_ids(context.fill):
+        table.set_present(user_id)
+    return table
+
+
+@benchmark("sparse_presence_table/set_present")
+def bench_set_present(context):
+    user_ids = context.user_ids(100000)
+    return lambda: consume(map(SparsePresenceTable(10, 2).set_present, user_ids)), len(user_ids)
+
+
+@benchmark("sparse_presence_table/is_present")
+def bench_is_present(context):
+    table = filled_table(context)
+    user_ids = context.user_ids(100000)
+    return lambda: consume(map(table.is_present, user_ids)), len(user_ids)
+
+
+@benchmark("sparse_presence_table/present")
+def bench_present(context):
+    table = filled_table(context)
+    user_ids = context.user_ids(100000)
+
+    def run():
+        for user_id in user_ids:
+            table.present(user_id)
+    return run, len(user_ids)
+
+
+@benchmark("sparse_presence_table/present_many")
+def bench_present_many(context):
+    table = filled_table(context)
+    pages = [context.user_ids(100) for _ in range(1000)]
+    return lambda: consume(map(table.present_many, pages)), sum(map(len, pages))
+
+
+@benchmark("sparse_presence_table/dump")
+def bench_dump(context):
+    table = filled_table(context)
+    return lambda: table.dump_to_file(io.BytesIO()), 1
+
+
+@benchmark("sparse_presence_table/load")
+def bench_load(context):
+    file = io.BytesIO()
+    filled_table(context).dump_to_file(file)
+
+    def run():
+        file.seek(0)
+        SparsePresenceTable(10, 2).load_from_file(file)
+    return run, 1
+
+
+# Weapi encryption
+
+WEAPI_PARAMS = {"userId": "1234567890", "offset": "0", "total": "false", "limit": "100", "csrf_token": ""}
+
+
+@benchmark("nem_crypto/encrypt/key_pool")
+def bench_encrypt(context):
+    pool = nem_crypto.KeyPool(64, keys=nem_crypto.seeded_keys(context.seed, 64))
+    return lambda: [nem_crypto.encrypt(WEAPI_PARAMS, key_pool=pool) for _ in range(1000)], 1000
+
+
+@benchmark("nem_crypto/encrypt/key_pool_reused")
+def bench_encrypt_reused_keys(context):
+    pool = nem_crypto.KeyPool(64, reuse=16, keys=nem_crypto.seeded_keys(context.seed, 64))
+    return lambda: [nem_crypto.encrypt(WEAPI_PARAMS, key_pool=pool) for _ in range(1000)], 1000
+
+
+@benchmark("nem_crypto/encrypt/square_multiply")
+def bench_encrypt_square_multiply(context):
+    # as `encrypt` did before `KeyPool`, with RSA by `square_multiply` for every request
+    keys = nem_crypto.seeded_keys(context.seed, 100)
+
+    def run():
+        for key in keys:
+            pair = (key, format(nem_crypto.square_multiply(
+                int(key[::-1].hex(), 16), nem_crypto.EXPONENT, nem_crypto.MODULUS), "x").zfill(256))
+            nem_crypto.encrypt(WEAPI_PARAMS, key_pool=type("", (), {'get': lambda _: pair})())
+    return run, len(keys)
+
+
+@benchmark("nem_crypto/encrypt/random_key")
+def bench_encrypt_random_key(context):
+    return lambda: [nem_crypto.encrypt(WEAPI_PARAMS) for _ in range(100)], 100
+
+
+@benchmark("nem_crypto/rsa_encrypt")
+def bench_rsa_encrypt(context):
+    keys = nem_crypto.seeded_keys(context.seed, 100)
+    return lambda: consume(map(nem_crypto.rsa_encrypt, keys)), len(keys)
+
+
+@benchmark("nem_crypto/aes_cbc_encrypt")
+def bench_aes_cbc_encrypt(context):
+    data = json.dumps(WEAPI_PARAMS).encode("utf-8")
+    key = nem_crypto.seeded_keys(context.seed, 1)[0]
+    return lambda: [nem_crypto.aes_cbc_encrypt(data, key) for _ in range(10000)], 10000
+
+
+# Page extraction, by scanning and by selectors as `common.nem_page` falls back to, per page
+
+@benchmark("nem_page/user_page/scan")
+def bench_scan_user_page(context):
+    pages = [user_page(context.random, user_id) for user_id in context.user_ids(50)]
+    return lambda: [nem_page.user_profile_of(nem_page.scan_ld_json(page)) for page in pages], len(pages)
+
+
+@benchmark("nem_page/user_page/select")
+def bench_select_user_page(context):
+    pages = [user_page(context.random, user_id) for user_id in context.user_ids(50)]
+    return lambda: [nem_page.user_profile_of(nem_page.select_ld_json(nem_page.Selector(text=page)))
+                    for page in pages], len(pages)
+
+
+@benchmark("nem_page/favorite_songs/scan")
+def bench_scan_favorite_songs(context):
+    pages = [playlist_page(context.random, user_id) for user_id in context.user_ids(20)]
+    return lambda: [nem_page.scan_favorite_songs(page) for page in pages], len(pages)
+
+
+@benchmark("nem_page/favorite_songs/select")
+def bench_select_favorite_songs(context):
+    pages = [playlist_page(context.random, user_id) for user_id in context.user_ids(20)]
+    return lambda: [nem_page.select_favorite_songs(nem_page.Selector(text=page)) for page in pages], len(pages)
+
+
+# Response decoding, per response
+
+@benchmark("nem_json/follow_page")
+def bench_follow_page(context):
+    bodies = [follow_body(context.random, context.user_ids(100), "followeds") for _ in range(20)]
+    return lambda: [nem_json.follow_page(body, "followeds") for body in bodies], len(bodies)
+
+
+@benchmark("nem_json/first_playlist")
+def bench_first_playlist(context):
+    bodies = [playlists_body(context.random, user_id) for user_id in context.user_ids(200)]
+    return lambda: consume(map(nem_json.first_playlist, bodies)), len(bodies)
+
+
+# Spider callbacks
+
+def user_page_responses(context, count=50):
+    pages = [(user_id, user_page(context.random, user_id).encode("utf-8")) for user_id in context.user_ids(count)]
+    return lambda: [HtmlResponse("http://music.163.com/user/home?id={}".format(user_id), body=body,
+                                 encoding="utf-8") for user_id, body in pages]
+
+
+@benchmark("spider/parse_user_page")
+def bench_parse_user_page(context):
+    spider, responses = context.spider, user_page_responses(context)
+
+    def run():
+        for response in responses():
+            consume(spider.parse_user_page(response))
+    return run, len(responses())
+
+
+def playlist_responses(context, count=20):
+    pages = [(user_id, playlist_page(context.random, user_id).encode("utf-8"))
+             for user_id in context.user_ids(count)]
+    return lambda: [HtmlResponse("http://music.163.com/playlist?id={}".format(user_id), body=body, encoding="utf-8",
+                                 request=Request("http://music.163.com/playlist?id={}".format(user_id),
+                                                 meta={'user_profile': UserProfile(id=user_id)}))
+                    for user_id, body in pages]
+
+
+@benchmark("spider/parse_favorite_songs")
+def bench_parse_favorite_songs(context):
+    spider, responses = context.spider, playlist_responses(context)
+
+    def run():
+        for response in responses():
+            consume(spider.parse_favorite_songs(response))
+    return run, len(responses())
+
+
+@benchmark("spider/parse_playlists")
+def bench_parse_playlists(context):
+    spider = context.spider
+    bodies = [(user_id, playlists_body(context.random, user_id)) for user_id in context.user_ids(200)]
+
+    def run():
+        for user_id, body in bodies:
+            url = "http://music.163.com/weapi/user/playlist?csrf_token="
+            request = Request(url, method="POST", meta={'user_profile': UserProfile(id=user_id)})
+            consume(spider.parse_playlists(TextResponse(url, body=body, encoding="utf-8", request=request)))
+    return run, len(bodies)
+
+
+@benchmark("spider/parse_follow")
+def bench_parse_follow(context):
+    """Pages of 100 followers, each of which makes requests for its playlists and follows (not encrypted)."""
+    spider = context.spider
+    pages = [(user_id, follow_body(context.random, context.user_ids(100), "followeds"))
+             for user_id in context.user_ids(20)]
+
+    def run():
+        for user_id, body in pages:
+            url = "http://music.163.com/weapi/user/getfolloweds?csrf_token="
+            request = Request(url, method="POST", meta={'follow_type': "followers", 'follow_user_id': user_id,
+                                                        'follow_offset': 0, 'follow_limit': 100})
+            consume(spider.parse_follow(TextResponse(url, body=body, encoding="utf-8", request=request)))
+    return run, len(pages)
+
+
+# Item pipeline
+
+class StubCollection():
+    """Take writes of `TxMongoPipeline` at once, to time the pipeline without MongoDB."""
+    result = types.SimpleNamespace(bulk_api_result={})
+
+    def bulk_write(self, operations, ordered=True):
+        return defer.succeed(self.result)
+
+    def update_one(self, *args, **kwargs):
+        return defer.succeed(self.result)
+
+    insert_one = update_one
+
+
+def stub_pipeline(context, **kwargs):
+    spider = context.spider
+    pipeline = TxMongoPipeline(None, "nem", stats=spider.crawler.stats, **kwargs)
+    pipeline.db = {UserProfile.collection_name: StubCollection(), Song.collection_name: StubCollection()}
+    return pipeline, spider
+
+
+def user_profiles(context, count):
+    return [UserProfile(id=user_id, name="用户{}".format(user_id), avatar_url="http://p1.music.126.net/a.jpg",
+                        description="喜欢音乐", favorite_songs=[context.random.randint(10 ** 5, 2 * 10 ** 9)
+                                                           for _ in range(context.random.randint(0, 200))])
+            for user_id in context.user_ids(count)]
+
+
+@benchmark("pipeline/process_item")
+def bench_process_item(context):
+    pipeline, spider = stub_pipeline(context)
+    items = user_profiles(context, 1000)
+    return lambda: [pipeline.process_item(item, spider) for item in items], len(items)
+
+
+@benchmark("pipeline/process_item/buffered")
+def bench_process_item_buffered(context):
+    pipeline, spider = stub_pipeline(context, buffer_size=500)
+    items = user_profiles(context, 1000)
+    return lambda: [pipeline.process_item(item, spider) for item in items], len(items)
+
+
+@benchmark("pipeline/process_item/packed_ids")
+def bench_process_item_packed(context):
+    pipeline, spider = stub_pipeline(context, buffer_size=500, pack_id_lists=True)
+    items = user_profiles(context, 1000)
+    return lambda: [pipeline.process_item(item, spider) for item in items], len(items)
+
+
+@benchmark("pipeline/process_item/song_batch_write_once")
+def bench_process_song_batch(context):
+    """Batches of favorite songs, of which most have been written before, as songs are shared among users."""
+    pipeline, spider = stub_pipeline(context, buffer_size=500, write_once=True)
+    popular = [context.random.randint(10 ** 5, 2 * 10 ** 9) for _ in range(2000)]
+    batches = [SongBatch(items=[{'id': context.random.choice(popular), 'name': "歌曲"} for _ in range(200)])
+               for _ in range(250)]
+    return lambda: [pipeline.process_item(batch, spider) for batch in batches], sum(len(b['items']) for b in batches)
@@ -0,0 +1,11 @@
+from pymongo import MongoClient
+from pymongo.uri_parser import parse_uri
+
+from ..spiders.user import UserSpider
+
+
+def mongo_collection(settings, collection_name):
+    """Get the `pymongo` collection that `TxMongoPipeline` writes `collection_name` to with `settings`."""
+    mongo_uri = settings.get('MONGO_URI') or "mongodb://localhost:27017"
+    db_name = settings.get('MONGO_DB') or parse_uri(mongo_uri)['database'] or UserSpider.database_name
+    return MongoClient(mongo_uri)[db_name][collection_name]
@@ -0,0 +1,44 @@
+import logging
+import os
+
+import numpy as np
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ..common.edge_log import read_edges, build_csr
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ScrapyCommand):
+    requires_project = False
+    requires_crawler_process = False
+    default_settings = {'LOG_ENABLED': True}
+
+    def syntax(self):
+        return "[options] <edge log> <directory>"
+
+    def short_desc(self):
+        return "Deduplicate and sort a follow edge log into CSR adjacency of .npy files"
+
+    def long_desc(self):
+        return ("Write node_ids.npy, indptr.npy and indices.npy to <directory>, where user node_ids[i] follows "
+                "users node_ids[indices[indptr[i]:indptr[i + 1]]]. With --reverse, i is followed by them instead.")
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--reverse", action="store_true",
+                            help="build adjacency of followers instead of following")
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        edges = read_edges(args[0])
+        src, dst = (edges['dst'], edges['src']) if opts.reverse else (edges['src'], edges['dst'])
+        node_ids, indptr, indices = build_csr(src, dst)
+        os.makedirs(args[1], exist_ok=True)
+        np.save(os.path.join(args[1], "node_ids.npy"), node_ids)
+        np.save(os.path.join(args[1], "indptr.npy"), indptr)
+        np.save(os.path.join(args[1], "indices.npy"), indices)
+        logger.info("Built adjacency of {} users and {} edges out of {} logged".format(
+            len(node_ids), len(indices), len(edges)))
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+
+import numpy as np
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ..common.id_list import unpack_ids
+from ..items import UserProfile
+from . import mongo_collection
+
+logger = logging.getLogger(__name__)
+
+
+class CSRExporter():
+    """Write `favorite_songs` of users, given in the order of `_id`, as a user×song CSR matrix in chunks of `.npy`s.
+
+    Chunk `k` has `indptr.k.npy` (offsets into its own `indices`), `indices.k.npy` (dense song indexes),
+    `user_ids.k.npy` (the user ID of each row) and `song_ids.k.npy` (the song IDs first found in it, so that song index
+    `i` is the `i`-th of the concatenation of all). After each chunk, `checkpoint.json` records where to resume.
+    `merge` concatenates the chunks into `indptr.npy`, `indices.npy`, `user_ids.npy` and `song_ids.npy`.
+    """
+
+    CHECKPOINT = "checkpoint.json"
+
+    def __init__(self, path, chunk_size=1000000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk = 0  # number of chunks written
+        self.last_id = None  # `_id` of the last user written
+        self.nnz = 0
+        self.song_indexes = {}
+        os.makedirs(path, exist_ok=True)
+        checkpoint_path = os.path.join(path, self.CHECKPOINT)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as file:
+                checkpoint = json.load(file)
+            self.chunk, self.last_id, self.nnz = checkpoint['chunk'], checkpoint['last_id'], checkpoint['nnz']
+            for k in range(self.chunk):
+                for song_id in np.load(self.chunk_path("song_ids", k)).tolist():
+                    self.song_indexes[song_id] = len(self.song_indexes)
+            logger.info("Resuming after user {} with {} chunks and {} songs".format(
+                self.last_id, self.chunk, len(self.song_indexes)))
+
+    def chunk_path(self, name, k):
+        return os.path.join(self.path, "{}.{:06d}.npy".format(name, k))
+
+    def export(self, users):
+        """Export `users`, an iterable of documents ordered by `_id` after `last_id`."""
+        song_indexes = self.song_indexes
+        user_ids, indptr, indices, new_song_ids = [], [0], [], []
+        for user in users:
+            songs = user.get('favorite_songs') or []
+            if isinstance(songs, bytes):
+                songs = unpack_ids(songs)
+            for song_id in songs:
+                index = song_indexes.get(song_id)
+                if index is None:
+                    index = song_indexes[song_id] = len(song_indexes)
+                    new_song_ids.append(song_id)
+                indices.append(index)
+            user_ids.append(user['_id'])
+            indptr.append(len(indices))
+            if len(user_ids) >= self.chunk_size:
+                self.write_chunk(user_ids, indptr, indices, new_song_ids)
+                user_ids, indptr, indices, new_song_ids = [], [0], [], []
+        if user_ids:
+            self.write_chunk(user_ids, indptr, indices, new_song_ids)
+
+    def write_chunk(self, user_ids, indptr, indices, new_song_ids):
+        k = self.chunk
+        np.save(self.chunk_path("user_ids", k), np.array(user_ids, dtype=np.int64))
+        np.save(self.chunk_path("indptr", k), np.array(indptr, dtype=np.int64))
+        np.save(self.chunk_path("indices", k), np.array(indices, dtype=np.int32))
+        np.save(self.chunk_path("song_ids", k), np.array(new_song_ids, dtype=np.int64))
+        self.chunk += 1
+        self.last_id = user_ids[-1]
+        self.nnz += len(indices)
+        temp_path = os.path.join(self.path, self.CHECKPOINT + ".tmp")
+        with open(temp_path, "w") as file:
+            json.dump({'chunk': self.chunk, 'last_id': self.last_id, 'nnz': self.nnz}, file)
+        os.replace(temp_path, os.path.join(self.path, self.CHECKPOINT))
+        logger.info("Exported chunk {}: {} users, {} favorites, {} songs in total".format(
+            k, len(user_ids), len(indices), len(self.song_indexes)))
+
+    def merge(self):
+        """Concatenate chunks into whole arrays, writing through memory maps to bound memory."""
+        def concatenate(name, dtype, offset=None):
+            lengths = [np.load(self.chunk_path(name, k), mmap_mode="r").shape[0] - (1 if offset else 0)
+                       for k in range(self.chunk)]
+            merged = np.lib.format.open_memmap(os.path.join(self.path, name + ".npy"), mode="w+", dtype=dtype,
+                                               shape=(sum(lengths) + (1 if offset else 0),))
+            start = base = 0
+            for k, length in enumerate(lengths):
+                chunk = np.load(self.chunk_path(name, k), mmap_mode="r")
+                if offset:  # `indptr`s: rebase and drop the leading 0 of each chunk
+                    merged[start + 1:start + 1 + length] = chunk[1:] + base
+                    base += chunk[-1]
+                else:
+                    merged[start:start + length] = chunk
+                start += length
+            merged.flush()
+        concatenate("user_ids", np.int64)
+        concatenate("indptr", np.int64, offset=True)
+        concatenate("indices", np.int32)
+        concatenate("song_ids", np.int64)
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    requires_crawler_process = False
+    default_settings = {'LOG_ENABLED': True}
+
+    def syntax(self):
+        return "[options] <directory>"
+
+    def short_desc(self):
+        return "Export favorite songs of stored users as a user×song CSR matrix of .npy files"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--chunk-size", type=int, default=1000000, metavar="N",
+                            help="number of users per chunk (default: 1000000)")
+        parser.add_argument("--batch-size", type=int, default=10000, metavar="N",
+                            help="number of users per batch of the cursor (default: 10000)")
+        parser.add_argument("--no-merge", action="store_true",
+                            help="keep the chunks only, without concatenating them in the end")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        exporter = CSRExporter(args[0], opts.chunk_size)
+        query = {'favorite_songs': {'$exists': True}}
+        if exporter.last_id is not None:
+            query['_id'] = {'$gt': exporter.last_id}
+        collection = mongo_collection(self.settings, UserProfile.collection_name)
+        cursor = collection.find(query, {'favorite_songs': 1}).sort('_id', 1).batch_size(opts.batch_size)
+        exporter.export(cursor)
+        if not opts.no_merge:
+            exporter.merge()
+        logger.info("Exported {} favorites of {} songs to {}".format(
+            exporter.nnz, len(exporter.song_indexes), args[0]))
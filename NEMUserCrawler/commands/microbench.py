@@ -0,0 +1,126 @@
+import fnmatch
+import gc
+import json
+import logging
+import os
+import platform
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+logger = logging.getLogger(__name__)
+
+
+def measure(run, ops, repeat):
+    """Time `run` `repeat` times after a warm-up, with GC off as `timeit` does, and return the best and the median
+    seconds per operation."""
+    run()
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - started) / ops)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def environment():
+    return {'python': platform.python_implementation() + " " + platform.python_version(),
+            'machine': platform.machine(), 'processor': platform.processor() or None}
+
+
+class Command(ScrapyCommand):
+    """Run the micro-benchmarks of `NEMUserCrawler.benchmarks` and compare them with a JSON baseline.
+
+    The best time per operation of each benchmark is what is compared, as it is the least noisy. The command fails
+    with the exit code 1 if any benchmark is more than `--max-slowdown` times as slow as in the baseline.
+    """
+    requires_project = True
+    requires_crawler_process = False
+    default_settings = {'LOG_LEVEL': 'INFO'}
+
+    def syntax(self):
+        return "[options] [pattern ...]"
+
+    def short_desc(self):
+        return "Run micro-benchmarks of hot paths and compare them with a baseline"
+
+    def long_desc(self):
+        return ("Run micro-benchmarks whose names match any of the glob patterns given (all by default), and compare "
+                "them with the baseline. Use --save to record the results as the baseline.")
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--baseline", metavar="FILE", default="microbench.json",
+                            help="JSON file of the baseline (default: microbench.json)")
+        parser.add_argument("--save", action="store_true",
+                            help="save the results to the baseline, replacing those of the benchmarks run")
+        parser.add_argument("--max-slowdown", type=float, default=1.3, metavar="RATIO",
+                            help="fail if a benchmark takes more than RATIO times as long as the baseline (default: "
+                                 "1.3)")
+        parser.add_argument("--repeat", type=int, default=5, metavar="N", help="timed runs of each (default: 5)")
+        parser.add_argument("--fill", type=int, default=1000000, metavar="N",
+                            help="user IDs in the tables of the dupefilter benchmarks (default: 1000000)")
+        parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+        parser.add_argument("-o", "--output", metavar="FILE", help="also write the results as JSON to FILE")
+
+    def run(self, args, opts):
+        # imported here, as `pipelines` brings in `twisted.internet.reactor` before the crawl commands install theirs
+        from ..benchmarks import BENCHMARKS, BenchmarkContext
+        names = [name for name in BENCHMARKS if not args or any(fnmatch.fnmatch(name, pattern) for pattern in args)]
+        if opts.list:
+            print("\n".join(names))
+            return
+        if not names:
+            raise UsageError("No benchmarks match {}".format(" ".join(args)))
+        if opts.repeat < 1 or opts.max_slowdown <= 0:
+            raise UsageError("--repeat and --max-slowdown must be positive")
+
+        baseline = {'environment': None, 'benchmarks': {}}
+        if os.path.exists(opts.baseline):
+            with open(opts.baseline) as file:
+                baseline = json.load(file)
+            if baseline.get('environment') != environment():
+                logger.warning("The baseline was taken in another environment, %s, so timings may not compare",
+                               baseline.get('environment'))
+        elif not opts.save:
+            logger.warning("No baseline at %s, run with --save to take one", opts.baseline)
+
+        context = BenchmarkContext(self.settings, fill=opts.fill)
+        results = {}
+        regressions = []
+        print("{:<48} {:>12} {:>12} {:>12} {:>7}".format("benchmark", "best µs/op", "median µs/op", "baseline", "ratio"))
+        for name in names:
+            run, ops = BENCHMARKS[name](context)
+            best, median = measure(run, ops, opts.repeat)
+            results[name] = {'best_us': round(best * 1e6, 4), 'median_us': round(median * 1e6, 4), 'ops': ops}
+            base = baseline['benchmarks'].get(name, {}).get('best_us')
+            ratio = results[name]['best_us'] / base if base else None
+            if ratio is not None and ratio > opts.max_slowdown:
+                regressions.append(name)
+            print("{:<48} {:>12.3f} {:>12.3f} {:>12} {:>7} {}".format(
+                name, best * 1e6, median * 1e6, "{:.3f}".format(base) if base else "-",
+                "{:.2f}".format(ratio) if ratio is not None else "-",
+                "SLOWER" if name in regressions else ""))
+
+        if opts.output:
+            with open(opts.output, "w") as file:
+                json.dump({'environment': environment(), 'benchmarks': results}, file, indent=2, sort_keys=True)
+        if opts.save:
+            baseline['environment'] = environment()
+            baseline['benchmarks'].update(results)
+            with open(opts.baseline + ".tmp", "w") as file:
+                json.dump(baseline, file, indent=2, sort_keys=True)
+            os.replace(opts.baseline + ".tmp", opts.baseline)
+            logger.info("Saved %d results to the baseline %s", len(results), opts.baseline)
+        elif regressions:
+            logger.error("%d benchmarks are more than %.2f times as slow as the baseline: %s",
+                         len(regressions), opts.max_slowdown, ", ".join(regressions))
+            self.exitcode = 1
@@ -0,0 +1,149 @@
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from scrapy import signals
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ..common import nem_crypto
+from ..items import UserProfile
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("mock server exited with {}".format(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("mock server did not start listening in {} secs".format(timeout))
+
+
+class Command(ScrapyCommand):
+    """Run `UserSpider` against `mock_server` on a synthetic graph, and report the throughput and resource usage."""
+    requires_project = True
+    default_settings = {'LOG_LEVEL': 'INFO'}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Benchmark the user spider against a local mock NEM server"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--users", type=int, default=10000, help="users in the synthetic graph")
+        parser.add_argument("--mean-degree", type=float, default=20, help="mean number of following of users")
+        parser.add_argument("--latency", type=float, default=0.0, help="mean latency of the server in seconds")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+        parser.add_argument("--seconds", type=float, default=60, help="stop after this many seconds (0 for never)")
+        parser.add_argument("--items", type=int, default=0, help="stop after this many items (0 for never)")
+        parser.add_argument("--concurrency", type=int, default=None, help="`CONCURRENT_REQUESTS`")
+        parser.add_argument("--pipelines", action="store_true", help="keep `ITEM_PIPELINES`, i.e. MongoDB")
+        parser.add_argument("--port", type=int, default=0, help="port of the mock server (default: a free one)")
+        parser.add_argument("-o", "--output", metavar="FILE", help="also write the report as JSON to FILE")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        port = opts.port or free_port()
+        key_seed, key_count = 0, max(self.settings.getint('NEM_KEY_POOL_SIZE'), 1)
+        server = subprocess.Popen([sys.executable, "-m", "NEMUserCrawler.mock_server", "--port", str(port),
+                                   "--users", str(opts.users), "--mean-degree", str(opts.mean_degree),
+                                   "--latency", str(opts.latency), "--error-rate", str(opts.error_rate),
+                                   "--key-seed", str(key_seed), "--key-count", str(key_count)])
+        jobdir = tempfile.mkdtemp(prefix="mockbench-")
+        try:
+            wait_for_port(port, server)
+            # picked up by `HttpProxyMiddleware`, all requests being for absolute URLs of `common.nem.BASE_URL`
+            os.environ['http_proxy'] = "http://127.0.0.1:{}".format(port)
+            overrides = {
+                'NEM_KEY_POOL_SIZE': key_count,
+                'JOBDIR': jobdir,
+                'ROBOTSTXT_OBEY': False,
+                'HTTPCACHE_ENABLED': False,
+                'AUTOTHROTTLE_ENABLED': False,
+                'DOWNLOAD_DELAY': 0,
+                'TELNETCONSOLE_ENABLED': False,
+                'CLOSESPIDER_TIMEOUT': opts.seconds,
+                'CLOSESPIDER_ITEMCOUNT': opts.items,
+                # requests go to the mock server only
+                'DOWNLOADER_MIDDLEWARES': {
+                    name: order for name, order in self.settings.getdict('DOWNLOADER_MIDDLEWARES').items()
+                    if not name.startswith('rotating_proxies.')},
+            }
+            if opts.concurrency:
+                overrides['CONCURRENT_REQUESTS'] = overrides['CONCURRENT_REQUESTS_PER_DOMAIN'] = opts.concurrency
+            if not opts.pipelines:
+                overrides['ITEM_PIPELINES'] = {}
+            self.settings.setdict(overrides, priority='cmdline')
+            report = self.benchmark(key_seed, key_count)
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(jobdir, ignore_errors=True)
+        report.update(graph_users=opts.users, mean_degree=opts.mean_degree, latency=opts.latency,
+                      error_rate=opts.error_rate)
+        if not report['requests']:
+            self.exitcode = 1
+        print(json.dumps(report, indent=2))
+        if opts.output:
+            with open(opts.output, "w") as file:
+                json.dump(report, file, indent=2)
+
+    def benchmark(self, key_seed, key_count):
+        """Crawl and return a report of users (profiles with favorite songs) and requests per second, CPU time per
+        item and peak RSS of this process.
+
+        The spider encrypts with `key_count` keys seeded by `key_seed` only, for the mock server to decrypt requests.
+        """
+        crawler = self.crawler_process.create_crawler("user")
+        counts = {'users': 0, 'items': 0}
+
+        def spider_opened(spider):
+            spider.key_pool = nem_crypto.KeyPool(key_count, self.settings.getint('NEM_KEY_POOL_REUSE', 1),
+                                                 keys=nem_crypto.seeded_keys(key_seed, key_count))
+        crawler.signals.connect(spider_opened, signal=signals.spider_opened)
+
+        def item_scraped(item, response, spider):
+            counts['items'] += 1
+            if isinstance(item, UserProfile) and 'favorite_songs' in item:
+                counts['users'] += 1
+        crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.perf_counter()
+        self.crawler_process.crawl(crawler)
+        self.crawler_process.start()
+        elapsed = time.perf_counter() - started
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (usage_after.ru_utime - usage.ru_utime) + (usage_after.ru_stime - usage.ru_stime)
+        requests = crawler.stats.get_value('downloader/request_count', 0)
+        return {
+            'elapsed': round(elapsed, 3),
+            'users': counts['users'],
+            'items': counts['items'],
+            'requests': requests,
+            'users_per_sec': round(counts['users'] / elapsed, 2),
+            'requests_per_sec': round(requests / elapsed, 2),
+            'cpu_secs': round(cpu, 3),
+            'cpu_ms_per_item': round(cpu * 1000 / counts['items'], 3) if counts['items'] else None,
+            'peak_rss_mb': round(usage_after.ru_maxrss / 1024, 1),  # in KiB on Linux
+            'new_users_per_request': crawler.stats.get_value('user/follow/new_per_request'),
+        }
@@ -0,0 +1,73 @@
+import json
+import logging
+
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+from pymongo import UpdateOne
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ..common.id_list import pack_ids, unpack_ids
+from ..items import UserProfile
+from . import mongo_collection
+
+
+class Command(ScrapyCommand):
+    """Migrate stored users to or from `MONGO_PACK_IDS`, or export their packed fields as JSON lines."""
+    requires_project = True
+    requires_crawler_process = False
+    default_settings = {'LOG_ENABLED': True}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Pack or unpack the ID lists of stored users, or export them unpacked"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument("--unpack", action="store_true",
+                            help="store packed ID lists back as arrays")
+        parser.add_argument("-o", "--export", metavar="FILE",
+                            help="write `{\"_id\": ..., <field>: [...]}` lines of all users to FILE instead")
+        parser.add_argument("--batch-size", type=int, default=1000, metavar="N",
+                            help="number of documents per bulk write (default: 1000)")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        logger = logging.getLogger(__name__)
+        collection = mongo_collection(self.settings, UserProfile.collection_name)
+        fields = UserProfile.packed_fields
+
+        if opts.export:
+            with open(opts.export, "w", encoding="utf-8") as file:
+                count = 0
+                for doc in collection.find({}, {field: 1 for field in fields}):
+                    for field in fields:
+                        if isinstance(doc.get(field), bytes):
+                            doc[field] = unpack_ids(doc[field])
+                    file.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                    count += 1
+            logger.info("Exported %d users to %s", count, opts.export)
+            return
+
+        # arrays are BSON type 4, binaries type 5
+        query = {'$or': [{field: {'$type': 5 if opts.unpack else 4}} for field in fields]}
+        operations = []
+        count = 0
+        for doc in collection.find(query, {field: 1 for field in fields}):
+            update = {}
+            for field in fields:
+                value = doc.get(field)
+                if opts.unpack and isinstance(value, bytes):
+                    update[field] = unpack_ids(value)
+                elif not opts.unpack and isinstance(value, list):
+                    update[field] = Binary(pack_ids(value), USER_DEFINED_SUBTYPE)
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': update}))
+            if len(operations) >= opts.batch_size:
+                count += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+                logger.info("%s %d users so far", "Unpacked" if opts.unpack else "Packed", count)
+        if operations:
+            count += collection.bulk_write(operations, ordered=False).modified_count
+        logger.info("%s %d users in total", "Unpacked" if opts.unpack else "Packed", count)
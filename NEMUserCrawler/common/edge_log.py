@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # only needed for `read_edges` and `build_csr`
+    np = None
+
+__all__ = ["EdgeLog", "read_edges", "build_csr", "FOLLOWING", "FOLLOWERS"]
+
+# where an edge was found: in the following of `src`, or in the followers of `dst`
+FOLLOWING, FOLLOWERS = 0, 1
+
+
+class EdgeLog():
+    """Append-only file of `(src, dst, type)` edges meaning `src` follows `dst`, as fixed-width `RECORD`s.
+
+    With no header, the file is an array of the record, see `read_edges` for mapping it. A record cut by a crash is
+    truncated when the log is opened again.
+    """
+
+    RECORD = struct.Struct("<QQB")
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        size = self.file.seek(0, os.SEEK_END)
+        if size % self.RECORD.size:
+            self.file.truncate(size - size % self.RECORD.size)
+        self.count = 0  # records appended since opened
+
+    def append(self, edges):
+        """Append `edges`, an iterable of `(src, dst, type)`."""
+        pack = self.RECORD.pack
+        data = b"".join(pack(*edge) for edge in edges)
+        self.file.write(data)
+        self.count += len(data) // self.RECORD.size
+
+    def append_follows(self, user_id, follow_type, user_ids):
+        """Append edges of `user_ids` found in the "following" or "followers" of `user_id`."""
+        if follow_type == "following":
+            self.append((user_id, other, FOLLOWING) for other in user_ids)
+        else:
+            self.append((other, user_id, FOLLOWERS) for other in user_ids)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+def read_edges(path):
+    """Map an edge log at `path` as a read-only NumPy array of records with fields `src`, `dst` and `type`."""
+    dtype = np.dtype([('src', '<u8'), ('dst', '<u8'), ('type', 'u1')])
+    count = os.path.getsize(path) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def build_csr(src, dst):
+    """Deduplicate and sort edges given as arrays of `src` and `dst`, into CSR adjacency of dense node indexes.
+
+    Return `(node_ids, indptr, indices)`, where the nodes followed by node `i`, i.e. user `node_ids[i]`, are
+    `indices[indptr[i]:indptr[i + 1]]`, in ascending order.
+    """
+    src = np.asarray(src, dtype=np.uint64)
+    dst = np.asarray(dst, dtype=np.uint64)
+    node_ids = np.unique(np.concatenate((src, dst)))
+    src = np.searchsorted(node_ids, src)
+    dst = np.searchsorted(node_ids, dst)
+    order = np.lexsort((dst, src))
+    src, dst = src[order], dst[order]
+    if len(src):
+        unique = np.empty(len(src), dtype=bool)
+        unique[0] = True
+        np.logical_or(src[1:] != src[:-1], dst[1:] != dst[:-1], out=unique[1:])
+        src, dst = src[unique], dst[unique]
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(node_ids)), out=indptr[1:])
+    index_type = np.int32 if len(node_ids) < 2 ** 31 else np.int64
+    return node_ids, indptr, dst.astype(index_type)
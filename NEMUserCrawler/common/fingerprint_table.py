@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+from array import array
+from hashlib import blake2b
+import json
+import struct
+import sys
+
+try:
+    from .sparse_presence_table import SerializationError
+except ImportError:  # imported as a top-level module, as by `tests.py`
+    from sparse_presence_table import SerializationError
+
+__all__ = ["FingerprintTable", "fingerprint_of"]
+
+
+def fingerprint_of(document):
+    """Get a 64-bit hash of `document`, a JSON-serializable `dict`, regardless of the order of its keys."""
+    data = json.dumps(document, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return int.from_bytes(blake2b(data.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class FingerprintTable():
+    """Map non-negative integer keys (below 2 ** 64 - 1) to 64-bit fingerprints, in two `array`s of open addressing.
+
+    Keys are stored as `key + 1` so that 0 marks an empty slot. At most `MAX_LOAD` of the slots are used, which makes
+    it about 23 bytes per entry, instead of a few hundreds for a `dict` of `int`s.
+    """
+
+    MAGIC = b"SFPT"
+    VERSION = 1
+    MAX_LOAD = 0.7
+    _MULTIPLIER = 0x9E3779B97F4A7C15  # Fibonacci hashing
+    _MASK64 = 2 ** 64 - 1
+
+    def __init__(self, capacity=1024):
+        self._len = 0
+        self._allocate(max(capacity, 8))
+
+    def _allocate(self, capacity):
+        self._bits = (capacity - 1).bit_length()
+        self._capacity = 1 << self._bits
+        self._keys = array("Q", bytes(8 * self._capacity))
+        self._values = array("Q", bytes(8 * self._capacity))
+
+    def _slot(self, stored_key):
+        """Find the slot holding `stored_key`, or the empty one where it would go."""
+        keys = self._keys
+        mask = self._capacity - 1
+        i = ((stored_key * self._MULTIPLIER) & self._MASK64) >> (64 - self._bits)
+        while True:
+            k = keys[i]
+            if k == stored_key or k == 0:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        keys, values = self._keys, self._values
+        self._allocate(self._capacity * 2)
+        for k, v in zip(keys, values):
+            if k:
+                i = self._slot(k)
+                self._keys[i] = k
+                self._values[i] = v
+
+    def get(self, key, default=None):
+        i = self._slot(key + 1)
+        return self._values[i] if self._keys[i] else default
+
+    def __getitem__(self, key):
+        i = self._slot(key + 1)
+        if not self._keys[i]:
+            raise KeyError(key)
+        return self._values[i]
+
+    def __setitem__(self, key, fingerprint):
+        i = self._slot(key + 1)
+        if not self._keys[i]:
+            if (self._len + 1) > self._capacity * self.MAX_LOAD:
+                self._grow()
+                i = self._slot(key + 1)
+            self._keys[i] = key + 1
+            self._len += 1
+        self._values[i] = fingerprint
+
+    def __contains__(self, key):
+        return bool(self._keys[self._slot(key + 1)])
+
+    def __len__(self):
+        return self._len
+
+    def items(self):
+        for k, v in zip(self._keys, self._values):
+            if k:
+                yield k - 1, v
+
+    def update(self, key, fingerprint):
+        """Set the fingerprint of `key` and return whether it has changed (or been missing)."""
+        i = self._slot(key + 1)
+        if self._keys[i]:
+            if self._values[i] == fingerprint:
+                return False
+            self._values[i] = fingerprint
+            return True
+        self[key] = fingerprint
+        return True
+
+    def dump_to_file(self, file):
+        """Dump the table in the format of `VERSION`, which `load_from_file` accepts, and return bytes written."""
+        file.write(struct.pack("!4sBBQ", self.MAGIC, self.VERSION, self._bits, self._len))
+        byte_count = 0
+        for a in (self._keys, self._values):
+            if sys.byteorder == "little":  # in network order as `SparsePresenceTable`
+                a = array(a.typecode, a)
+                a.byteswap()
+            byte_count += file.write(a.tobytes())
+        return byte_count
+
+    def load_from_file(self, file):
+        """Replace the content of the table with one dumped by `dump_to_file`."""
+        header = file.read(struct.calcsize("!4sBBQ"))
+        if len(header) != struct.calcsize("!4sBBQ"):
+            raise SerializationError("file ended unexpectedly when reading the header")
+        magic, version, bits, length = struct.unpack("!4sBBQ", header)
+        if magic != self.MAGIC:
+            raise SerializationError("not a fingerprint table: {!r}".format(magic))
+        if version != self.VERSION:
+            raise SerializationError("unsupported version: {}".format(version))
+        self._allocate(1 << bits)
+        for a in (self._keys, self._values):
+            size = 8 * self._capacity
+            temp = file.read(size)
+            if len(temp) != size:
+                raise SerializationError("file ended unexpectedly: got {}/{} bytes".format(len(temp), size))
+            a[:] = array("Q", temp)
+            if sys.byteorder == "little":
+                a.byteswap()
+        self._len = length
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import struct
+
+__all__ = ["FrontierRecord"]
+
+
+class FrontierRecord():
+    """A compact record of a user-centric request, which the spider rebuilds the request from when dequeued.
+
+    For `FAVORITES`, `offset` carries the ID of the playlist. For follow pages, `stride` is the distance to the next
+    page when pages are fanned out, 0 otherwise, and `total` is the number of users told by the first page to a
+    fanned-out chain, 0 otherwise. `depth` is that of the request in `DepthMiddleware`.
+    """
+    __slots__ = ("user_id", "kind", "offset", "limit", "priority", "stride", "depth", "total")
+
+    PLAYLISTS, FAVORITES, FOLLOWING, FOLLOWERS = range(4)
+    TAG = b"T"
+    STRUCT = struct.Struct("!cQBQIiIII")
+
+    def __init__(self, user_id, kind, offset=0, limit=0, priority=0, stride=0, depth=0, total=0):
+        self.user_id = user_id
+        self.kind = kind
+        self.offset = offset
+        self.limit = limit
+        self.priority = priority
+        self.stride = stride
+        self.depth = depth
+        self.total = total
+
+    def pack(self):
+        return self.STRUCT.pack(self.TAG, self.user_id, self.kind, self.offset, self.limit, self.priority,
+                                self.stride, self.depth, self.total)
+
+    @classmethod
+    def unpack(cls, data):
+        tag, *fields = cls.STRUCT.unpack(data)
+        return cls(*fields)
+
+    @classmethod
+    def is_packed(cls, data):
+        return len(data) == cls.STRUCT.size and data[:1] == cls.TAG
+
+    def __eq__(self, other):
+        return isinstance(other, FrontierRecord) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return "FrontierRecord({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
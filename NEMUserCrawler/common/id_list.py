@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Pack lists of integer IDs, e.g. favorite songs, into bytes: each ID as the zigzag varint of its delta from the
+previous one, so that the order is kept and IDs close to each other take one or two bytes."""
+
+__all__ = ["pack_ids", "unpack_ids", "FORMAT_VERSION"]
+
+FORMAT_VERSION = 1  # the first byte of packed lists
+
+
+def pack_ids(ids):
+    """Pack `ids`, a sequence of integers in the range of int64, into `bytes`."""
+    packed = bytearray((FORMAT_VERSION,))
+    previous = 0
+    for i in ids:
+        delta = i - previous
+        previous = i
+        n = delta << 1 if delta >= 0 else (-delta << 1) - 1  # zigzag
+        while n > 0x7f:
+            packed.append((n & 0x7f) | 0x80)
+            n >>= 7
+        packed.append(n)
+    return bytes(packed)
+
+
+def unpack_ids(data):
+    """Unpack a list of IDs packed by `pack_ids`."""
+    if not data:
+        raise ValueError("empty packed IDs")
+    if data[0] != FORMAT_VERSION:
+        raise ValueError("unsupported format of packed IDs: {}".format(data[0]))
+    ids = []
+    previous = 0
+    n = shift = 0
+    for byte in memoryview(data)[1:]:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += n >> 1 if not n & 1 else -((n + 1) >> 1)
+        ids.append(previous)
+        n = shift = 0
+    if shift:
+        raise ValueError("packed IDs ended in the middle of a varint")
+    return ids
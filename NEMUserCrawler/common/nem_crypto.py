@@ -5,12 +5,15 @@
 #            https://s3.music.126.net/web/s/core.js
 
 import json
+import random
 import secrets
+import threading
+from collections import deque
 from string import ascii_letters, digits
-from base64 import b64encode
+from base64 import b64encode, b64decode
 from Crypto.Cipher import AES
 
-__all__ = ["encrypt"]
+__all__ = ["encrypt", "decrypt", "KeyPool", "seeded_keys"]
 
 NONCE = b'0CoJUm6Qyw8W8jud'
 IV = b'0102030405060708'
@@ -21,22 +24,111 @@ EXPONENT = 0x010001
 VALID_KEY_SEQ = (ascii_letters + digits).encode("ascii")
 
 
-def encrypt(data, key=None):
+def encrypt(data, key=None, key_pool=None):
+    """Encrypt `data` for weapi.
+
+    If `key` is not given, a (key, encSecKey) pair is taken from `key_pool`, or generated on the spot without one.
+    """
     if not isinstance(data, (str, bytes)):
         data = json.dumps(data)
     if not isinstance(data, bytes):
         data = data.encode("UTF-8")
-    if key is None:
-        # The random key must only have letters and digits..
-        key = random_key(16)
+    if key is not None:
+        enc_sec_key = enc_sec_key_of(key)
+    elif key_pool is not None:
+        key, enc_sec_key = key_pool.get()
+    else:
+        key, enc_sec_key = random_key_pair()
     cipher_data = b64encode(aes_cbc_encrypt(
         b64encode(aes_cbc_encrypt(data, NONCE)), key))
     return {
         'params': cipher_data.decode("ascii"),
-        'encSecKey': format(rsa_encrypt(key), "x").zfill(256)
+        'encSecKey': enc_sec_key
     }
 
 
+def decrypt(params, key):
+    """Decrypt `params` of weapi encrypted with `key` back to the JSON given to `encrypt`.
+
+    Only those who know `key` can, as it is sent RSA-encrypted in `encSecKey`, e.g. a mock server sharing a `KeyPool`.
+    """
+    data = aes_cbc_decrypt(b64decode(aes_cbc_decrypt(b64decode(params), key)), NONCE)
+    return json.loads(data.decode("UTF-8"))
+
+
+def enc_sec_key_of(key) -> str:
+    return format(rsa_encrypt(key), "x").zfill(256)
+
+
+def random_key_pair():
+    # The random key must only have letters and digits..
+    key = random_key(16)
+    return key, enc_sec_key_of(key)
+
+
+def seeded_keys(seed, count):
+    """Generate `count` keys from `seed`, the same every time, for who has to know the keys in use."""
+    rng = random.Random(seed)
+    return [bytes(rng.choice(VALID_KEY_SEQ) for _ in range(16)) for _ in range(count)]
+
+
+class KeyPool():
+    """A bounded pool of precomputed (key, encSecKey) pairs to keep RSA out of `encrypt`.
+
+    Pairs are handed out in turn, each for `reuse` times, and the pool is refilled in a background thread once less
+    than half of `size` pairs are left. If it runs dry anyway, a pair is generated on the spot.
+
+    With `keys`, the pool hands out pairs of these keys only, in turn, instead of random ones.
+    """
+
+    def __init__(self, size=64, reuse=1, background=True, keys=None):
+        self.size = size
+        self.reuse = reuse
+        self.background = background
+        self._fixed_pairs = [(key, enc_sec_key_of(key)) for key in keys] if keys else None
+        self._pairs = deque()
+        self._current = None
+        self._uses_left = 0
+        self._lock = threading.Lock()
+        self._refilling = None
+        self.fill()
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def fill(self):
+        """Fill the pool up to `size` pairs synchronously."""
+        if self._fixed_pairs is not None:
+            while len(self._pairs) < self.size:
+                self._pairs.extend(self._fixed_pairs)
+            return
+        while len(self._pairs) < self.size:
+            self._pairs.append(random_key_pair())
+
+    def get(self):
+        """Return a (key, encSecKey) pair."""
+        with self._lock:
+            if self._uses_left <= 0:
+                try:
+                    self._current = self._pairs.popleft()
+                except IndexError:
+                    self._current = random_key_pair() if self._fixed_pairs is None \
+                        else random.choice(self._fixed_pairs)
+                self._uses_left = self.reuse
+            self._uses_left -= 1
+            pair = self._current
+            if len(self._pairs) < self.size // 2:
+                self._refill()
+        return pair
+
+    def _refill(self):
+        if not self.background:
+            self.fill()
+        elif self._refilling is None or not self._refilling.is_alive():
+            self._refilling = threading.Thread(target=self.fill, name="KeyPool refilling", daemon=True)
+            self._refilling.start()
+
+
 def random_key(size=16) -> bytes:
     return bytes(secrets.choice(VALID_KEY_SEQ) for _ in range(size))
 
@@ -47,10 +139,16 @@ def aes_cbc_encrypt(data, key, iv=IV) -> bytes:
     return cipher.encrypt(data)
 
 
+def aes_cbc_decrypt(data, key, iv=IV) -> bytes:
+    cipher = AES.new(key, AES.MODE_CBC, iv=iv)
+    return unpad(cipher.decrypt(data))
+
+
 def rsa_encrypt(data, exponent=EXPONENT, modulus=MODULUS) -> int:
     #data = pad(data, 126)
     data = data[::-1]
-    cipher_data = square_multiply(int(data.hex(), base=16), exponent, modulus)
+    # the built-in `pow` does the same as `square_multiply`, in C
+    cipher_data = pow(int(data.hex(), base=16), exponent, modulus)
     return cipher_data
 
 
@@ -62,6 +160,12 @@ def pad(data_to_pad, block_size):
     return data_to_pad + bytes(to_pad for _ in range(to_pad))
 
 
+def unpad(data):
+    if not data or not 1 <= data[-1] <= 16 or data[-data[-1]:] != bytes([data[-1]]) * data[-1]:
+        raise ValueError("invalid padding")
+    return data[:-data[-1]]
+
+
 def square_multiply(x, e, n):
     bits = []
     while e != 0:
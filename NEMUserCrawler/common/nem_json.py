@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Decode the JSON responses of weapi into only what is crawled from them.
+
+Bodies are decoded as bytes, by orjson if it is installed, which is several times as fast as `json` and builds the
+objects in C, and only the few fields kept are then read into tuples, instead of keeping the whole tree around.
+"""
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:  # `json` takes bytes as well
+    orjson = None
+
+__all__ = ["loads", "JSONDecodeError", "FollowUser", "FollowPage", "follow_page", "first_playlist"]
+
+loads = orjson.loads if orjson is not None else json.loads
+JSONDecodeError = json.JSONDecodeError  # which `orjson.JSONDecodeError` is a subclass of
+
+# `following` and `followers` are the numbers of them, `None` if not given
+FollowUser = namedtuple("FollowUser", ["id", "name", "avatar_url", "description", "following", "followers"])
+# `count` is the number of entries in the page, including those `users` lacks for missing fields;
+# `total` is the total number of users, given when requested with `total`, or `None`
+FollowPage = namedtuple("FollowPage", ["users", "count", "more", "total"])
+
+
+def follow_page(body, key):
+    """Decode a page of `/weapi/user/getfollows` (`key` of "follow") or `/weapi/user/getfolloweds` ("followeds").
+
+    Raise `KeyError` if the page lacks `key` or `more`, and `JSONDecodeError` if it is not JSON.
+    """
+    d = loads(body)
+    entries = d[key]
+    users = []
+    for entry in entries:
+        try:
+            users.append(FollowUser(int(entry['userId']), entry['nickname'], entry['avatarUrl'], entry['signature'],
+                                    entry.get('follows'), entry.get('followeds')))
+        except (KeyError, TypeError, ValueError):
+            continue
+    total = None
+    for total_key in ("total", "size"):
+        if isinstance(d.get(total_key), int):
+            total = d[total_key]
+            break
+    return FollowPage(users, len(entries), d['more'], total)
+
+
+def first_playlist(body):
+    """Decode a page of `/weapi/user/playlist` into the `(id, name)` of the first playlist, which is the favorite
+    one, or `None` if there is none.
+
+    Raise `KeyError` if the page lacks `playlist`, and `JSONDecodeError` if it is not JSON.
+    """
+    playlists = loads(body)['playlist']
+    if not playlists:
+        return None
+    return playlists[0]['id'], playlists[0]['name']
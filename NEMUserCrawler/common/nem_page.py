@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Extract what is crawled from the HTML pages of NEM, i.e. user profiles from `/user/home` and favorite songs from
+`/playlist`.
+
+`scan_*` look for the few bytes needed by plain string search, which is many times faster than building a DOM of the
+whole page, and return `None` for a page not of the expected shape. `select_*` do the same with selectors, for such
+pages. `*_of` try the former and fall back to the latter.
+"""
+import json
+import re
+from html import unescape
+
+try:
+    from parsel import Selector
+except ImportError:  # only needed for `select_*`, i.e. falling back
+    Selector = None
+
+__all__ = ["scan_ld_json", "select_ld_json", "ld_json_of", "user_profile_of",
+           "scan_favorite_songs", "select_favorite_songs", "favorite_songs_of"]
+
+LD_JSON_START = '<script type="application/ld+json">'
+SCRIPT_END = '</script>'
+SONGS_START = '<ul class="f-hide">'
+SONGS_END = '</ul>'
+SONG_ITEM = re.compile(r'<li><a href="/song\?id=(\d+)">(.*?)</a></li>')
+USER_ID = re.compile(r"user/home\?id=(\d+)")
+
+
+def scan_ld_json(html):
+    """Get the object of the `ld+json` script of a `/user/home` page, or `None` if there is no such valid one."""
+    start = html.find(LD_JSON_START)
+    if start < 0:
+        return None
+    start += len(LD_JSON_START)
+    end = html.find(SCRIPT_END, start)
+    if end < 0:
+        return None
+    try:
+        d = json.loads(html[start:end])
+    except ValueError:
+        return None
+    return d if isinstance(d, dict) and '@id' in d else None
+
+
+def select_ld_json(selector):
+    """`scan_ld_json` with `selector`, a `parsel.Selector` or Scrapy response of the page."""
+    for script in selector.css('script[type="application/ld+json"]::text').getall():
+        try:
+            d = json.loads(script)
+        except ValueError:
+            continue
+        if isinstance(d, dict) and '@id' in d:
+            return d
+    return None
+
+
+def ld_json_of(html):
+    d = scan_ld_json(html)
+    if d is None and Selector is not None:
+        d = select_ld_json(Selector(text=html))
+    return d
+
+
+def user_profile_of(d):
+    """Make the fields of `items.UserProfile` but `favorite_songs` from the `ld+json` object `d` of a user page."""
+    match = USER_ID.search(d['@id'])
+    if match is None:
+        raise ValueError("No user ID in {!r}".format(d['@id']))
+    images = d.get('images') or []
+    return {'id': int(match.group(1)),
+            'name': d['title'],
+            'avatar_url': images[0] if images else "",
+            'description': d['description']}
+
+
+def scan_favorite_songs(html):
+    """Get the songs in the `f-hide` list of a `/playlist` page as `(id, name)`s, or `None` if the list is not
+    found or not of the expected shape."""
+    start = html.find(SONGS_START)
+    if start < 0:
+        return None
+    start += len(SONGS_START)
+    end = html.find(SONGS_END, start)
+    if end < 0:
+        return None
+    items = html[start:end]
+    songs = SONG_ITEM.findall(items)
+    if len(songs) != items.count("<li") or any("<" in name for _, name in songs):
+        return None  # items of other markup, which selectors get right
+    return [(int(song_id), unescape(name) if "&" in name else name) for song_id, name in songs]
+
+
+def select_favorite_songs(selector):
+    """`scan_favorite_songs` with `selector`, a `parsel.Selector` or Scrapy response of the page."""
+    songs = []
+    for song in selector.xpath("//ul[@class='f-hide']/li/a"):
+        song_id = song.xpath("@href").re_first(r"id=(\d+)")
+        if song_id is not None:
+            songs.append((int(song_id), song.xpath("string()").get()))
+    return songs
+
+
+def favorite_songs_of(html):
+    songs = scan_favorite_songs(html)
+    if songs is None and Selector is not None:
+        songs = select_favorite_songs(Selector(text=html))
+    return songs
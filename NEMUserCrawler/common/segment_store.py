@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import gzip
+import heapq
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+
+__all__ = ["SegmentStore"]
+
+
+class SegmentStore():
+    """Append-only store of JSON documents in gzipped NDJSON segments, one directory for each collection.
+
+    A document with `_id` updates the fields of the document with the same `_id` written before, like an upsert with
+    `$set` in MongoDB, and the last writer wins. Others are kept as they are. Documents are written by a background
+    thread in batches, and a new segment is started once the current one has `segment_size` bytes of JSON.
+    `compact` merges the segments of a collection into one, sorted by `_id`.
+
+    Segments are merged as sorted runs, k-way, so that reading or compacting a collection holds the documents of at
+    most one segment in memory, instead of all of them.
+    """
+
+    SEGMENT_NAME = "segment-{:06d}.ndjson.gz"
+    SEGMENT_PATTERN = re.compile(r"^segment-(\d{6})\.ndjson\.gz$")
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, compresslevel=6):
+        self.path = path
+        self.segment_size = segment_size
+        self.compresslevel = compresslevel
+        self._files = {}  # collection name -> (segment number, `GzipFile`)
+        self._queue = queue.Queue()
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, name="SegmentStoreWriter", daemon=True)
+        self._writer.start()
+
+    def segments(self, collection_name):
+        """Get the paths of the segments of `collection_name`, oldest first."""
+        directory = os.path.join(self.path, collection_name)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                if self.SEGMENT_PATTERN.match(name)]
+
+    def append(self, collection_name, documents):
+        """Queue `documents`, a list, to be written to `collection_name` by the writer thread."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((collection_name, documents))
+
+    def flush(self):
+        """Wait until all queued documents are written."""
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        if self._error is not None:
+            raise self._error
+
+    def _write_loop(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    for _, file in self._files.values():
+                        file.close()
+                    self._files.clear()
+                    return
+                self._write(*batch)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, collection_name, documents):
+        data = "".join(json.dumps(document, ensure_ascii=False, separators=(",", ":")) + "\n"
+                       for document in documents).encode("utf-8")
+        number, file = self._files.get(collection_name, (None, None))
+        if file is None or file.tell() >= self.segment_size:
+            if file is not None:
+                file.close()
+            number, file = self._open_segment(collection_name, number)
+            self._files[collection_name] = (number, file)
+        file.write(data)
+
+    def _open_segment(self, collection_name, number=None):
+        """Open a new segment to append to, after segment `number` or all existing ones."""
+        if number is None:
+            segments = self.segments(collection_name)
+            number = int(self.SEGMENT_PATTERN.match(os.path.basename(segments[-1])).group(1)) if segments else 0
+        directory = os.path.join(self.path, collection_name)
+        os.makedirs(directory, exist_ok=True)
+        number += 1
+        path = os.path.join(directory, self.SEGMENT_NAME.format(number))
+        return number, gzip.open(path, "ab", compresslevel=self.compresslevel)
+
+    @staticmethod
+    def read_segment(path):
+        with gzip.open(path, "rb") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:  # a line cut by a crash, only possible at the end of a segment
+                    break
+
+    @staticmethod
+    def id_key(_id):
+        """Get the key to sort documents by `_id` with, numbers coming before strings, which come before others."""
+        if isinstance(_id, (int, float)) and not isinstance(_id, bool):
+            return 0, _id, ""
+        if isinstance(_id, str):
+            return 1, 0, _id
+        return 2, 0, json.dumps(_id, sort_keys=True)
+
+    def _sorted_run(self, path, temp_dir):
+        """Yield the documents without `_id` of the segment `path`, and return the path of a run of the others sorted by
+        `_id`, those of the same `_id` merged, which is the segment itself if it is sorted already (as compacted)."""
+        documents = {}
+        in_order = True
+        last_key = None
+        for document in self.read_segment(path):
+            if '_id' not in document:
+                yield document
+                continue
+            key = self.id_key(document['_id'])
+            if in_order and last_key is not None and key <= last_key:
+                in_order = False
+            last_key = key
+            documents.setdefault(key, {}).update(document)
+        if in_order:
+            return path
+        run_path = os.path.join(temp_dir, os.path.basename(path))
+        with gzip.open(run_path, "wb", compresslevel=1) as file:
+            for key in sorted(documents):
+                file.write(json.dumps(documents[key], ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                file.write(b"\n")
+        return run_path
+
+    def _read_run(self, path, index):
+        for document in self.read_segment(path):
+            if '_id' in document:  # others are read by `_sorted_run`
+                yield self.id_key(document['_id']), index, document
+
+    def read(self, collection_name, segments=None):
+        """Iterate over the documents of `collection_name`, those without `_id` first, then the others sorted by `_id`
+        (see `id_key`), with those of the same `_id` merged."""
+        segments = self.segments(collection_name) if segments is None else segments
+        if not segments:
+            return
+        with tempfile.TemporaryDirectory(prefix="merge-", dir=os.path.dirname(segments[0])) as temp_dir:
+            runs = []
+            for index, path in enumerate(segments):
+                run_path = yield from self._sorted_run(path, temp_dir)
+                runs.append(self._read_run(run_path, index))
+            # older runs first among documents of the same `_id`, so that the last writer wins
+            key, document = None, None
+            for next_key, _, next_document in heapq.merge(*runs):
+                if document is not None and next_key == key:
+                    document.update(next_document)
+                    continue
+                if document is not None:
+                    yield document
+                key, document = next_key, next_document
+            if document is not None:
+                yield document
+
+    def compact(self, collection_name):
+        """Merge all closed segments of `collection_name` into the newest of them, and return the number merged.
+
+        Should not be called while documents of `collection_name` are being written.
+        """
+        segments = self.segments(collection_name)
+        current = self._files.get(collection_name)
+        if current is not None:
+            segments = [path for path in segments if path != current[1].name]
+        if len(segments) < 2:
+            return 0
+        temp_path = segments[-1] + ".tmp"
+        with gzip.open(temp_path, "wb", compresslevel=self.compresslevel) as file:
+            for document in self.read(collection_name, segments):
+                file.write(json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        # Replacing the newest first: should it stop halfway, the older segments left are still overridden by it.
+        os.replace(temp_path, segments[-1])
+        for path in segments[:-1]:
+            os.remove(path)
+        return len(segments)
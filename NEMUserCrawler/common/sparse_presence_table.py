@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
+from array import array
+from bisect import bisect_left
 from math import ceil
+import mmap
+import os
 import struct
+import sys
 
-__all__ = ["SparsePresenceTable", "SerializationError"]
+try:
+    import numpy as np
+except ImportError:  # `*_many` methods fall back to per-number calls
+    np = None
+
+__all__ = ["SparsePresenceTable", "MmapSparsePresenceTable", "SerializationError"]
 
 
 class SerializationError(Exception):
@@ -10,94 +20,500 @@ class SerializationError(Exception):
 
 
 class SparsePresenceTable():
-    """Used to record whether numbers in a prescribed range has been present or not by bits in `bytearray`."""
+    """Used to record whether numbers in a prescribed range has been present or not by bits in `bytearray`.
+
+    When `adaptive`, like Roaring bitmaps, a block starts as a sorted `array` of the indexes present in it and is
+    converted to a bitmap only after it has more than `array_threshold` indexes. By default, an array container is
+    converted once it reaches 1/8 of the bitmap size or `ARRAY_THRESHOLD_MAX` indexes, whichever is less.
+    """
+
+    # Below this size, `*_many` methods loop over `nos` in Python, which beats the per-block NumPy overhead.
+    VECTORIZE_THRESHOLD = 512
+    # The array limit of Roaring bitmaps. `present` inserts into a sorted array by moving its tail, which would take
+    # more than a bitmap lookup by an order of magnitude near 1/8 of a block of 10^8 bits (390K indexes).
+    ARRAY_THRESHOLD_MAX = 4096
+    # Bitmaps are checkpointed by pages of this many bytes changed, not whole, see `dump_dirty_to_file`.
+    PAGE_SIZE = 4096
 
-    def __init__(self, length, sparse_prefix_length, prefix_to_preallocate=None):
+    MAGIC = b"SPTB"
+    VERSION = 2
+    DELTA_MAGIC = b"SPTD"
+    VACANT, BITMAP, ARRAY, PAGES = range(4)  # `PAGES` of a bitmap in delta records only
+
+    def __init__(self, length, sparse_prefix_length, prefix_to_preallocate=None, adaptive=True, array_threshold=None):
         self._block_amount = 10 ** sparse_prefix_length
         # in bit
         self._block_effective_size = 10 ** (length - sparse_prefix_length)
         # in byte, possible trivial internal fragmentation counted
         self._block_size = ceil(self._block_effective_size / 8)
         self._table = [None for _ in range(self._block_amount)]
+        # prefix -> pages of the bitmap changed since the last `dump_dirty_to_file`, or `None` for the whole block
+        self._dirty = {}
+        self._adaptive = adaptive
+        self._typecode = next(typecode for typecode in "HIQ"
+                              if 2 ** (array(typecode).itemsize * 8) >= self._block_effective_size)
+        if array_threshold is None:
+            array_threshold = min(self._block_size // array(self._typecode).itemsize // 8, self.ARRAY_THRESHOLD_MAX)
+        self._array_threshold = array_threshold
         if prefix_to_preallocate:
             for prefix in prefix_to_preallocate:
-                self._table[prefix] = bytearray(self._block_size)
+                self._new_block(prefix)
 
     def get_block(self, prefix):
         return self._table[prefix]
 
+    def _new_block(self, prefix):
+        """Allocate a vacant bitmap block and return it."""
+        self._table[prefix] = bytearray(self._block_size)
+        return self._table[prefix]
+
+    def _new_array_block(self, prefix, indexes_in_block=()):
+        """Put a sorted `indexes_in_block` as an array container or, if too many or not adaptive, a bitmap."""
+        if self._adaptive and len(indexes_in_block) <= self._array_threshold:
+            if np is not None and isinstance(indexes_in_block, np.ndarray):
+                indexes_in_block = indexes_in_block.astype(self._typecode).tobytes()
+            self._table[prefix] = array(self._typecode, indexes_in_block)
+            return self._table[prefix]
+        bitmap = self._new_block(prefix)
+        self._set_bits(bitmap, indexes_in_block)
+        return bitmap
+
+    def _set_bits(self, bitmap, indexes_in_block):
+        if np is not None:
+            indexes_in_block = np.asarray(indexes_in_block, dtype=np.int64)
+            buffer, indexes_of_byte, bit_masks = self._bits_of(bitmap, indexes_in_block)
+            np.bitwise_or.at(buffer, indexes_of_byte, bit_masks)
+        else:
+            for index_in_block in indexes_in_block:
+                bitmap[index_in_block >> 3] |= 0b1 << (7 - (index_in_block & 7))
+
     def is_present(self, no):
         block, index_in_block = divmod(no, self._block_effective_size)
-        index_of_byte, index_in_byte = divmod(index_in_block, 8)
-        if self._table[block] is None:
+        table_block = self._table[block]
+        if table_block is None:
             return False
-        return self._table[block][index_of_byte] & (0b1 << (7 - index_in_byte)) > 0
+        if type(table_block) is array:
+            i = bisect_left(table_block, index_in_block)
+            return i < len(table_block) and table_block[i] == index_in_block
+        index_of_byte, index_in_byte = divmod(index_in_block, 8)
+        return table_block[index_of_byte] & (0b1 << (7 - index_in_byte)) > 0
 
     def set_present(self, no):
-        block, index_in_block = divmod(no, self._block_effective_size)
-        index_of_byte, index_in_byte = divmod(index_in_block, 8)
-        if self._table[block] is None:
-            self._table[block] = bytearray(self._block_size)
-        self._table[block][index_of_byte] = self._table[block][index_of_byte] | (
-            0b1 << (7 - index_in_byte))
+        self.present(no)
 
     def present(self, no):
         block, index_in_block = divmod(no, self._block_effective_size)
+        table_block = self._table[block]
+        if table_block is None:
+            if self._adaptive:
+                self._table[block] = array(self._typecode, (index_in_block,))
+                self._dirty[block] = None
+                return False
+            table_block = self._new_block(block)
+        elif type(table_block) is array:
+            i = bisect_left(table_block, index_in_block)
+            if i < len(table_block) and table_block[i] == index_in_block:
+                return True
+            table_block.insert(i, index_in_block)
+            if len(table_block) > self._array_threshold:
+                self._new_array_block(block, table_block)
+                self._dirty[block] = {index // (self.PAGE_SIZE * 8) for index in table_block}
+            else:
+                self._dirty[block] = None
+            return False
         index_of_byte, index_in_byte = divmod(index_in_block, 8)
-        if self._table[block] is None:
-            result = False
-            self._table[block] = bytearray(self._block_size)
-        else:
-            result = self._table[block][index_of_byte] & (
-                0b1 << (7 - index_in_byte)) > 0
-        self._table[block][index_of_byte] = self._table[block][index_of_byte] | (
-            0b1 << (7 - index_in_byte))
+        result = table_block[index_of_byte] & (0b1 << (7 - index_in_byte)) > 0
+        if not result:
+            pages = self._dirty.get(block, False)
+            if pages is False:
+                self._dirty[block] = {index_of_byte // self.PAGE_SIZE}
+            elif pages is not None:
+                pages.add(index_of_byte // self.PAGE_SIZE)
+            table_block[index_of_byte] = table_block[index_of_byte] | (0b1 << (7 - index_in_byte))
         return result
 
+    def _mark_dirty(self, prefix, pages=None):
+        """Mark `pages` of the bitmap at `prefix` as changed, or the whole block if `None` or not a bitmap."""
+        if pages is None or type(self._table[prefix]) is array:
+            self._dirty[prefix] = None
+        elif self._dirty.setdefault(prefix, set()) is not None:
+            self._dirty[prefix].update(pages)
+
     def __contains__(self, item):
         return self.is_present(item)
 
-    def dump_to_file(self, file):
-        def pack_into_file(fmt, *args):
-            temp = struct.pack(fmt, *args)
-            return file.write(temp)
-        pack_into_file("!HL", self._block_amount, self._block_size)
-        byte_count = 0
-        for block in self._table:
-            if block is None:
-                pack_into_file("!?", False)
+    def _group_by_block(self, nos):
+        """Split `nos` into (prefix, positions in `nos`, indexes of bit in the block) for each block involved."""
+        blocks, indexes_in_block = np.divmod(nos, self._block_effective_size)
+        order = np.argsort(blocks, kind="stable")
+        bounds = [0] + (np.flatnonzero(np.diff(blocks[order])) + 1).tolist() + [len(nos)]
+        for start, end in zip(bounds, bounds[1:]):
+            positions = order[start:end]
+            yield int(blocks[positions[0]]), positions, indexes_in_block[positions]
+
+    @staticmethod
+    def _bits_of(block, indexes_in_block):
+        """Return (view of `block`, index of byte, bit mask in byte) for bits at `indexes_in_block`."""
+        buffer = np.frombuffer(block, dtype=np.uint8)
+        bit_masks = np.left_shift(1, 7 - (indexes_in_block & 7)).astype(np.uint8)
+        return buffer, indexes_in_block >> 3, bit_masks
+
+    def _test_block(self, block, indexes_in_block):
+        if type(block) is array:
+            members = np.frombuffer(block, dtype=block.typecode)
+            if len(members) == 0:
+                return np.zeros(len(indexes_in_block), dtype=bool)
+            found = np.searchsorted(members, indexes_in_block)
+            return members[np.minimum(found, len(members) - 1)] == indexes_in_block
+        buffer, indexes_of_byte, bit_masks = self._bits_of(block, indexes_in_block)
+        return buffer[indexes_of_byte] & bit_masks > 0
+
+    def is_present_many(self, nos):
+        """Vectorized `is_present`. Return a boolean array (or a list without NumPy) in the order of `nos`."""
+        if np is None:
+            return [self.is_present(no) for no in nos]
+        if len(nos) < self.VECTORIZE_THRESHOLD:
+            return np.fromiter(map(self.is_present, nos), dtype=bool, count=len(nos))
+        nos = np.asarray(nos, dtype=np.int64).ravel()
+        result = np.zeros(len(nos), dtype=bool)
+        for block, positions, indexes_in_block in self._group_by_block(nos):
+            if self._table[block] is None:
+                continue
+            result[positions] = self._test_block(self._table[block], indexes_in_block)
+        return result
+
+    def present_many(self, nos):
+        """Vectorized `present`.
+
+        The result is the same as calling `present` on `nos` one by one, i.e. repeated numbers count as present
+        since their second occurrence.
+        """
+        if np is None:
+            return [self.present(no) for no in nos]
+        if len(nos) < self.VECTORIZE_THRESHOLD:
+            return np.fromiter(map(self.present, nos), dtype=bool, count=len(nos))
+        nos = np.asarray(nos, dtype=np.int64).ravel()
+        result = np.ones(len(nos), dtype=bool)
+        result[np.unique(nos, return_index=True)[1]] = False
+        for block, positions, indexes_in_block in self._group_by_block(nos):
+            table_block = self._table[block]
+            if table_block is None and self._adaptive:
+                table_block = self._table[block] = array(self._typecode)
+            elif table_block is None:
+                table_block = self._new_block(block)
+            found = self._test_block(table_block, indexes_in_block)
+            result[positions] |= found
+            if found.all():
+                continue
+            if type(table_block) is array:
+                members = np.union1d(np.frombuffer(table_block, dtype=table_block.typecode), indexes_in_block)
+                self._new_array_block(block, members)
+                self._mark_dirty(block, np.unique(members // (self.PAGE_SIZE * 8)).tolist())
             else:
-                pack_into_file("!?", True)
-                byte_count += file.write(block)
-        return byte_count
+                buffer, indexes_of_byte, bit_masks = self._bits_of(table_block, indexes_in_block)
+                np.bitwise_or.at(buffer, indexes_of_byte, bit_masks)
+                self._mark_dirty(block, np.unique(indexes_of_byte[~found] // self.PAGE_SIZE).tolist())
+        return result
 
-    def load_from_file(self, file):
-        def unpack_from_file(fmt):
-            temp = file.read(struct.calcsize(fmt))
-            if len(temp) != struct.calcsize(fmt):
-                raise SerializationError(
-                    "file ended unexpectedly when unpack {}".format(fmt))
-            return struct.unpack(fmt, temp)
-        block_amount, block_size = unpack_from_file("!HL")
+    def _write_block(self, file, block):
+        """Write the kind and content of `block`, return block bytes written."""
+        if block is None:
+            file.write(struct.pack("!B", self.VACANT))
+            return 0
+        elif type(block) is array:
+            file.write(struct.pack("!BBL", self.ARRAY, block.itemsize, len(block)))
+            return file.write(self._array_to_bytes(block))
+        else:
+            file.write(struct.pack("!B", self.BITMAP))
+            return file.write(block)
+
+    @staticmethod
+    def _array_to_bytes(block):
+        if sys.byteorder == "little":  # in network order as others
+            block = array(block.typecode, block)
+            block.byteswap()
+        return block.tobytes()
+
+    @staticmethod
+    def _unpack_from_file(file, fmt):
+        temp = file.read(struct.calcsize(fmt))
+        if len(temp) != struct.calcsize(fmt):
+            raise SerializationError(
+                "file ended unexpectedly when unpack {}".format(fmt))
+        return struct.unpack(fmt, temp)
+
+    def _read_block(self, file, kind, i, pages=False):
+        """Read the content of a block of `kind`, return `None`, a bitmap or an array container, or with `pages`, also
+        `{page: bytes}` of a bitmap."""
+        def read_from_file(size):
+            temp = file.read(size)
+            if len(temp) != size:
+                raise SerializationError("file ended unexpectedly: at block {}/{}, got {}/{} bytes".format(
+                    i + 1,
+                    self._block_amount,
+                    len(temp),
+                    size))
+            return temp
+        if kind == self.VACANT:
+            return None
+        elif kind == self.BITMAP:
+            return read_from_file(self._block_size)
+        elif kind == self.ARRAY:
+            itemsize, length = self._unpack_from_file(file, "!BL")
+            typecode = next(typecode for typecode in "HIQ" if array(typecode).itemsize == itemsize)
+            block = array(typecode, read_from_file(itemsize * length))
+            if sys.byteorder == "little":
+                block.byteswap()
+            return block
+        elif kind == self.PAGES and pages:
+            length, = self._unpack_from_file(file, "!L")
+            block = {}
+            for _ in range(length):
+                page, = self._unpack_from_file(file, "!L")
+                if page * self.PAGE_SIZE >= self._block_size:
+                    raise SerializationError("page {} out of block {}/{}".format(page, i + 1, self._block_amount))
+                block[page] = read_from_file(min(self.PAGE_SIZE, self._block_size - page * self.PAGE_SIZE))
+            return block
+        else:
+            raise SerializationError("unknown kind of block {}/{}: {}".format(i + 1, self._block_amount, kind))
+
+    def _check_shape(self, block_amount, block_size):
         if block_amount != self._block_amount or block_size != self._block_size:
             raise SerializationError("`block_amount` and/or `block_size` mismatch: expect {}/{}, got {}/{}".format(
                 self._block_amount,
                 self._block_size,
                 block_amount,
                 block_size))
+
+    def dump_to_file(self, file):
+        """Dump the table in the format of `VERSION`, which `load_from_file` accepts, and return block bytes written."""
+        file.write(struct.pack("!4sBHL", self.MAGIC, self.VERSION, self._block_amount, self._block_size))
+        byte_count = 0
+        for block in self._table:
+            byte_count += self._write_block(file, block)
+        return byte_count
+
+    def load_from_file(self, file):
+        """Load a table dumped by `dump_to_file`, either in the format of `VERSION` or the legacy unversioned one."""
+        magic, = self._unpack_from_file(file, "!4s")
+        if magic == self.MAGIC:
+            version, block_amount, block_size = self._unpack_from_file(file, "!BHL")
+            if version != self.VERSION:
+                raise SerializationError("unsupported version: {}".format(version))
+        else:
+            # legacy: no magic, `block_amount` and `block_size` comes first, then a bool and a bitmap for each block
+            version = 1
+            block_amount, block_size = struct.unpack("!HL", magic + self._unpack_from_file(file, "!2s")[0])
+        self._check_shape(block_amount, block_size)
         byte_count = 0
         for i in range(block_amount):
-            not_vacant, = unpack_from_file("!?")
-            if not not_vacant:
+            kind, = self._unpack_from_file(file, "!B")
+            if version == 1 and kind:
+                kind = self.BITMAP
+            block = self._read_block(file, kind, i)
+            if block is None:
                 continue
+            elif type(block) is array:
+                self._new_array_block(i, block)
+                byte_count += len(block) * block.itemsize
             else:
-                block = bytearray(file.read(self._block_size))
-                if len(block) != self._block_size:
-                    raise SerializationError("file ended unexpectedly: at block {}/{}, got {}/{} bytes".format(
-                        i + 1,
-                        block_amount,
-                        len(block),
-                        self._block_size))
+                self._new_block(i)[:] = block
                 byte_count += len(block)
-                self._table[i] = bytearray(block)
         return byte_count
+
+    @property
+    def dirty_blocks(self):
+        """Prefixes of blocks changed since the last `dump_dirty_to_file`."""
+        return frozenset(self._dirty)
+
+    def dump_dirty_to_file(self, file):
+        """Append blocks changed since the last call as a delta record, which `load_deltas_from_file` accepts.
+
+        Of bitmaps, only the pages of `PAGE_SIZE` bytes changed are written, so that the cost of a record follows the
+        numbers made present since the last one rather than the size of the table. Return block bytes written. Nothing
+        is written if no block is dirty.
+        """
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = sorted(self._dirty.items()), {}
+        file.write(struct.pack("!4sHLH", self.DELTA_MAGIC, self._block_amount, self._block_size, len(dirty)))
+        byte_count = 0
+        for prefix, pages in dirty:
+            block = self._table[prefix]
+            if pages is None or type(block) is array:
+                file.write(struct.pack("!H", prefix))
+                byte_count += self._write_block(file, block)
+                continue
+            file.write(struct.pack("!HBL", prefix, self.PAGES, len(pages)))
+            for page in sorted(pages):
+                file.write(struct.pack("!L", page))
+                byte_count += file.write(block[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE])
+        return byte_count
+
+    def load_deltas_from_file(self, file):
+        """Merge all delta records in `file` into the table and return the number of records merged.
+
+        As numbers are never removed, records are merged by union and thus may be replayed in any order or more than
+        once. A truncated record at the end of `file`, as left by an interrupted append, is ignored.
+        """
+        count = 0
+        while True:
+            try:
+                header = file.read(struct.calcsize("!4sHLH"))
+                if not header:
+                    break
+                elif len(header) != struct.calcsize("!4sHLH"):
+                    raise SerializationError("file ended unexpectedly when unpack delta header")
+                magic, block_amount, block_size, length = struct.unpack("!4sHLH", header)
+                if magic != self.DELTA_MAGIC:
+                    raise SerializationError("not a delta record: {!r}".format(magic))
+                self._check_shape(block_amount, block_size)
+                blocks = []
+                for _ in range(length):
+                    prefix, kind = self._unpack_from_file(file, "!HB")
+                    blocks.append((prefix, self._read_block(file, kind, prefix, pages=True)))
+            except SerializationError:
+                if file.read(1):
+                    raise
+                break  # truncated tail
+            for prefix, block in blocks:
+                self._merge_block(prefix, block)
+            count += 1
+        return count
+
+    def _merge_block(self, prefix, block):
+        """Union `block`, an array container, a bitmap or `{page: bytes}` of a bitmap, into the block at `prefix`."""
+        current = self._table[prefix]
+        if block is None:
+            return
+        elif type(block) is dict:
+            if current is None:
+                current = self._new_block(prefix)
+            elif type(current) is array:
+                self._new_block(prefix)
+                self._set_bits(self._table[prefix], current)
+                current = self._table[prefix]
+            for page, content in block.items():
+                start = page * self.PAGE_SIZE
+                self._or_into(current, start, content)
+        elif current is None:
+            if type(block) is array:
+                self._new_array_block(prefix, block)
+            else:
+                self._new_block(prefix)[:] = block
+        elif type(block) is array:
+            if type(current) is array:
+                self._new_array_block(prefix, sorted(set(current).union(block)))
+            else:
+                self._set_bits(current, block)
+        else:
+            if type(current) is array:
+                self._new_block(prefix)[:] = block
+                self._set_bits(self._table[prefix], current)
+            else:
+                self._or_into(current, 0, block)
+
+    @staticmethod
+    def _or_into(bitmap, start, content):
+        """Bitwise or `content` into `bitmap` from byte `start`."""
+        end = start + len(content)
+        if np is not None:
+            buffer = np.frombuffer(bitmap, dtype=np.uint8)[start:end]
+            np.bitwise_or(buffer, np.frombuffer(content, dtype=np.uint8), out=buffer)
+        else:
+            bitmap[start:end] = (int.from_bytes(bitmap[start:end], "big") | int.from_bytes(content, "big")).to_bytes(
+                len(content), "big")
+
+
+class MmapSparsePresenceTable(SparsePresenceTable):
+    """`SparsePresenceTable` backed by a memory-mapped file with a fixed block layout.
+
+    Block `i` lives at a fixed offset in the file, so opening a table only maps the file and reads the header,
+    regardless of how many blocks are populated. Pages are faulted in by the OS on first access and bit flips go
+    straight to the page cache. The file is created sparse, vacant blocks take no disk space.
+    """
+    MMAP_MAGIC = b"SPTM"
+    MMAP_VERSION = 1
+    HEADER_FORMAT = "!4sBHL"
+
+    def __init__(self, length, sparse_prefix_length, path, prefix_to_preallocate=None):
+        self._mmap = None
+        self._flags = None
+        self.file_path = path
+        # bitmaps only, as each block has a fixed place in the file
+        super().__init__(length, sparse_prefix_length, adaptive=False)
+        header_size = struct.calcsize(self.HEADER_FORMAT) + self._block_amount
+        self._data_offset = ceil(header_size / mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+        file_size = self._data_offset + self._block_amount * self._block_size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing_size = os.fstat(fd).st_size
+            if existing_size == 0:
+                os.ftruncate(fd, file_size)  # sparse on most filesystems
+                os.pwrite(fd, struct.pack(self.HEADER_FORMAT, self.MMAP_MAGIC, self.MMAP_VERSION,
+                                          self._block_amount, self._block_size), 0)
+            elif existing_size != file_size:
+                raise SerializationError("file size mismatch: expect {}, got {}".format(file_size, existing_size))
+            self._mmap = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+
+        magic, version, block_amount, block_size = struct.unpack_from(self.HEADER_FORMAT, self._mmap)
+        if magic != self.MMAP_MAGIC or version != self.MMAP_VERSION:
+            self.close()
+            raise SerializationError("not a table file of version {}: {!r}".format(self.MMAP_VERSION, path))
+        if block_amount != self._block_amount or block_size != self._block_size:
+            self.close()
+            raise SerializationError("`block_amount` and/or `block_size` mismatch: expect {}/{}, got {}/{}".format(
+                self._block_amount,
+                self._block_size,
+                block_amount,
+                block_size))
+        view = memoryview(self._mmap)
+        self._flags = view[struct.calcsize(self.HEADER_FORMAT):header_size]
+        for prefix in range(self._block_amount):
+            if self._flags[prefix]:
+                self._table[prefix] = self._block_view(prefix)
+        view.release()
+        if prefix_to_preallocate:
+            for prefix in prefix_to_preallocate:
+                if self._table[prefix] is None:
+                    self._new_block(prefix)
+
+    def _block_view(self, prefix):
+        start = self._data_offset + prefix * self._block_size
+        with memoryview(self._mmap) as view:
+            return view[start:start + self._block_size]
+
+    def _new_block(self, prefix):
+        self._table[prefix] = self._block_view(prefix)
+        self._flags[prefix] = 1
+        return self._table[prefix]
+
+    def flush(self):
+        """Write dirty pages back to the file."""
+        if self._mmap is not None:
+            self._mmap.flush()
+        self._dirty.clear()
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self.flush()
+        # all exported views must be released before the map can be closed
+        for i, block in enumerate(self._table):
+            if block is not None:
+                block.release()
+                self._table[i] = None
+        if self._flags is not None:
+            self._flags.release()
+            self._flags = None
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 import unittest
+import unittest.mock
+import json
 import random
 import time
+import os
+import pickle
+import struct
+import tempfile
 from io import BytesIO
 from math import ceil
 
-from sparse_presence_table import SparsePresenceTable
-import nem, nem_crypto
+from sparse_presence_table import SparsePresenceTable, MmapSparsePresenceTable, SerializationError
+from frontier import FrontierRecord
+from fingerprint_table import FingerprintTable, fingerprint_of
+from id_list import pack_ids, unpack_ids
+from segment_store import SegmentStore
+from edge_log import EdgeLog, read_edges, build_csr, FOLLOWING, FOLLOWERS
+import nem, nem_crypto, nem_page, nem_json
 
 
 class NEMAPICryptoTest(unittest.TestCase):
@@ -22,8 +33,52 @@ class NEMAPICryptoTest(unittest.TestCase):
             cipher_data['params'], "7KvkKBOcrvCW43XAV0rLbJHixeL5hnPJ6ndHWAxY4qGvaXk7v3Vt9+VWQr4JDhV3")
         self.assertEqual(cipher_data['encSecKey'], "59ba25f5a3e0b29a9c3580c003565fa128e9e7624c6fbbd47321206ff00d07b1d7d340f773df588fe1dae991642d9fdd8095ca2b04137424a31b4d58eeb7a52e50366da3ce6501f4e3f19a62f77e585927afa0ef8b3c111b3a664bf328b723701fe626f23369aacdc36377bc2a9c7d8e7945ed1db8ceb1c63c9d9a9cf7ae4fcf")
 
+    def test_decrypt_seeded_keys(self):
+        keys = nem_crypto.seeded_keys(7, 4)
+        self.assertEqual(keys, nem_crypto.seeded_keys(7, 4))
+        self.assertNotEqual(keys, nem_crypto.seeded_keys(8, 4))
+        params = {'uid': 123, 'limit': 1000, 'csrf_token': ""}
+        pool = nem_crypto.KeyPool(4, keys=keys)
+        for _ in range(8):
+            cipher_data = nem_crypto.encrypt(params, key_pool=pool)
+            key = dict(zip(map(nem_crypto.enc_sec_key_of, keys), keys))[cipher_data['encSecKey']]
+            self.assertEqual(nem_crypto.decrypt(cipher_data['params'], key), params)
+
+    def test_key_pool(self):
+        for nth_test, (size, reuse) in enumerate([(4, 1), (4, 3), (1, 1)]):
+            with self.subTest(nth_test=nth_test, size=size, reuse=reuse):
+                pool = nem_crypto.KeyPool(size, reuse, background=False)
+                pairs = [pool.get() for _ in range(size * reuse * 3)]
+                for key, enc_sec_key in pairs:
+                    self.assertEqual(enc_sec_key, nem_crypto.enc_sec_key_of(key))
+                    self.assertEqual(nem_crypto.encrypt("{}", key=key),
+                                     nem_crypto.encrypt("{}", key_pool=type("", (), {'get': lambda _: (key, enc_sec_key)})()))
+                self.assertEqual(len(pairs) // reuse, len(set(pairs)))
+                self.assertGreaterEqual(len(pool), size // 2)
+
+    def test_pooled_keys(self):
+        # how fast pooled keys are is measured by `scrapy microbench nem_crypto/*`
+        data = {"userId": "1234567890", "offset": "0", "total": "false", "limit": "100", "csrf_token": ""}
+        for nth_test, reuse in enumerate([1, 16]):
+            with self.subTest(nth_test=nth_test, reuse=reuse):
+                pool = nem_crypto.KeyPool(8, reuse, background=False)
+                pairs = []
+                recording_pool = type("", (), {'get': lambda _: pairs.append(pool.get()) or pairs[-1]})()
+                for _ in range(32):
+                    cipher_data = nem_crypto.encrypt(data, key_pool=recording_pool)
+                    key, enc_sec_key = pairs[-1]
+                    self.assertEqual(cipher_data['encSecKey'], enc_sec_key)
+                    # as `encrypt` did before `KeyPool`
+                    self.assertEqual(enc_sec_key, format(nem_crypto.square_multiply(
+                        int(key[::-1].hex(), 16), nem_crypto.EXPONENT, nem_crypto.MODULUS), "x").zfill(256))
+                    self.assertEqual(nem_crypto.decrypt(cipher_data['params'], key), data)
+                self.assertEqual(len(set(pairs)), 32 // reuse)
+
 
 class SparsePresenceTableTest(unittest.TestCase):
+    def new_table(self, *args):
+        return SparsePresenceTable(*args)
+
     def reset_time(self):
         self.start_time = time.time()
 
@@ -47,7 +102,7 @@ class SparsePresenceTableTest(unittest.TestCase):
             with self.subTest(nth_test=nth_test):
                 preallocated = set(random.randint(0, 99)
                                    for _ in range(random.randint(10, 20)))
-                table = SparsePresenceTable(10, 2, preallocated)
+                table = self.new_table(10, 2, preallocated)
                 self.assertEqual(table._block_amount, 100)
                 self.assertEqual(len(table._table), 100)
 
@@ -63,7 +118,7 @@ class SparsePresenceTableTest(unittest.TestCase):
             with self.subTest(nth_test=nth_test):
 
                 self.reset_time()
-                table = SparsePresenceTable(10, 2)
+                table = self.new_table(10, 2)
                 self.print_duration("create 1 table")
                 self.reset_time()
                 for _ in range(1000):
@@ -76,7 +131,7 @@ class SparsePresenceTableTest(unittest.TestCase):
     def test_present(self):
         for nth_test in range(5):
             with self.subTest(nth_test=nth_test):
-                table = SparsePresenceTable(10, 2)
+                table = self.new_table(10, 2)
                 self.reset_time()
                 nos = list(set(random.randint(0, 10**10 - 1) for _ in range(1000)))
                 for no in nos:
@@ -92,10 +147,39 @@ class SparsePresenceTableTest(unittest.TestCase):
                     "`present` 1000 (hit) + roughly 10000 (miss) times", 1000 + 10000)
         
 
+    def test_present_many(self):
+        for nth_test, page_size in enumerate([100, 100, 10000, 10000]):
+            with self.subTest(nth_test=nth_test, page_size=page_size):
+                table = self.new_table(9, 2, range(100))
+                reference = self.new_table(9, 2, range(100))
+                pages = [[random.randint(0, 10**9 - 1) for _ in range(page_size)]
+                         for _ in range(max(1, 20000 // page_size))]
+                pages.append(pages[0][:50] + pages[0][:50])  # seen and repeated in one page
+                count = sum(map(len, pages))
+
+                self.reset_time()
+                expected = [[reference.present(no) for no in page] for page in pages]
+                duration = self.elapsed_time()
+                self.print_duration("`present` {} pages of {} one by one".format(len(pages), page_size), count)
+
+                self.reset_time()
+                result = [table.present_many(page) for page in pages]
+                self.print_duration("`present_many` {} pages of {}".format(len(pages), page_size), count)
+                print("{}: speedup of `present_many` on pages of {}: {:.2f}x".format(
+                    self.id(), page_size, duration / self.elapsed_time()))
+                self.assertEqual(expected, [list(page) for page in result])
+
+                self.reset_time()
+                result = [table.is_present_many(page) for page in pages]
+                self.print_duration("`is_present_many` {} pages of {}".format(len(pages), page_size), count)
+                self.assertTrue(all(all(page) for page in result))
+                misses = [random.randint(0, 10**9 - 1) for _ in range(page_size)]
+                self.assertEqual([no in reference for no in misses], list(table.is_present_many(misses)))
+
     def test_serilization(self):
         for nth_test in range(5):
             with self.subTest(nth_test=nth_test):
-                table = SparsePresenceTable(8, 2)
+                table = self.new_table(8, 2)
                 present = [random.randint(0, 10**8 - 1) for _ in range(1000)]
                 for no in present:
                     table.set_present(no)
@@ -111,7 +195,426 @@ class SparsePresenceTableTest(unittest.TestCase):
                 self.assertEqual(empty_block_amount, table._table.count(None))
                 for no in present:
                     self.assertIn(no, table)
-            
+
+
+class AdaptiveSparsePresenceTableTest(unittest.TestCase):
+    def test_adaptive_containers(self):
+        for nth_test, batched in enumerate([False, True]):
+            with self.subTest(nth_test=nth_test, batched=batched):
+                table = SparsePresenceTable(8, 2, array_threshold=1000)
+                reference = set()
+                for _ in range(3):
+                    nos = [random.randint(0, 10**6 - 1) for _ in range(600)]  # all in block 0
+                    if batched:
+                        table.present_many(nos + [0] * SparsePresenceTable.VECTORIZE_THRESHOLD)
+                    else:
+                        for no in nos + [0]:
+                            table.set_present(no)
+                    reference.update(nos + [0])
+                    self.assertEqual(type(table.get_block(0)).__name__,
+                                     "array" if len(reference) <= 1000 else "bytearray")
+                    self.assertEqual(sorted(reference), [no for no in range(10**6) if no in table])
+                    file = BytesIO()
+                    table.dump_to_file(file)
+                    file.seek(0)
+                    loaded = SparsePresenceTable(8, 2, array_threshold=1000)
+                    loaded.load_from_file(file)
+                    self.assertEqual(type(table.get_block(0)), type(loaded.get_block(0)))
+                    self.assertTrue(all(loaded.is_present_many(sorted(reference))))
+
+    def test_adaptive_memory(self):
+        table = SparsePresenceTable(10, 2)
+        for _ in range(10000):
+            table.set_present(random.randint(0, 10**10 - 1))
+        memory = sum(len(block) * block.itemsize for block in table._table if block is not None)
+        print("{}: 10000 random numbers take {} bytes, against {} bytes of bitmaps".format(
+            self.id(), memory, 100 * table._block_size))
+        self.assertLess(memory * 10, 100 * table._block_size)
+
+    def test_default_threshold(self):
+        # arrays are kept short for cheap inserts, even though a block of 10^8 bits could hold 390K indexes in 1/8
+        table = SparsePresenceTable(10, 2)
+        nos = [i * 20000 for i in range(SparsePresenceTable.ARRAY_THRESHOLD_MAX)]
+        table.present_many(nos)
+        self.assertEqual(type(table.get_block(0)).__name__, "array")
+        table.present(1)
+        self.assertEqual(type(table.get_block(0)).__name__, "bytearray")
+        self.assertTrue(all(table.is_present_many([1] + nos)))
+
+    def test_legacy_format(self):
+        present = [random.randint(0, 10**8 - 1) for _ in range(1000)]
+        table = SparsePresenceTable(8, 2, adaptive=False)
+        for no in present:
+            table.set_present(no)
+        file = BytesIO()
+        file.write(struct.pack("!HL", table._block_amount, table._block_size))
+        for block in table._table:
+            file.write(struct.pack("!?", block is not None))
+            if block is not None:
+                file.write(block)
+        file.seek(0)
+        table = SparsePresenceTable(8, 2)
+        table.load_from_file(file)
+        for no in present:
+            self.assertIn(no, table)
+
+
+class DeltaSparsePresenceTableTest(unittest.TestCase):
+    def test_deltas(self):
+        for nth_test, adaptive in enumerate([True, False, True]):
+            with self.subTest(nth_test=nth_test, adaptive=adaptive):
+                table = SparsePresenceTable(8, 2, adaptive=adaptive, array_threshold=200)
+                base, log = BytesIO(), BytesIO()
+                present = []
+                for checkpoint in range(5):
+                    if checkpoint == 2:
+                        table.dump_to_file(base)
+                    nos = [random.randint(0, 10**8 - 1) for _ in range(random.randint(1, 2000))]
+                    table.present_many(nos) if checkpoint % 2 else [table.present(no) for no in nos]
+                    present.extend(nos)
+                    self.assertEqual(set(no // 10**6 for no in nos), table.dirty_blocks)
+                    record = BytesIO()
+                    table.dump_dirty_to_file(record)
+                    log.write(record.getvalue())
+                    self.assertFalse(table.dirty_blocks)
+                self.assertEqual(0, table.dump_dirty_to_file(log))
+                # replayed records and a truncated tail are harmless
+                log.write(record.getvalue())
+                log.write(record.getvalue()[:len(record.getvalue()) // 2])
+
+                base.seek(0)
+                log.seek(0)
+                table = SparsePresenceTable(8, 2, adaptive=adaptive, array_threshold=200)
+                table.load_from_file(base)
+                self.assertEqual(6, table.load_deltas_from_file(log))
+                self.assertFalse(table.dirty_blocks)
+                for no in present:
+                    self.assertIn(no, table)
+                misses = [random.randint(0, 10**8 - 1) for _ in range(10000)]
+                self.assertEqual(set(present).intersection(misses),
+                                 set(no for no, seen in zip(misses, table.is_present_many(misses)) if seen))
+
+
+    def test_dirty_pages(self):
+        table = SparsePresenceTable(9, 2, adaptive=False)  # blocks of 1.25 MB
+        present = [random.randint(0, 10**8 - 1) for _ in range(20000)]
+        table.present_many(present)
+        base = BytesIO()
+        table.dump_to_file(base)
+        table.dump_dirty_to_file(BytesIO())
+        nos = [random.randint(0, 10**8 - 1) for _ in range(10)]
+        for no in nos[:5]:
+            table.present(no)
+        table.present_many(nos[5:] + present[:SparsePresenceTable.VECTORIZE_THRESHOLD])
+        record = BytesIO()
+        # only the pages of the new numbers, not the 10 bitmaps they are in
+        self.assertEqual(table.dump_dirty_to_file(record),
+                         len(set((no // 10**7, no % 10**7 // 8 // SparsePresenceTable.PAGE_SIZE) for no in nos))
+                         * SparsePresenceTable.PAGE_SIZE)
+        self.assertLess(len(record.getvalue()), 11 * (SparsePresenceTable.PAGE_SIZE + 16))
+        base.seek(0)
+        record.seek(0)
+        table = SparsePresenceTable(9, 2)
+        table.load_from_file(base)
+        self.assertEqual(1, table.load_deltas_from_file(record))
+        self.assertTrue(all(table.is_present_many(present + nos)))
+
+
+class MmapSparsePresenceTableTest(SparsePresenceTableTest):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "table")
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+        self.temp_dir.cleanup()
+
+    def new_table(self, *args):
+        path = os.path.join(self.temp_dir.name, "table{}".format(len(self.tables)))
+        self.tables.append(MmapSparsePresenceTable(*args[:2], path, *args[2:]))
+        return self.tables[-1]
+
+    def test_reopen(self):
+        for nth_test in range(5):
+            with self.subTest(nth_test=nth_test):
+                os.remove(self.path) if os.path.exists(self.path) else None
+                present = [random.randint(0, 10**8 - 1) for _ in range(1000)]
+                with MmapSparsePresenceTable(8, 2, self.path) as table:
+                    for no in present:
+                        table.set_present(no)
+                    empty_block_amount = table._table.count(None)
+                self.reset_time()
+                with MmapSparsePresenceTable(8, 2, self.path) as table:
+                    self.print_duration("reopen 1 table")
+                    self.assertEqual(empty_block_amount, table._table.count(None))
+                    for no in present:
+                        self.assertIn(no, table)
+
+    def test_load_from_file(self):
+        table = SparsePresenceTable(8, 2)
+        present = [random.randint(0, 10**8 - 1) for _ in range(1000)]
+        for no in present:
+            table.set_present(no)
+        file = BytesIO()
+        table.dump_to_file(file)
+        file.seek(0)
+        with MmapSparsePresenceTable(8, 2, self.path) as table:
+            table.load_from_file(file)
+        with MmapSparsePresenceTable(8, 2, self.path) as table:
+            for no in present:
+                self.assertIn(no, table)
+
+    def test_mismatch(self):
+        MmapSparsePresenceTable(8, 2, self.path).close()
+        with self.assertRaises(SerializationError):
+            MmapSparsePresenceTable(8, 3, self.path)
+
+
+class FrontierRecordTest(unittest.TestCase):
+    def test_pack(self):
+        for kind in range(4):
+            record = FrontierRecord(random.randint(0, 10**10 - 1), kind, random.randint(0, 10**10),
+                                    random.randint(0, 1000), random.randint(-100, 100), random.randint(0, 1000),
+                                    random.randint(0, 10**6), random.randint(0, 10**6))
+            packed = record.pack()
+            self.assertTrue(FrontierRecord.is_packed(packed))
+            self.assertEqual(record, FrontierRecord.unpack(packed))
+        self.assertFalse(FrontierRecord.is_packed(b"X" + packed[1:]))
+        self.assertFalse(FrontierRecord.is_packed(pickle.dumps({}, protocol=4)))
+
+
+class FingerprintTableTest(unittest.TestCase):
+    def test_update(self):
+        table = FingerprintTable(8)
+        expected = {}
+        for _ in range(20000):
+            key, fingerprint = random.randint(0, 10**10), random.getrandbits(64)
+            self.assertEqual(table.update(key, fingerprint), expected.get(key) != fingerprint)
+            expected[key] = fingerprint
+        self.assertEqual(len(table), len(expected))
+        self.assertEqual(dict(table.items()), expected)
+        for key in expected:
+            self.assertIn(key, table)
+        self.assertNotIn(10**10 + 1, table)
+        self.assertIsNone(table.get(10**10 + 1))
+        key = next(iter(expected))
+        self.assertFalse(table.update(key, expected[key]))
+
+    def test_serialization(self):
+        table = FingerprintTable()
+        for _ in range(5000):
+            table[random.randint(0, 10**10)] = random.getrandbits(64)
+        file = BytesIO()
+        table.dump_to_file(file)
+        file.seek(0)
+        loaded = FingerprintTable()
+        loaded.load_from_file(file)
+        self.assertEqual(dict(loaded.items()), dict(table.items()))
+        self.assertEqual(len(loaded), len(table))
+        with self.assertRaises(SerializationError):
+            loaded.load_from_file(BytesIO(file.getvalue()[:-1]))
+
+    def test_fingerprint_of(self):
+        self.assertEqual(fingerprint_of({'name': "歌", 'id': 1}), fingerprint_of({'id': 1, 'name': "歌"}))
+        self.assertNotEqual(fingerprint_of({'id': 1, 'name': "歌"}), fingerprint_of({'id': 1, 'name': "曲"}))
+        self.assertLess(fingerprint_of({}), 2 ** 64)
+
+
+class IDListTest(unittest.TestCase):
+    def test_pack(self):
+        cases = [[], [0], [1, 1, 1], [2 ** 63 - 1, -2 ** 63, 0, -1],
+                 [random.randint(1, 2 * 10**9) for _ in range(5000)]]
+        for ids in cases:
+            self.assertEqual(unpack_ids(pack_ids(ids)), ids)
+        with self.assertRaises(ValueError):
+            unpack_ids(pack_ids([2 ** 40])[:-1])
+
+    def test_size(self):
+        import bson
+        ids = sorted(random.sample(range(10**6, 5 * 10**8), 1000))
+        packed, array = len(pack_ids(ids)), len(bson.encode({'favorite_songs': ids}))
+        print("{}: bytes for 1000 IDs: {} as an array, {} packed".format(self.id(), array, packed))
+        self.assertLess(packed * 2, array)
+
+
+class SegmentStoreTest(unittest.TestCase):
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            expected = {}
+            for run in range(2):
+                store = SegmentStore(path, segment_size=4096)
+                for _ in range(50):
+                    documents = [{'_id': random.randint(0, 200), random.choice("ab"): random.random()}
+                                 for _ in range(20)]
+                    for document in documents:
+                        expected.setdefault(document['_id'], {}).update(document)
+                    store.append("c", documents)
+                store.append("c", [{'x': run}])
+                store.flush()
+                self.assertGreater(len(store.segments("c")), 2)
+                store.close()
+            compacted = store.compact("c")
+            self.assertGreater(compacted, 2)
+            self.assertEqual(len(store.segments("c")), 1)
+            documents = list(store.read("c"))
+            self.assertEqual(sorted(d['x'] for d in documents if '_id' not in d), [0, 1])
+            self.assertEqual({d['_id']: d for d in documents if '_id' in d}, expected)
+            self.assertEqual([d['_id'] for d in documents if '_id' in d], sorted(expected))
+
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = SegmentStore(path, segment_size=1)  # a segment for each batch
+            store.append("c", [{'_id': "b", 'v': 1}, {'_id': 3, 'v': 1}, {'_id': [1], 'v': 1}, {'_id': 1.5, 'v': 1}])
+            store.append("c", [{'_id': 3, 'v': 2, 'w': 2}, {'_id': "a"}, {'_id': 3, 'v': 3}, {'v': 0}])
+            store.append("c", [{'_id': 0}, {'_id': "b", 'w': 3}])
+            store.close()
+            segments = store.segments("c")
+            self.assertEqual(len(segments), 3)
+            self.assertEqual(list(store.read("c")), [
+                {'v': 0}, {'_id': 0}, {'_id': 1.5, 'v': 1}, {'_id': 3, 'v': 3, 'w': 2}, {'_id': "a"},
+                {'_id': "b", 'v': 1, 'w': 3}, {'_id': [1], 'v': 1}])
+            store.compact("c")
+            # compacted segments are runs already
+            with tempfile.TemporaryDirectory() as temp_dir:
+                run = store._sorted_run(segments[-1], temp_dir)
+                self.assertEqual(next(run), {'v': 0})
+                with self.assertRaises(StopIteration) as returned:
+                    next(run)
+                self.assertEqual(returned.exception.value, segments[-1])
+                self.assertEqual(os.listdir(temp_dir), [])
+
+
+class EdgeLogTest(unittest.TestCase):
+    def test_log(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "edges")
+            log = EdgeLog(path)
+            log.append_follows(1, "following", [2, 3])
+            log.append_follows(1, "followers", [10**10])
+            log.close()
+            with open(path, "ab") as file:
+                file.write(b"\0" * 5)  # cut by a crash
+            log = EdgeLog(path)
+            log.append([(2, 1, FOLLOWING)])
+            log.close()
+            edges = read_edges(path)
+            self.assertEqual([tuple(edge) for edge in edges.tolist()],
+                             [(1, 2, FOLLOWING), (1, 3, FOLLOWING), (10**10, 1, FOLLOWERS), (2, 1, FOLLOWING)])
+
+    def test_build_csr(self):
+        pairs = [(random.randint(1, 50) * 10**8, random.randint(1, 50) * 10**8) for _ in range(2000)]
+        src, dst = zip(*pairs)
+        node_ids, indptr, indices = build_csr(src, dst)
+        adjacency = {}
+        for i, node_id in enumerate(node_ids.tolist()):
+            followed = [node_ids[j] for j in indices[indptr[i]:indptr[i + 1]]]
+            self.assertEqual(followed, sorted(set(followed)))
+            if followed:
+                adjacency[node_id] = set(followed)
+        expected = {}
+        for a, b in pairs:
+            expected.setdefault(a, set()).add(b)
+        self.assertEqual(adjacency, expected)
+
+
+class NEMPageTest(unittest.TestCase):
+    USER_PAGE = ('<html><head><script type="text/javascript">var a = "</div>";</script>'
+                 '<script type="application/ld+json">{"@context": "https://ziyuan.baidu.com/contexts/cambrian.jsonld", '
+                 '"@id": "http://music.163.com/user/home?id=12345678", "title": "名字 & co", '
+                 '"images": ["http://p1.music.126.net/a.jpg"], "description": "签名"}</script></head>'
+                 '<body><div class="nav">' + '<a href="/discover">x</a>' * 1000 + '</div></body></html>')
+    PLAYLIST_PAGE = ('<html><body><div>' + '<p>x</p>' * 1000 + '</div><ul class="f-hide">'
+                     '<li><a href="/song?id=1">A &amp; B</a></li><li><a href="/song?id=22">歌</a></li>'
+                     '<li><a href="/song?id=333">&lt;3</a></li></ul><ul><li>other</li></ul></body></html>')
+    PROFILE = {'id': 12345678, 'name': "名字 & co", 'avatar_url': "http://p1.music.126.net/a.jpg",
+               'description': "签名"}
+    SONGS = [(1, "A & B"), (22, "歌"), (333, "<3")]
+
+    def test_user_page(self):
+        d = nem_page.scan_ld_json(self.USER_PAGE)
+        self.assertEqual(nem_page.user_profile_of(d), self.PROFILE)
+        self.assertEqual(nem_page.select_ld_json(nem_page.Selector(text=self.USER_PAGE)), d)
+        for page in ["<html></html>", self.USER_PAGE.replace("</script></head>", ""),
+                     self.USER_PAGE.replace('"@id"', '"id"')]:
+            self.assertIsNone(nem_page.scan_ld_json(page))
+            self.assertIsNone(nem_page.ld_json_of(page))
+
+    def test_user_page_fallback(self):
+        page = self.USER_PAGE.replace('type="application/ld+json"', 'id="ld" type="application/ld+json"')
+        self.assertIsNone(nem_page.scan_ld_json(page))
+        self.assertEqual(nem_page.user_profile_of(nem_page.ld_json_of(page)), self.PROFILE)
+
+    def test_favorite_songs(self):
+        self.assertEqual(nem_page.scan_favorite_songs(self.PLAYLIST_PAGE), self.SONGS)
+        self.assertEqual(nem_page.select_favorite_songs(nem_page.Selector(text=self.PLAYLIST_PAGE)), self.SONGS)
+        empty = self.PLAYLIST_PAGE[:self.PLAYLIST_PAGE.index('<li><a href="/song')] + "</ul></body></html>"
+        self.assertEqual(nem_page.scan_favorite_songs(empty), [])
+        self.assertIsNone(nem_page.scan_favorite_songs("<html></html>"))
+        self.assertEqual(nem_page.favorite_songs_of("<html></html>"), [])
+
+    def test_favorite_songs_fallback(self):
+        for page in [self.PLAYLIST_PAGE.replace('<li><a href="/song?id=22">', '<li class="x"><a href="/song?id=22">'),
+                     self.PLAYLIST_PAGE.replace('A &amp; B', '<b>A &amp; B</b>'),
+                     self.PLAYLIST_PAGE.replace('<ul class="f-hide">', '<ul class="f-hide" >')]:
+            with self.subTest(page=page[-300:]):
+                self.assertIsNone(nem_page.scan_favorite_songs(page))
+                self.assertEqual(nem_page.favorite_songs_of(page), self.SONGS)
+
+    def test_scan_throughput(self):
+        page = self.PLAYLIST_PAGE.replace('<ul class="f-hide">', '<ul class="f-hide">' + "".join(
+            '<li><a href="/song?id={0}">song {0}</a></li>'.format(i) for i in range(1000, 1200)))
+        rates = {}
+        for name, extract in [("selectors", lambda: nem_page.select_favorite_songs(nem_page.Selector(text=page))),
+                              ("scanning", lambda: nem_page.scan_favorite_songs(page))]:
+            start_time = time.time()
+            for _ in range(50):
+                extract()
+            rates[name] = 50 / (time.time() - start_time)
+            print("{}: favorite songs by {}: {:.0f} pages per sec".format(self.id(), name, rates[name]))
+        self.assertGreater(rates["scanning"], rates["selectors"])
+
+
+class NEMJSONTest(unittest.TestCase):
+    def follow_body(self, entries, **extra):
+        d = {'followeds': entries, 'more': True, 'code': 200, 'touchCount': 3}
+        d.update(extra)
+        return json.dumps(d, ensure_ascii=False).encode("utf-8")
+
+    def entry(self, user_id, **extra):
+        d = {'userId': user_id, 'nickname': "名字{}".format(user_id), 'avatarUrl': "a", 'signature': "s",
+             'follows': 1, 'followeds': 2, 'vipRights': {'associator': {'vipCode': 100}}, 'experts': {}}
+        d.update(extra)
+        return d
+
+    def backends(self):
+        for loads in [json.loads] + ([nem_json.orjson.loads] if nem_json.orjson is not None else []):
+            with self.subTest(loads=loads), unittest.mock.patch.object(nem_json, "loads", loads):
+                yield
+
+    def test_follow_page(self):
+        for _ in self.backends():
+            body = self.follow_body([self.entry(1), self.entry(2, follows=None), {'userId': 3}], total=10)
+            page = nem_json.follow_page(body, "followeds")
+            self.assertEqual(page.users, [(1, "名字1", "a", "s", 1, 2), (2, "名字2", "a", "s", None, 2)])
+            self.assertEqual((page.count, page.more, page.total), (3, True, 10))
+            self.assertEqual(nem_json.follow_page(self.follow_body([], more=False, size=0), "followeds"),
+                             ([], 0, False, 0))
+            self.assertIsNone(nem_json.follow_page(self.follow_body([]), "followeds").total)
+            self.assertRaises(KeyError, nem_json.follow_page, self.follow_body([]), "follow")
+            self.assertRaises(nem_json.JSONDecodeError, nem_json.follow_page, b'{"followeds": [', "followeds")
+
+    def test_first_playlist(self):
+        for _ in self.backends():
+            body = json.dumps({'playlist': [{'id': 7, 'name': "喜欢的音乐", 'creator': {}}, {'id': 8, 'name': "x"}],
+                               'more': False}).encode("utf-8")
+            self.assertEqual(nem_json.first_playlist(body), (7, "喜欢的音乐"))
+            self.assertIsNone(nem_json.first_playlist(b'{"playlist": [], "code": 200}'))
+            self.assertRaises(KeyError, nem_json.first_playlist, b'{"code": 404}')
+            self.assertRaises(nem_json.JSONDecodeError, nem_json.first_playlist, b"<html>")
+
+
 class test_nem(unittest.TestCase):
     def test_is_weapi(self):
         cases = [("http://music.163.com/weapi", True),
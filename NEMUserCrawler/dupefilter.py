@@ -3,31 +3,85 @@ import logging
 import os
 from shutil import move as fmove
 
+from twisted.internet import task, threads
+
 from scrapy.dupefilters import BaseDupeFilter
 from scrapy.utils.job import job_dir
 
-from .common.sparse_presence_table import SparsePresenceTable, SerializationError
+from .common.sparse_presence_table import SparsePresenceTable, MmapSparsePresenceTable, SerializationError
 from .items import UserProfile
 
 
 class NemUserIDFilter(BaseDupeFilter):
-    def __init__(self, path=None, debug=False):
+    def __init__(self, path=None, debug=False, use_mmap=False,
+                 checkpoint_interval=0, checkpoint_ids=0, compact_size=0):
         self.file_path = None
         self.fingerprints = set()
         self.logdupes = True
         self.debug = debug
+        self.stats = None  # of the crawler, to count users crawled for the first time in
+        self.use_mmap = bool(path) and use_mmap
+        # Users found on follow pages in this run, whose requests are queued if not crawled yet. Not persisted: after a
+        # resume, users still queued may be found and requested once more.
+        self.found_user_ids = SparsePresenceTable(10, 2)
         self.logger = logging.getLogger(__name__)
-        self.crawled_user_ids = SparsePresenceTable(10, 2)
         if path:
             self.file_path = os.path.join(path, 'crawled_user_ids')
-            if os.path.exists(self.file_path):
+        if self.use_mmap:
+            # The table lives in the mapped file, so there is nothing to load or dump as a whole.
+            mmap_path = self.file_path + ".mmap"
+            migrate = not os.path.exists(mmap_path) and os.path.exists(self.file_path)
+            self.crawled_user_ids = MmapSparsePresenceTable(10, 2, mmap_path)
+            if migrate:
+                self.logger.info("Migrating %s to memory-mapped %s", self.file_path, mmap_path)
                 with open(self.file_path, 'rb') as file:
                     self.crawled_user_ids.load_from_file(file)
+                self.crawled_user_ids.flush()
+                fmove(self.file_path, self.file_path + ".old")
+        else:
+            self.crawled_user_ids = SparsePresenceTable(10, 2)
+            if self.file_path and os.path.exists(self.file_path):
+                with open(self.file_path, 'rb') as file:
+                    self.crawled_user_ids.load_from_file(file)
+
+        # Checkpoints: pages changed since the last checkpoint are appended to `delta_path`, which is folded into
+        # `file_path` by a compaction in a thread once it grows over `compact_size` bytes.
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_ids = checkpoint_ids
+        self.compact_size = compact_size
+        self.new_id_count = 0
+        self.checkpoint_loop = None
+        self.compacting = None
+        if self.file_path and not self.use_mmap:
+            self.delta_path = self.file_path + ".delta"
+            self.compacting_path = self.delta_path + ".compacting"
+            replayed = False
+            for path in (self.compacting_path, self.delta_path):
+                if os.path.exists(path):
+                    with open(path, 'rb') as file:
+                        count = self.crawled_user_ids.load_deltas_from_file(file)
+                    self.logger.info("Replayed %d checkpoints from %s", count, path)
+                    replayed = True
+            if replayed:
+                # fold them into the base file right away, so that no compaction is left half-done
+                self._compact(self.compacting_path, self.delta_path)
 
     @classmethod
     def from_settings(cls, settings):
         debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(job_dir(settings), debug)
+        use_mmap = settings.getbool('DUPEFILTER_MMAP')
+        return cls(job_dir(settings), debug, use_mmap,
+                   checkpoint_interval=settings.getfloat('DUPEFILTER_CHECKPOINT_INTERVAL'),
+                   checkpoint_ids=settings.getint('DUPEFILTER_CHECKPOINT_IDS'),
+                   compact_size=settings.getint('DUPEFILTER_CHECKPOINT_COMPACT_SIZE'))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        dupefilter = cls.from_settings(crawler.settings)
+        dupefilter.stats = crawler.stats
+        # for `UserSpider.user_id_filter` to skip users crawled before building their requests
+        crawler.user_id_filter = dupefilter
+        return dupefilter
 
     @staticmethod
     def extract_user_id(request):
@@ -51,16 +105,86 @@ class NemUserIDFilter(BaseDupeFilter):
         if request.meta.get('do_not_filter', False):
             return False
         elif request.meta.get('as_present', False):
-            return self.crawled_user_ids.present(user_id)
+            seen = self.crawled_user_ids.present(user_id)
+            if not seen:
+                if self.stats is not None:
+                    # once per user, unlike users not seen yet on follow pages, found on many before being crawled
+                    self.stats.inc_value('user/follow/new')
+                if self.checkpoint_ids:
+                    self.new_id_count += 1
+                    if self.new_id_count >= self.checkpoint_ids:
+                        self.checkpoint()
+            return seen
         else:
             return self.crawled_user_ids.is_present(user_id)
 
+    def users_seen(self, user_ids):
+        """Tell whether each of `user_ids` has been crawled, in one batch. Nothing is marked as present."""
+        return self.crawled_user_ids.is_present_many([int(user_id) for user_id in user_ids])
+
+    def users_found(self, user_ids):
+        """Tell whether each of `user_ids` has been crawled or found before in this run, marking them all found."""
+        user_ids = [int(user_id) for user_id in user_ids]
+        found = self.found_user_ids.present_many(user_ids)
+        seen = self.crawled_user_ids.is_present_many(user_ids)
+        return [bool(f or s) for f, s in zip(found, seen)]
+
+    def open(self):
+        if self.file_path and self.checkpoint_interval:
+            self.checkpoint_loop = task.LoopingCall(self.checkpoint)
+            self.checkpoint_loop.start(self.checkpoint_interval, now=False)
+
+    def checkpoint(self):
+        """Persist IDs crawled since the last checkpoint, in time proportional to the pages of the table changed."""
+        self.new_id_count = 0
+        if self.use_mmap:
+            self.crawled_user_ids.flush()
+            return
+        elif not self.file_path:
+            return
+        with open(self.delta_path, "ab") as file:
+            byte_count = self.crawled_user_ids.dump_dirty_to_file(file)
+            file.flush()
+            os.fsync(file.fileno())
+        self.logger.debug("Checkpointed %d bytes of crawled user IDs", byte_count)
+        if (self.compact_size and self.compacting is None and not os.path.exists(self.compacting_path)
+                and os.path.getsize(self.delta_path) >= self.compact_size):
+            # Checkpoints from now on go to a new delta file, while the table (a superset of the old one) is
+            # dumped in a thread. Bits set meanwhile are dirty and land in the new delta file.
+            os.rename(self.delta_path, self.compacting_path)
+            self.compacting = threads.deferToThread(self._compact, self.compacting_path)
+            self.compacting.addErrback(lambda failure: self.logger.error(
+                "Failed to compact crawled user IDs: %s", failure.getErrorMessage()))
+            self.compacting.addBoth(lambda _: setattr(self, 'compacting', None))
+
+    def _compact(self, *delta_paths):
+        """Dump the whole table to `file_path` atomically and remove `delta_paths` it covers."""
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            self.crawled_user_ids.dump_to_file(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.file_path)
+        for path in delta_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
     def close(self, reason):
-        if self.file_path:
+        if self.checkpoint_loop is not None and self.checkpoint_loop.running:
+            self.checkpoint_loop.stop()
+        if self.compacting is not None:
+            self.compacting.addBoth(lambda _: self.close(reason))
+            return self.compacting
+        if self.use_mmap:
+            self.crawled_user_ids.close()
+        elif self.file_path:
             if os.path.exists(self.file_path):
                 fmove(self.file_path, self.file_path + ".old")
             with open(self.file_path, "wb") as file:
                 self.crawled_user_ids.dump_to_file(file)
+            for path in (self.compacting_path, self.delta_path):
+                if os.path.exists(path):
+                    os.remove(path)
 
     def log(self, request, spider):
         user_id = request.meta.get('filter_user_id') or self.extract_user_id(request)
@@ -68,7 +192,7 @@ class NemUserIDFilter(BaseDupeFilter):
         if user_profile is None:
             user_name = "UNKNOWN"
         else:
-            user_name = user_profile['name']
+            user_name = user_profile.get('name', "UNKNOWN")
         if self.debug:
             msg = "Skipped request associated with user: %(user_name)s(%(user_id)s)"
             self.logger.debug(msg, {'user_name': user_name, 'user_id': user_id},
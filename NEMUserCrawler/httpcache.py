@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Make `HttpCacheMiddleware` work with weapi requests, whose bodies are encrypted with a random key every time."""
+import hashlib
+import json
+from time import time
+from urllib.parse import urlsplit
+
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.utils.request import RequestFingerprinter
+
+from .common import nem
+
+
+class WeAPIRequestFingerprinter(RequestFingerprinter):
+    """Fingerprint weapi requests by their path and plaintext parameters in `meta['weapi_params']`, others as usual.
+
+    Requests with `NEM_DEFER_WEAPI_ENCRYPTION` carry the parameters, while those encrypted when built cannot be
+    decrypted and are fingerprinted as usual, i.e. never twice the same.
+    """
+
+    def fingerprint(self, request):
+        params = request.meta.get('weapi_params')
+        if params is None or not nem.is_weapi(request.url):
+            return super().fingerprint(request)
+        params = {key: value for key, value in params.items() if key != "csrf_token"}
+        data = json.dumps([request.method, urlsplit(request.url).path, params], sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).digest()
+
+
+class EndpointTTLCacheStorage(FilesystemCacheStorage):
+    """`FilesystemCacheStorage` with the expiration time by endpoint, for what changes faster than the others.
+
+    `HTTPCACHE_ENDPOINT_TTLS` maps URL path prefixes to seconds, where the longest matching one applies and 0 means
+    never expiring. Responses of other paths expire after `HTTPCACHE_EXPIRATION_SECS`.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        ttls = settings.getdict('HTTPCACHE_ENDPOINT_TTLS')
+        self.ttls = sorted(ttls.items(), key=lambda item: len(item[0]), reverse=True)
+        # expired in `retrieve_response` instead, by endpoint
+        self.default_ttl, self.expiration_secs = self.expiration_secs, 0
+
+    def ttl_of(self, url):
+        path = urlsplit(url).path
+        for prefix, ttl in self.ttls:
+            if path.startswith(prefix):
+                return ttl
+        return self.default_ttl
+
+    def retrieve_response(self, spider, request):
+        response = super().retrieve_response(spider, request)
+        if response is None:
+            return None  # not cached
+        ttl = self.ttl_of(request.url)
+        stored = request.meta.get('cache_timestamp')
+        if 0 < ttl and stored is not None and ttl < time() - stored:
+            del request.meta['cache_timestamp']
+            return None  # expired
+        return response
@@ -13,6 +13,7 @@ class MongoItem(scrapy.Item):
 
 class UserProfile(MongoItem):
     collection_name = "users"
+    packed_fields = ("favorite_songs",)  # with `MONGO_PACK_IDS`
 
     id = scrapy.Field()
     name = scrapy.Field()
@@ -22,6 +23,16 @@ class UserProfile(MongoItem):
 
 class Song(MongoItem):
     collection_name = "songs"
+    write_once = True
 
     id = scrapy.Field()
-    name = scrapy.Field()
\ No newline at end of file
+    name = scrapy.Field()
+
+class ItemBatch(scrapy.Item):
+    """Fields of many items of `item_class` yielded as one item, to be written as a whole."""
+    item_class = None
+
+    items = scrapy.Field()
+
+class SongBatch(ItemBatch):
+    item_class = Song
@@ -5,8 +5,12 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+from urllib.parse import urlencode
+
 from scrapy import signals
 
+from .common import nem
+
 
 class NemusercrawlerSpiderMiddleware(object):
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +105,19 @@ class NemusercrawlerDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class WeAPIEncryptionMiddleware(object):
+    """Encrypt the plaintext parameters of weapi requests queued in `meta['weapi_params']` right before downloading.
+
+    Requests are then queued without the encrypted body, and no encryption is spent on those that are filtered or
+    dropped before being downloaded. The `KeyPool` of the spider is used if it has one.
+    """
+
+    def process_request(self, request, spider):
+        params = request.meta.get('weapi_params')
+        if params is None or request.body or not nem.is_weapi(request.url):
+            return None
+        # Set in place: a replaced request returned from here would be rescheduled (and go through the dupefilter)
+        request._set_body(urlencode(nem.encrypt(params, key_pool=getattr(spider, 'key_pool', None))))
+        return None
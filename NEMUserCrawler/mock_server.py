@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""A local stand-in for the NEM endpoints that `UserSpider` and `user_fetcher_server` use, over a synthetic graph.
+
+It serves as an HTTP proxy too, since requests are for absolute URLs of `common.nem.BASE_URL`. Weapi requests are
+decrypted with keys of `common.nem.seeded_keys`, which clients have to use (as `scrapy mockbench` does).
+
+    python -m NEMUserCrawler.mock_server --port 8163 --users 100000 --key-seed 0
+"""
+import argparse
+import asyncio
+import html
+import json
+import random
+from bisect import bisect_right
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+from .common.nem_crypto import decrypt, enc_sec_key_of, seeded_keys
+
+USER_ID_BASE = 100000000
+PLAYLIST_ID_BASE = 2000000000
+SONG_ID_BASE = 400000000
+
+
+class SyntheticGraph():
+    """`users` users following others, with numbers of following drawn from a Pareto distribution of `alpha` and a
+    mean of about `mean_degree`, and the users followed skewed towards low indexes by `skew`, to have popular users.
+
+    Profiles and favorite songs are generated from `seed` and the index of each user when asked for, so only the edges
+    are kept in memory.
+    """
+
+    def __init__(self, users=10000, mean_degree=20, alpha=2.0, skew=2.0, songs=100000, mean_favorites=50, seed=0):
+        self.users = users
+        self.songs = songs
+        self.mean_favorites = mean_favorites
+        self.seed = seed
+        rng = random.Random(seed)
+        scale = mean_degree * (alpha - 1) / alpha
+        self.following = []
+        followers = [[] for _ in range(users)]
+        for u in range(users):
+            degree = min(int(scale * rng.paretovariate(alpha)), users - 1)
+            followed = sorted({int(users * rng.random() ** skew) for _ in range(degree)} - {u})
+            self.following.append(followed)
+            for v in followed:
+                followers[v].append(u)
+        self.followers = followers
+
+    def index_of(self, user_id):
+        index = int(user_id) - USER_ID_BASE
+        return index if 0 <= index < self.users else None
+
+    def profile(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        return {'userId': USER_ID_BASE + index,
+                'nickname': "user{}".format(index),
+                'avatarUrl': "http://p1.music.126.net/{:x}/{}.jpg".format(rng.getrandbits(64), index),
+                'signature': "signature of user {}".format(index) if rng.random() < 0.7 else "",
+                'follows': len(self.following[index]),
+                'followeds': len(self.followers[index])}
+
+    def favorite_songs(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        count = min(int(self.mean_favorites / 2 * rng.paretovariate(2.0)), self.songs)
+        return [SONG_ID_BASE + int(self.songs * rng.random() ** 2) for _ in range(count)]
+
+
+class MockNEMServer():
+    def __init__(self, graph, keys, latency=0.0, error_rate=0.0, page_limit_max=100, seed=0):
+        self.graph = graph
+        self.keys = {enc_sec_key_of(key): key for key in keys}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_limit_max = page_limit_max
+        self.rng = random.Random(seed)
+        self.request_count = 0
+
+    def application(self):
+        app = web.Application(middlewares=[self.faults])
+        app.add_routes([web.get('/discover', self.discover),
+                        web.get('/user/home', self.user_home),
+                        web.get('/playlist', self.playlist),
+                        web.post('/weapi/user/playlist', self.user_playlist),
+                        web.post('/weapi/user/getfollows/{user_id}', self.getfollows),
+                        web.post('/weapi/user/getfolloweds', self.getfolloweds),
+                        web.post('/weapi/search/get', self.search)])
+        return app
+
+    @web.middleware
+    async def faults(self, request, handler):
+        """Inject latency and errors."""
+        self.request_count += 1
+        if self.latency:
+            await asyncio.sleep(self.rng.expovariate(1 / self.latency))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return web.Response(status=503, text="Service Unavailable")
+        return await handler(request)
+
+    async def weapi_params(self, request):
+        form = dict(parse_qsl(await request.text()))
+        try:
+            return decrypt(form['params'], self.keys[form['encSecKey']])
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest(text="undecryptable weapi request, see `--key-seed`")
+
+    @staticmethod
+    def not_found():
+        return web.Response(text='<p class="note s-fc3">很抱歉，你要查找的网页找不到</p>', content_type="text/html")
+
+    async def discover(self, request):
+        links = "".join('<a href="/user/home?id={0}">user{1}</a>'.format(USER_ID_BASE + i, i)
+                        for i in range(min(20, self.graph.users)))
+        return web.Response(text="<html><body>{}</body></html>".format(links), content_type="text/html")
+
+    async def user_home(self, request):
+        index = self.graph.index_of(request.query.get('id', -1))
+        if index is None:
+            return self.not_found()
+        profile = self.graph.profile(index)
+        ld = {'@context': "https://ziyuan.baidu.com/contexts/cambrian.jsonld",
+              '@id': "http://music.163.com/user/home?id={}".format(profile['userId']),
+              'title': profile['nickname'],
+              'images': [profile['avatarUrl']],
+              'description': profile['signature']}
+        text = ('<html><head><script type="application/ld+json">{}</script></head><body></body></html>'
+                .format(json.dumps(ld, ensure_ascii=False)))
+        return web.Response(text=text, content_type="text/html")
+
+    async def user_playlist(self, request):
+        params = await self.weapi_params(request)
+        index = self.graph.index_of(params.get('uid', -1))
+        if index is None:
+            return web.json_response({'code': 404, 'playlist': [], 'more': False})
+        playlist = {'id': PLAYLIST_ID_BASE + index, 'name': "user{}喜欢的音乐".format(index),
+                    'userId': USER_ID_BASE + index, 'trackCount': len(self.graph.favorite_songs(index))}
+        return web.json_response({'code': 200, 'more': False, 'playlist': [playlist]})
+
+    async def playlist(self, request):
+        index = int(request.query.get('id', -1)) - PLAYLIST_ID_BASE
+        if not 0 <= index < self.graph.users:
+            return self.not_found()
+        items = "".join('<li><a href="/song?id={0}">song {0}</a></li>'.format(song_id)
+                        for song_id in self.graph.favorite_songs(index))
+        return web.Response(text='<html><body><ul class="f-hide">{}</ul></body></html>'.format(items),
+                            content_type="text/html")
+
+    def follow_page(self, key, indexes, params):
+        offset = int(params.get('offset', 0))
+        limit = min(int(params.get('limit', 20)), self.page_limit_max)
+        page = [self.graph.profile(i) for i in indexes[offset:offset + limit]]
+        d = {'code': 200, key: page, 'more': offset + limit < len(indexes)}
+        if params.get('total') in (True, "true"):
+            d['total' if key == "followeds" else 'size'] = len(indexes)
+        return web.json_response(d)
+
+    async def getfollows(self, request):
+        params = await self.weapi_params(request)
+        index = self.graph.index_of(request.match_info['user_id'])
+        return self.follow_page('follow', self.graph.following[index] if index is not None else [], params)
+
+    async def getfolloweds(self, request):
+        params = await self.weapi_params(request)
+        index = self.graph.index_of(params.get('userId', -1))
+        return self.follow_page('followeds', self.graph.followers[index] if index is not None else [], params)
+
+    async def search(self, request):
+        params = await self.weapi_params(request)
+        s = str(params.get('s', ""))
+        offset, limit = int(params.get('offset', 0)), int(params.get('limit', 30))
+        # names are "user<index>", so those starting with `s` are found without a scan
+        indexes = []
+        if s.startswith("user") and s[4:].isdigit():
+            index = int(s[4:])
+            width = 1
+            while index < self.graph.users and len(indexes) < offset + limit:
+                indexes.extend(range(index, min(index + width, self.graph.users)))
+                index, width = index * 10, width * 10
+        profiles = [{key: profile[key] for key in ('userId', 'nickname', 'avatarUrl')}
+                    for profile in map(self.graph.profile, indexes[offset:offset + limit])]
+        return web.json_response({'code': 200, 'result': {'userprofiles': profiles,
+                                                          'userprofileCount': len(indexes)}})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8163)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--mean-degree", type=float, default=20)
+    parser.add_argument("--alpha", type=float, default=2.0, help="Pareto shape of the number of following")
+    parser.add_argument("--skew", type=float, default=2.0, help="how much popular users are followed, 1 for uniform")
+    parser.add_argument("--songs", type=int, default=100000)
+    parser.add_argument("--mean-favorites", type=float, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--page-limit-max", type=int, default=100, help="largest page of follows honored")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--key-seed", type=int, default=0, help="seed of the keys of clients")
+    parser.add_argument("--key-count", type=int, default=256, help="number of the keys of clients")
+    args = parser.parse_args(argv)
+    graph = SyntheticGraph(args.users, args.mean_degree, args.alpha, args.skew, args.songs, args.mean_favorites,
+                           args.seed)
+    server = MockNEMServer(graph, seeded_keys(args.key_seed, args.key_count), args.latency, args.error_rate,
+                           args.page_limit_max, args.seed)
+    web.run_app(server.application(), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,36 +7,214 @@
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 import logging
+import os
+import time
+import zlib
 import txmongo
 from pymongo.uri_parser import parse_uri
 from pymongo.errors import DuplicateKeyError, BulkWriteError
-from twisted.internet import defer
+from twisted.internet import defer, task, threads
 from scrapy.exceptions import NotConfigured
+from scrapy.utils.job import job_dir
 from pymongo import InsertOne, UpdateOne
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+from .common.sparse_presence_table import SparsePresenceTable
+from .common.fingerprint_table import FingerprintTable, fingerprint_of
+from .common.id_list import pack_ids
+from .common.segment_store import SegmentStore
+from .items import ItemBatch, UserProfile
 
 
 class TxMongoPipeline(object):
     mongo_uri = "mongodb://localhost:27017"  # default
+    flush_stats_prefix = 'txmongo/flush/'
+    ignored_error_codes = ()  # of write errors expected in bulk writes, counted instead of logged
 
-    def __init__(self, mongo_uri, db_name, buffer_size=0):
+    def __init__(self, mongo_uri, db_name, buffer_size=0, buffer_max_age=0, max_inflight_flushes=1, stats=None,
+                 write_once=False, refresh_names=False, fingerprints=False, pack_id_lists=False, path=None):
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.mongo_uri = mongo_uri or self.mongo_uri
         self.db_name = db_name or parse_uri(self.mongo_uri)['database']
+        self.connection = None
+        self.stats = stats
 
+        # Write-behind buffer: flushed once `buffer_size` operations are buffered or the oldest one is
+        # `buffer_max_age` seconds old, with at most `max_inflight_flushes` flushes in flight.
         self.buffer_size = buffer_size
-        if buffer_size > 0:
-            self.buffer = {}
-            self.buffer_count = 0
+        self.buffer_max_age = buffer_max_age
+        self.buffer = {}
+        self.buffer_records = {}  # collection name -> what to `record_written` for each operation in `buffer`
+        self.buffer_count = 0
+        self.buffer_started = None
+        self.flush_slots = defer.DeferredSemaphore(max(max_inflight_flushes, 1))
+        self.inflight_flushes = set()
+        self.age_check = None
+
+        # Items with `write_once` (e.g. songs, found again in the favorites of every other user) are written only the
+        # first time their `_id` is seen, unless `refresh_names` is set and the name has changed since.
+        # The IDs written are kept in `path` across runs; the names seen are not. Items are recorded as written only
+        # once the write succeeds, those being written kept in `pending_names` meanwhile.
+        self.write_once = write_once
+        self.refresh_names = refresh_names
+        self.path = path
+        self.stored_ids = {}
+        self.stored_names = {}
+        self.pending_names = {}
+
+        # With `fingerprints`, upserts are skipped when the hash of the fields to `$set` is the same as the last time.
+        # Each collection has one table for each set of fields, as items may carry some of the fields of a document.
+        # Fingerprints are recorded once written as well, those being written kept in `pending_fingerprints`.
+        self.fingerprints = fingerprints
+        self.fingerprint_tables = {}
+        self.pending_fingerprints = {}
+
+        # With `pack_id_lists`, lists of IDs in the fields named by `packed_fields` of items are stored as `Binary`s by
+        # `common.id_list.pack_ids`, which `common.id_list.unpack_ids` reverses. The `pack_ids` command migrates
+        # documents stored before.
+        self.pack_id_lists = pack_id_lists
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             mongo_uri=crawler.settings.get('MONGO_URI'),
             db_name=crawler.settings.get('MONGO_DB'),
-            buffer_size=crawler.settings.getint('MONGO_BUFFER_SIZE', 0)
+            buffer_size=crawler.settings.getint('MONGO_BUFFER_SIZE', 0),
+            buffer_max_age=crawler.settings.getfloat('MONGO_BUFFER_MAX_AGE', 0),
+            max_inflight_flushes=crawler.settings.getint('MONGO_MAX_INFLIGHT_FLUSHES', 1),
+            stats=crawler.stats,
+            write_once=crawler.settings.getbool('MONGO_WRITE_ONCE'),
+            refresh_names=crawler.settings.getbool('MONGO_WRITE_ONCE_REFRESH_NAMES'),
+            fingerprints=crawler.settings.getbool('MONGO_FINGERPRINTS'),
+            pack_id_lists=crawler.settings.getbool('MONGO_PACK_IDS'),
+            path=job_dir(crawler.settings)
         )
 
+    def stored_ids_path(self, collection_name):
+        return os.path.join(self.path, 'stored_{}_ids'.format(collection_name)) if self.path else None
+
+    def stored_ids_of(self, collection_name):
+        """Get the table of `_id`s written to `collection_name`, loaded from `JOBDIR` when first needed."""
+        table = self.stored_ids.get(collection_name)
+        if table is None:
+            table = self.stored_ids[collection_name] = SparsePresenceTable(10, 2)
+            path = self.stored_ids_path(collection_name)
+            if path and os.path.exists(path):
+                with open(path, 'rb') as file:
+                    table.load_from_file(file)
+                self.logger.info("Loaded stored IDs of {} from {}".format(collection_name, path))
+        return table
+
+    def is_stored(self, collection_name, _id, item):
+        """Tell whether writing `item` would be redundant, as it has been written or is being written.
+
+        If not, its name hash is pending in `pending_names` until `record_written`.
+        """
+        name_hash = zlib.crc32(item['name'].encode('utf-8')) \
+            if self.refresh_names and item.get('name') is not None else None
+        pending = self.pending_names.setdefault(collection_name, {})
+        if _id in pending:
+            last_hash = pending[_id]
+        elif self.stored_ids_of(collection_name).is_present(int(_id)):
+            # a name not seen during this run may just have been written in a previous run, which costs one rewrite
+            last_hash = self.stored_names.get(collection_name, {}).get(_id)
+        else:
+            pending[_id] = name_hash
+            return False
+        if name_hash is None or name_hash == last_hash:
+            return True
+        pending[_id] = name_hash
+        return False
+
+    def fingerprints_path(self, collection_name, fields):
+        if not self.path:
+            return None
+        return os.path.join(self.path, 'fingerprints_{}_{}'.format(collection_name, '-'.join(fields)))
+
+    def is_unchanged(self, collection_name, _id, item):
+        """Tell whether `item` is the same as the last time it was written or is being written, along with the key of
+        its table and its fingerprint.
+
+        If not, its fingerprint is pending in `pending_fingerprints` until `record_written`.
+        """
+        fields = {key: value for key, value in item.items() if key != '_id'}
+        key = (collection_name, tuple(sorted(fields)))
+        table = self.fingerprint_tables.get(key)
+        if table is None:
+            table = self.fingerprint_tables[key] = FingerprintTable()
+            path = self.fingerprints_path(*key)
+            if path and os.path.exists(path):
+                with open(path, 'rb') as file:
+                    table.load_from_file(file)
+                self.logger.info("Loaded {} fingerprints of {} from {}".format(len(table), collection_name, path))
+        fingerprint = fingerprint_of(fields)
+        pending = self.pending_fingerprints.setdefault(key, {})
+        last_fingerprint = pending[_id] if _id in pending else table.get(int(_id))
+        if fingerprint == last_fingerprint:
+            return True, key, fingerprint
+        pending[_id] = fingerprint
+        return False, key, fingerprint
+
+    def skip_reason(self, item_class, collection_name, _id, item):
+        """Get why upserting `item` can be skipped, which is counted in stats, or `None` if it should be written, along
+        with what to `record_written` once it is written."""
+        write_once = self.write_once and getattr(item_class, 'write_once', False)
+        if write_once and self.is_stored(collection_name, _id, item):
+            return 'suppressed', None
+        if not write_once and not self.fingerprints:
+            return None, None
+        # (`_id`, whether to record it as stored, its name hash, the key of its fingerprint table, its fingerprint)
+        record = [_id, write_once, self.pending_names[collection_name][_id] if write_once else None, None, None]
+        if self.fingerprints:
+            unchanged, key, fingerprint = self.is_unchanged(collection_name, _id, item)
+            if unchanged:
+                # written before, or being written, which `is_stored` does not know, so it is not pending there
+                self.record_written(collection_name, [tuple(record)], None)
+                return 'unchanged', None
+            record[3:] = key, fingerprint
+        return None, tuple(record)
+
+    def record_written(self, collection_name, records, failed=()):
+        """Record the items that `records` of `skip_reason` are of as written, except those at the indexes in
+        `failed`, or all if it is `None`, which are to be written again when seen again."""
+        for index, record in enumerate(records):
+            if record is None:
+                continue
+            _id, write_once, name_hash, key, fingerprint = record
+            written = failed is not None and index not in failed
+            if write_once:
+                pending = self.pending_names[collection_name]
+                if pending.get(_id, -1) == name_hash:  # unless to be written again since with another name
+                    del pending[_id]
+                if written:
+                    self.stored_ids_of(collection_name).set_present(int(_id))
+                    if name_hash is not None:
+                        self.stored_names.setdefault(collection_name, {})[_id] = name_hash
+            if key is not None:
+                pending = self.pending_fingerprints[key]
+                if pending.get(_id, -1) == fingerprint:
+                    del pending[_id]
+                if written:
+                    self.fingerprint_tables[key][int(_id)] = fingerprint
+
+    def pack_fields(self, item_class, item):
+        for field in getattr(item_class, 'packed_fields', ()) if self.pack_id_lists else ():
+            if isinstance(item.get(field), list):
+                item[field] = Binary(pack_ids(item[field]), USER_DEFINED_SUBTYPE)
+
+    def dump_tables(self):
+        """Save the tables of stored IDs and fingerprints in `JOBDIR`, replacing the old ones atomically."""
+        paths_and_tables = [(self.stored_ids_path(collection_name), table)
+                            for collection_name, table in self.stored_ids.items()]
+        paths_and_tables += [(self.fingerprints_path(*key), table) for key, table in self.fingerprint_tables.items()]
+        for path, table in paths_and_tables:
+            if path is None:
+                continue
+            with open(path + '.tmp', 'wb') as file:
+                table.dump_to_file(file)
+            os.replace(path + '.tmp', path)
+
     @defer.inlineCallbacks
     def open_spider(self, spider):
         try:
@@ -51,19 +229,36 @@ class TxMongoPipeline(object):
                     self.__class__.__name__)
             self.logger.error(e)
             raise NotConfigured(e)
-        self.logger.info("TxMongoPipeline activated, uri: {}, database: {}, buffer size: {}.".format(self.mongo_uri, self.db_name, self.buffer_size))
+        self.logger.info(self.__class__.__name__ + " activated, uri: {}, database: {}, buffer size: {}.".format(self.mongo_uri, self.db_name, self.buffer_size))
         self.connection = yield txmongo.connection.ConnectionPool(self.mongo_uri)
         self.db = self.connection[self.db_name]
+        if self.buffer_size and self.buffer_max_age:
+            self.age_check = task.LoopingCall(self.flush_stale_buffer)
+            self.age_check.start(min(self.buffer_max_age / 2, 1), now=False)
 
     @defer.inlineCallbacks
     def close_spider(self, spider):
+        if self.age_check is not None and self.age_check.running:
+            self.age_check.stop()
         if self.buffer:
             yield self.flush_buffer()
+        if self.inflight_flushes:
+            yield defer.DeferredList(list(self.inflight_flushes))
+        if self.stats is not None and self.stats.get_value(self.flush_stats_prefix + 'count'):
+            count = self.stats.get_value(self.flush_stats_prefix + 'count')
+            self.logger.info("Buffer flushed {} times, {:.1f} operations and {:.3f} secs per flush on average".format(
+                count,
+                self.stats.get_value(self.flush_stats_prefix + 'operations', 0) / count,
+                self.stats.get_value(self.flush_stats_prefix + 'latency_total', 0) / count))
+        self.dump_tables()
         if self.connection:
             yield self.connection.disconnect()
 
     @defer.inlineCallbacks
     def process_item(self, item, spider):
+        if isinstance(item, ItemBatch):
+            yield self.process_batch(item, spider)
+            defer.returnValue(item)
         collection_name = item.collection_name if hasattr(item, "collection_name")\
             else item.__class__.__name__
         processed_item = dict(item)
@@ -83,19 +278,31 @@ class TxMongoPipeline(object):
         # `upsert` here: denotes whether the insert operation is to use `insert_one` or `update` with `upsert=True`
         # in the former case, DuplicateKeyError may be raised
         upsert = _id is not None and hasattr(item, 'upsert') and item.upsert
+        record = None
+        if upsert:
+            reason, record = self.skip_reason(item.__class__, collection_name, _id, processed_item)
+            if reason is not None:
+                spider.crawler.stats.inc_value(
+                    'pipeline/txmongo/{}/{}'.format(collection_name, reason), spider=spider)
+                defer.returnValue(item)
+        self.pack_fields(item.__class__, processed_item)
         # TODO: test error handling
         if self.buffer_size:
             # buffer enabled
-            if self.buffer_count >= self.buffer_size:
-                result = yield self.flush_buffer()
-            else:
-                operation = UpdateOne({'_id': _id}, {'$set': processed_item}, upsert=True) if upsert else InsertOne(processed_item)
-                self.buffer.setdefault(collection_name, []).append(operation)
-                self.buffer_count += 1
+            operation = UpdateOne({'_id': _id}, {'$set': processed_item}, upsert=True) if upsert else InsertOne(processed_item)
+            # backpressure: wait only until the flush gets a slot among those in flight
+            yield self.buffer_operations(collection_name, [operation], [record])
         else:
             # buffer disabled
             if upsert:
-                result = yield self.db[collection_name].update({'_id': _id}, processed_item, upsert=True)
+                # `$set` as the buffered path does, so that items with some fields of a document do not wipe others
+                try:
+                    result = yield self.db[collection_name].update_one({'_id': _id}, {'$set': processed_item},
+                                                                       upsert=True)
+                except Exception:
+                    self.record_written(collection_name, [record], None)
+                    raise
+                self.record_written(collection_name, [record])
             else:
                 try:
                     result = yield self.db[collection_name].insert_one(processed_item)
@@ -108,17 +315,255 @@ class TxMongoPipeline(object):
         defer.returnValue(item)
 
     @defer.inlineCallbacks
+    def process_batch(self, batch, spider):
+        """Write the items in `batch` with one `bulk_write`, or add them to the buffer all at once."""
+        item_class = batch.item_class
+        collection_name = getattr(item_class, "collection_name", item_class.__name__)
+        to__id = getattr(item_class, "to__id", None)
+        operations = []
+        records = []
+        skipped = {}
+        for fields in batch['items']:
+            processed_item = dict(fields)
+            _id = processed_item.pop(to__id, None) if to__id else None
+            if _id is None or not getattr(item_class, 'upsert', False):
+                operations.append(InsertOne(processed_item))
+                records.append(None)
+                continue
+            reason, record = self.skip_reason(item_class, collection_name, _id, processed_item)
+            if reason is not None:
+                skipped[reason] = skipped.get(reason, 0) + 1
+                continue
+            processed_item['_id'] = _id
+            self.pack_fields(item_class, processed_item)
+            operations.append(UpdateOne({'_id': _id}, {'$set': processed_item}, upsert=True))
+            records.append(record)
+        if operations:
+            if self.buffer_size:
+                yield self.buffer_operations(collection_name, operations, records)
+            else:
+                yield self.bulk_write(collection_name, operations, records)
+            spider.crawler.stats.inc_value(
+                'pipeline/txmongo/{}'.format(collection_name), len(operations), spider=spider)
+        for reason, count in skipped.items():
+            spider.crawler.stats.inc_value(
+                'pipeline/txmongo/{}/{}'.format(collection_name, reason), count, spider=spider)
+
+    def buffer_operations(self, collection_name, operations, records=None):
+        """Add `operations` to the buffer, along with what to `record_written` for each once written, and flush it if
+        it is full. The returned `Deferred` fires as the one of `flush_buffer` does, or at once."""
+        self.buffer.setdefault(collection_name, []).extend(operations)
+        self.buffer_records.setdefault(collection_name, []).extend(records or [None] * len(operations))
+        if self.buffer_count == 0:
+            self.buffer_started = time.time()
+        self.buffer_count += len(operations)
+        if self.buffer_count >= self.buffer_size:
+            return self.flush_buffer()
+        return defer.succeed(None)
+
+    def flush_stale_buffer(self):
+        if self.buffer_count and time.time() - self.buffer_started >= self.buffer_max_age:
+            return self.flush_buffer()
+
     def flush_buffer(self):
-        results = []
-        buffer = self.buffer.copy() # execution flow switched to other coroutines when bulk write
-        self.buffer.clear()
+        """Start writing the buffer in the background.
+
+        The returned `Deferred` fires once the flush is started, which is delayed while there are already
+        `max_inflight_flushes` in flight. It is the flush in `inflight_flushes` that fires once written.
+        """
+        buffer, records, count = self.buffer, self.buffer_records, self.buffer_count
+        self.buffer = {}
+        self.buffer_records = {}
         self.buffer_count = 0
-        for collection_name, operations in buffer.items():
-            try:
-                result = yield self.db[collection_name].bulk_write(operations, ordered=False)
-                self.logger.debug("Buffer flushed, {} for collection {}: {}".format(len(operations), collection_name, result.bulk_api_result))
-            except BulkWriteError as e:
+        self.buffer_started = None
+        if not buffer:
+            return defer.succeed(None)
+
+        def start(_):
+            flush = self.write_buffer(buffer, count, records)
+            self.inflight_flushes.add(flush)
+
+            def finish(result):
+                self.inflight_flushes.discard(flush)
+                self.flush_slots.release()
+                return result
+            flush.addBoth(finish)
+        return self.flush_slots.acquire().addCallback(start)
+
+    @defer.inlineCallbacks
+    def bulk_write(self, collection_name, operations, records=None):
+        """Bulk write `operations`, and `record_written` the `records` of those written. Errors are logged, not
+        raised."""
+        failed = ()
+        try:
+            result = yield self.db[collection_name].bulk_write(operations, ordered=False)
+            self.logger.debug("Buffer flushed, {} for collection {}: {}".format(len(operations), collection_name, result.bulk_api_result))
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', ())
+            ignored = sum(1 for error in errors if error.get('code') in self.ignored_error_codes)
+            if ignored < len(errors) or e.details.get('writeConcernErrors'):
                 self.logger.error("{!r} when writing buffer: {}".format(e, e.details))
-                result = e.details
-                results.append(result)
-        defer.returnValue(results)
\ No newline at end of file
+            if ignored and self.stats is not None:
+                self.stats.inc_value(self.flush_stats_prefix + 'ignored_errors', ignored)
+            result = e.details
+            # unordered, so all but those with errors are written, unless the write concern is not satisfied
+            failed = None if e.details.get('writeConcernErrors') \
+                else {error['index'] for error in e.details.get('writeErrors', ())}
+        except Exception as e:
+            self.logger.error("{!r} when writing buffer of {} operations for collection {}".format(e, len(operations), collection_name))
+            result = e
+            failed = None
+        if records and any(records):
+            self.record_written(collection_name, records, failed)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def write_buffer(self, buffer, count, records=None):
+        """Bulk write the operations in `buffer` for all collections in parallel."""
+        records = records or {}
+        start_time = time.time()
+        results = yield defer.gatherResults([self.bulk_write(collection_name, operations, records.get(collection_name))
+                                             for collection_name, operations in buffer.items()])
+        latency = time.time() - start_time
+        if self.stats is not None:
+            self.stats.inc_value(self.flush_stats_prefix + 'count')
+            self.stats.inc_value(self.flush_stats_prefix + 'operations', count)
+            self.stats.max_value(self.flush_stats_prefix + 'operations_max', count)
+            self.stats.inc_value(self.flush_stats_prefix + 'latency_total', latency)
+            self.stats.max_value(self.flush_stats_prefix + 'latency_max', latency)
+        defer.returnValue(results)
+
+
+class SongUsersIndexPipeline(TxMongoPipeline):
+    """Maintain `song_users`, an inverted index of the favorite songs of users, to look up users by songs.
+
+    Each document holds up to `bucket_size` users of a song as `{'song': ..., 'users': [...], 'count': ...}`, so that
+    popular songs span many documents instead of growing one over the size limit. Users are added in bulk writes of
+    `buffer_size` operations. A user crawled again is not added again, as a unique index on `song` and `users` rejects
+    the update, which is then counted in the `ignored_errors` stat of flushes, leaving `count` as is.
+    """
+    collection_name = "song_users"
+    flush_stats_prefix = 'song_users/flush/'
+    ignored_error_codes = (11000,)  # duplicate key, for a user added before
+
+    def __init__(self, mongo_uri, db_name, bucket_size=1000, **kwargs):
+        super().__init__(mongo_uri, db_name, **kwargs)
+        self.bucket_size = bucket_size
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SONG_USERS_INDEX'):
+            raise NotConfigured
+        return cls(
+            mongo_uri=crawler.settings.get('MONGO_URI'),
+            db_name=crawler.settings.get('MONGO_DB'),
+            bucket_size=crawler.settings.getint('SONG_USERS_INDEX_BUCKET_SIZE', 1000),
+            buffer_size=max(crawler.settings.getint('SONG_USERS_INDEX_BUFFER_SIZE', 1000), 1),
+            buffer_max_age=crawler.settings.getfloat('MONGO_BUFFER_MAX_AGE', 0),
+            max_inflight_flushes=crawler.settings.getint('MONGO_MAX_INFLIGHT_FLUSHES', 1),
+            stats=crawler.stats
+        )
+
+    @defer.inlineCallbacks
+    def open_spider(self, spider):
+        yield super().open_spider(spider)
+        # for both finding the bucket with room to push into, and looking up users by a song
+        yield self.db[self.collection_name].create_index(
+            txmongo.filter.sort(txmongo.filter.ASCENDING('song') + txmongo.filter.ASCENDING('count')))
+        # multikey, so that a user is in at most one bucket of a song
+        yield self.db[self.collection_name].create_index(
+            txmongo.filter.sort(txmongo.filter.ASCENDING('song') + txmongo.filter.ASCENDING('users')), unique=True)
+
+    @defer.inlineCallbacks
+    def process_item(self, item, spider):
+        if not isinstance(item, UserProfile) or not item.get('favorite_songs'):
+            defer.returnValue(item)
+        user_id = item['id']
+        # a bucket with room and without the user, or a new one, which the unique index rejects if the user is in any
+        operations = [UpdateOne({'song': song_id, 'count': {'$lt': self.bucket_size}, 'users': {'$ne': user_id}},
+                                {'$push': {'users': user_id}, '$inc': {'count': 1}},
+                                upsert=True)
+                      for song_id in item['favorite_songs']]
+        yield self.buffer_operations(self.collection_name, operations)
+        spider.crawler.stats.inc_value(
+            'pipeline/txmongo/{}'.format(self.collection_name), len(operations), spider=spider)
+        defer.returnValue(item)
+
+
+def document_of(item_class, fields):
+    """Get `(collection name, document)` for storing an item of `item_class` with `fields`, with the field named by
+    `to__id` moved to `_id` as `TxMongoPipeline` does."""
+    collection_name = getattr(item_class, "collection_name", item_class.__name__)
+    document = dict(fields)
+    to__id = getattr(item_class, "to__id", None)
+    _id = document.pop(to__id, None) if to__id else None
+    if _id is not None:
+        document['_id'] = _id
+    return collection_name, document
+
+
+class LocalStorePipeline(object):
+    """Write items to a `SegmentStore` in `path` instead of MongoDB, in batches of `batch_size` documents.
+
+    Documents are merged by `_id` when read or compacted, with the last writer winning, like the upserts with `$set` of
+    `TxMongoPipeline`. Collections are compacted in a thread on close with `compact_on_close`.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, batch_size=1000, compact_on_close=False, stats=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.segment_size = segment_size
+        self.batch_size = max(batch_size, 1)
+        self.compact_on_close = compact_on_close
+        self.stats = stats
+        self.store = None
+        self.batches = {}
+        self.batch_count = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('LOCAL_STORE_PATH')
+        if not path:
+            raise NotConfigured
+        return cls(path,
+                   segment_size=crawler.settings.getint('LOCAL_STORE_SEGMENT_SIZE', 64 * 1024 * 1024),
+                   batch_size=crawler.settings.getint('LOCAL_STORE_BATCH_SIZE', 1000),
+                   compact_on_close=crawler.settings.getbool('LOCAL_STORE_COMPACT_ON_CLOSE'),
+                   stats=crawler.stats)
+
+    def open_spider(self, spider):
+        self.logger.info("LocalStorePipeline activated, path: {}, batch size: {}.".format(self.path, self.batch_size))
+        self.store = SegmentStore(self.path, self.segment_size)
+
+    def process_item(self, item, spider):
+        if isinstance(item, ItemBatch):
+            documents = [document_of(item.item_class, fields) for fields in item['items']]
+        else:
+            documents = [document_of(item.__class__, item)]
+        for collection_name, document in documents:
+            self.batches.setdefault(collection_name, []).append(document)
+            spider.crawler.stats.inc_value(
+                'pipeline/localstore/{}'.format(collection_name), spider=spider)
+        self.batch_count += len(documents)
+        if self.batch_count >= self.batch_size:
+            self.write_batches()
+        return item
+
+    def write_batches(self):
+        """Hand batches over to the writer thread of the store."""
+        for collection_name, documents in self.batches.items():
+            self.store.append(collection_name, documents)
+        self.batches = {}
+        self.batch_count = 0
+
+    def close_spider(self, spider):
+        self.write_batches()
+        return threads.deferToThread(self.close_store)
+
+    def close_store(self):
+        self.store.close()
+        if self.compact_on_close:
+            for collection_name in sorted(os.listdir(self.path)):
+                count = self.store.compact(collection_name)
+                if count:
+                    self.logger.info("Compacted {} segments of {}".format(count, collection_name))
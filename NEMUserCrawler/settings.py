@@ -13,6 +13,7 @@ BOT_NAME = 'NEMUserCrawler'
 
 SPIDER_MODULES = ['NEMUserCrawler.spiders']
 NEWSPIDER_MODULE = 'NEMUserCrawler.spiders'
+COMMANDS_MODULE = 'NEMUserCrawler.commands'
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -54,6 +55,7 @@ CONCURRENT_REQUESTS_PER_DOMAIN = 16
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
     'NEMUserCrawler.middlewares.NemusercrawlerDownloaderMiddleware': None,
+    'NEMUserCrawler.middlewares.WeAPIEncryptionMiddleware': 50,
     'rotating_proxies.middlewares.RotatingProxyMiddleware': 610,
     'rotating_proxies.middlewares.BanDetectionMiddleware': 620,
 }
@@ -69,6 +71,8 @@ EXTENSIONS = {
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     'NEMUserCrawler.pipelines.TxMongoPipeline': 300,
+    'NEMUserCrawler.pipelines.SongUsersIndexPipeline': 310,
+    'NEMUserCrawler.pipelines.LocalStorePipeline': 320,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -106,4 +110,109 @@ ROTATING_PROXY_PAGE_RETRY_TIMES = 16
 ROTATING_PROXY_BACKOFF_BASE = 90
 ROTATING_PROXY_BACKOFF_CAP = 1800
 
-RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 403, 405, 404, 400]
\ No newline at end of file
+RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 403, 405, 404, 400]
+
+# Keep the crawled user IDs of `NemUserIDFilter` in a memory-mapped file under `JOBDIR`,
+# instead of loading and dumping the whole table at start-up and shut-down.
+DUPEFILTER_MMAP = False
+
+# Periodically checkpoint the crawled user IDs of `NemUserIDFilter`, every N seconds and/or every N newly crawled IDs
+# (0 to disable). Only the 4 KiB pages of the table changed since the last checkpoint are appended to a delta file, at
+# most 4 KiB per ID crawled in between, which is compacted into the full table in a thread once it exceeds
+# `DUPEFILTER_CHECKPOINT_COMPACT_SIZE` bytes (0 to never compact).
+DUPEFILTER_CHECKPOINT_INTERVAL = 60
+DUPEFILTER_CHECKPOINT_IDS = 0
+DUPEFILTER_CHECKPOINT_COMPACT_SIZE = 512 * 1024 * 1024
+
+# Precompute this many (key, encSecKey) pairs for weapi requests, to keep RSA out of building requests (0 to disable).
+# Each pair is used for `NEM_KEY_POOL_REUSE` requests before being discarded.
+NEM_KEY_POOL_SIZE = 256
+NEM_KEY_POOL_REUSE = 1
+
+# Check followers/following on a page against the crawled user IDs of `NemUserIDFilter` in one batch and only build
+# requests for unseen ones, instead of letting the dupefilter drop them one by one.
+FOLLOW_PREFILTER = True
+
+# Queue weapi requests with plaintext parameters and encrypt them in `WeAPIEncryptionMiddleware` when dequeued for
+# downloading, which must be enabled in `DOWNLOADER_MIDDLEWARES` then.
+NEM_DEFER_WEAPI_ENCRYPTION = True
+
+# Queue user-centric requests as packed `FrontierRecord`s of (user ID, kind, offset, limit, priority) in `JOBDIR`,
+# instead of pickled requests with profiles. Profiles are stored as soon as users are found in this mode.
+SCHEDULER_DISK_QUEUE = 'NEMUserCrawler.squeues.CompactLifoDiskQueue'
+FRONTIER_COMPACT = True
+
+# Fan out follower/following pages: the first page asks for the total, then the remaining pages are requested at once
+# in up to this many concurrent chains per user (0 or 1 to walk through pages one by one).
+FOLLOW_FANOUT = 8
+
+# Page size to request followers/following with at first, and the largest one to probe for as long as the API honors
+# it (0 for `FOLLOW_PAGE_LIMIT`, i.e. no probing). The page size is pinned at what is honored once pages keep coming
+# back truncated at the same size.
+FOLLOW_PAGE_LIMIT = 100
+FOLLOW_PAGE_LIMIT_MAX = 0
+
+# With `MONGO_BUFFER_SIZE` > 0, `TxMongoPipeline` buffers write operations and bulk writes them once that many are
+# buffered or the oldest is `MONGO_BUFFER_MAX_AGE` seconds old (0 for no limit), with collections written in parallel and
+# at most `MONGO_MAX_INFLIGHT_FLUSHES` flushes in flight. Items wait when all of them are busy.
+MONGO_BUFFER_SIZE = 0
+MONGO_BUFFER_MAX_AGE = 10
+MONGO_MAX_INFLIGHT_FLUSHES = 4
+
+# Write items with `write_once` (songs) only once per `_id`, skipping the same songs found in the favorites of other
+# users. IDs written are kept in `JOBDIR`. With `MONGO_WRITE_ONCE_REFRESH_NAMES`, a song is rewritten when found with
+# a name other than the one seen last during this run.
+MONGO_WRITE_ONCE = True
+MONGO_WRITE_ONCE_REFRESH_NAMES = False
+
+# Yield the favorite songs of a user as one `SongBatch` item, which `TxMongoPipeline` writes with one bulk write (or adds
+# to the buffer at once), instead of one `Song` item per song.
+SONG_BATCH = True
+
+# Skip upserts of items whose fields are the same as the last time they were written, by keeping 64-bit hashes of them
+# in `JOBDIR` (about 23 bytes per document), so that re-crawling unchanged users and songs writes almost nothing.
+MONGO_FINGERPRINTS = False
+
+# Store lists of IDs, i.e. `favorite_songs` of users, as binaries of zigzag varint deltas (see `common.id_list`) instead
+# of BSON arrays, which take about 16 bytes per ID. `scrapy pack_ids` migrates users stored before, or back.
+MONGO_PACK_IDS = False
+
+# Maintain `song_users`, an inverted index from songs to the users having them in favorites, in documents of up to
+# `SONG_USERS_INDEX_BUCKET_SIZE` users, pushed in bulk writes of `SONG_USERS_INDEX_BUFFER_SIZE` operations.
+SONG_USERS_INDEX = False
+SONG_USERS_INDEX_BUCKET_SIZE = 1000
+SONG_USERS_INDEX_BUFFER_SIZE = 1000
+
+# With `LOCAL_STORE_PATH`, `LocalStorePipeline` also writes items to gzipped NDJSON segments of up to
+# `LOCAL_STORE_SEGMENT_SIZE` bytes in that directory, in batches of `LOCAL_STORE_BATCH_SIZE` written by a thread.
+# Documents of the same `_id` are merged when compacted, on close with `LOCAL_STORE_COMPACT_ON_CLOSE`.
+# Remove `TxMongoPipeline` from `ITEM_PIPELINES` to crawl without MongoDB.
+LOCAL_STORE_PATH = None
+LOCAL_STORE_SEGMENT_SIZE = 64 * 1024 * 1024
+LOCAL_STORE_BATCH_SIZE = 1000
+LOCAL_STORE_COMPACT_ON_CLOSE = True
+
+# Append an edge `(src, dst, type)` for every user found in the following/followers of another to a binary log at
+# `EDGE_LOG_PATH` (see `common.edge_log`), fsynced every `EDGE_LOG_SYNC_INTERVAL` seconds. `scrapy build_follow_graph`
+# turns it into CSR adjacency.
+EDGE_LOG_PATH = None
+EDGE_LOG_SYNC_INTERVAL = 60
+
+# Prioritize the followers/following of each user found by the new users expected from their first page, i.e. their
+# number up to a page times the share of unseen users on the page the user was found on, smoothed towards the running
+# share on pages of the kind. Requires `NemUserIDFilter`.
+# Empty lists are not requested, nor users found before in the run. The stat `user/follow/new_per_request` tells the
+# users crawled for the first time per request.
+FOLLOW_PRIORITIZE = True
+
+# Fingerprint weapi requests by their plaintext parameters (with `NEM_DEFER_WEAPI_ENCRYPTION`) so that the HTTP cache
+# can serve them, and expire cached responses by endpoint. Enable with `HTTPCACHE_ENABLED`.
+REQUEST_FINGERPRINTER_CLASS = 'NEMUserCrawler.httpcache.WeAPIRequestFingerprinter'
+HTTPCACHE_STORAGE = 'NEMUserCrawler.httpcache.EndpointTTLCacheStorage'
+HTTPCACHE_ENDPOINT_TTLS = {
+    '/user/home': 7 * 24 * 3600,
+    '/weapi/user/playlist': 24 * 3600,
+    '/playlist': 24 * 3600,
+    '/weapi/user/getfollows': 6 * 3600,
+    '/weapi/user/getfolloweds': 6 * 3600,
+}
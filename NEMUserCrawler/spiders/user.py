@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import json
-import re
+import math
 import scrapy
 import logging
-from urllib.parse import urlencode
+from twisted.internet import task
+from urllib.parse import urlencode, urlsplit, parse_qs
 from .. import common
-from ..items import UserProfile, Song
+from ..common.frontier import FrontierRecord
+from ..common.edge_log import EdgeLog
+from ..common import nem_json, nem_page
+from ..items import UserProfile, Song, SongBatch
 
 
 class UserSpider(scrapy.Spider):
@@ -38,6 +42,31 @@ for each follower |    |parse_favorite_songs|
     start_urls = [common.nem.rel2abs("discover")]
     custom_settings = {'DUPEFILTER_CLASS': "NEMUserCrawler.dupefilter.NemUserIDFilter",
                        'COOKIES_ENABLED':  False}
+    key_pool = None  # `common.nem.KeyPool` for weapi requests, set up by `NEM_KEY_POOL_SIZE`
+    edge_log = None  # `common.edge_log.EdgeLog` of follow edges, set up by `EDGE_LOG_PATH`
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        pool_size = crawler.settings.getint('NEM_KEY_POOL_SIZE')
+        if pool_size > 0:
+            spider.key_pool = common.nem.KeyPool(pool_size, crawler.settings.getint('NEM_KEY_POOL_REUSE', 1))
+        edge_log_path = crawler.settings.get('EDGE_LOG_PATH')
+        if edge_log_path:
+            spider.edge_log = EdgeLog(edge_log_path)
+            sync_interval = crawler.settings.getfloat('EDGE_LOG_SYNC_INTERVAL')
+            if sync_interval > 0:
+                spider.edge_log_sync = task.LoopingCall(spider.edge_log.sync)
+                spider.edge_log_sync.start(sync_interval, now=False)
+            crawler.signals.connect(spider.close_edge_log, signal=scrapy.signals.spider_closed)
+        return spider
+
+    def close_edge_log(self, spider):
+        sync = getattr(self, 'edge_log_sync', None)
+        if sync is not None and sync.running:
+            sync.stop()
+        self.edge_log.close()
+        self.logger.info("Logged {} follow edges to {}".format(self.edge_log.count, self.edge_log.path))
 
     def parse(self, response):
         for user_id in response.xpath("//a[starts-with(@href, '/user/home')]/@href").re(r"(?<=id=)\d+"):
@@ -45,19 +74,18 @@ for each follower |    |parse_favorite_songs|
             yield response.follow("user/home?id={}".format(user_id), callback=self.parse_user_page)
             yield from self.request_follows(response, user_id)
 
-    REGEX_USER_ID = re.compile(r".+user/home\?id=(?P<id>\d+)")
-
     def parse_user_page(self, response):
-        d = response.css(
-            'script[type="application/ld+json"]::text').extract_first()
-        d = json.loads(d)
-        user_id = self.REGEX_USER_ID.match(d['@id']).group('id')
-        up = UserProfile(
-            id=int(user_id),
-            name=d['title'],
-            avatar_url=d['images'][0] if len(d['images']) > 0 else "",
-            description=d['description']
-        )
+        d = nem_page.scan_ld_json(response.text)
+        if d is None:  # not of the shape expected, see `common.nem_page`
+            self.crawler.stats.inc_value('user/extract/fallback/user_page', spider=self)
+            d = nem_page.select_ld_json(response)
+        if d is None:
+            self.logger.warning("No profile found in the user page %s", response.url)
+            return
+        up = UserProfile(**nem_page.user_profile_of(d))
+        if self.compact_frontier:
+            yield up
+            up = UserProfile(id=up['id'])
         yield self.request_playlists(response, up)
 
     def request_play_history(self):
@@ -70,56 +98,88 @@ for each follower |    |parse_favorite_songs|
         #                           "csrf_token": ""})),
         #                      callback=self.parse_play_histroy)
 
+    def weapi_request(self, response, url, params, **kwargs):
+        """Build a POST request of `params` to weapi `url`.
+
+        `params` is encrypted right away, or with `NEM_DEFER_WEAPI_ENCRYPTION`, queued in plaintext as
+        `meta['weapi_params']` and encrypted by `WeAPIEncryptionMiddleware` once the request is about to be downloaded.
+        """
+        if self.settings.getbool('NEM_DEFER_WEAPI_ENCRYPTION'):
+            kwargs['meta'] = dict(kwargs.get('meta') or {}, weapi_params=params)
+            body = ""
+        else:
+            body = urlencode(common.nem.encrypt(params, key_pool=self.key_pool))
+        return self.follow(response,
+                           url,
+                           method="POST",
+                           headers={
+                               'Content-Type': "application/x-www-form-urlencoded"},
+                           body=body,
+                           **kwargs)
+
+    @staticmethod
+    def follow(response, url, **kwargs):
+        """`response.follow`, or a request to `url` relative to `common.nem.BASE_URL` if `response` is `None`."""
+        if response is None:
+            return scrapy.Request(common.nem.rel2abs(url), **kwargs)
+        return response.follow(url, **kwargs)
+
     def request_playlists(self, response, user_profile):
-        return response.follow("/weapi/user/playlist?csrf_token=",
-                               method="POST",
-                               headers={
-                                   'Content-Type': "application/x-www-form-urlencoded"},
-                               body=urlencode(common.nem.encrypt(
-                                   {"uid": str(user_profile['id']), "wordwrap": "99", "offset": "0",
-                                    "total": "true", "limit": "5", "csrf_token": ""}
-                               )),
-                               callback=self.parse_playlists,
-                               meta={
-                                   "filter_user_id": user_profile['id'],
-                                   'user_profile': user_profile},
-                               priority=20)
+        return self.weapi_request(response,
+                                  "/weapi/user/playlist?csrf_token=",
+                                  {"uid": str(user_profile['id']), "wordwrap": "99", "offset": "0",
+                                   "total": "true", "limit": "5", "csrf_token": ""},
+                                  callback=self.parse_playlists,
+                                  meta={
+                                      "filter_user_id": user_profile['id'],
+                                      'user_profile': user_profile},
+                                  priority=20)
 
     def parse_playlists(self, response):
-        d = json.loads(response.body.decode("utf-8"))
         up: UserProfile = response.meta.get('user_profile')
         try:
-            if "喜欢的音乐" not in d['playlist'][0]['name']:
-                self.log("User {}({}) seems to have no Fav playlist."
-                         " Name of the first playlist: {}".format(
-                             up['name'], up['id'], d['playlist'][0]['name']),
-                         logging.WARNING)
-            #print(up['name'], d['playlist'][0]['name'])
-            yield response.follow("/playlist?id={}".format(d['playlist'][0]['id']),
-                                  method="GET",
-                                  callback=self.parse_favorite_songs,
-                                  meta={
-                                      'filter_user_id': up['id'],
-                                      'user_profile': up,
-                'as_present': True},
-                priority=30)
-        except (KeyError, json.decoder.JSONDecodeError) as e:
+            playlist = nem_json.first_playlist(response.body)
+        except (KeyError, nem_json.JSONDecodeError) as e:
             self.log(
                 "{!r} when parsing the playlists of user {}.".format(e, up),
                 logging.WARNING)
             yield self.request_playlists(response, up)  # retry
-            # self.log("Error when parsing the playlists of user {}({}): .".format(
-            #     up['name'], up['id']), d, logging.WARNING)
+            return
+        if playlist is None:
+            self.logger.warning("User %s has no playlists", up['id'])
+            return
+        playlist_id, name = playlist
+        if "喜欢的音乐" not in name:
+            self.log("User {}({}) seems to have no Fav playlist."
+                     " Name of the first playlist: {}".format(
+                         up.get('name'), up['id'], name),
+                     logging.WARNING)
+        yield self.request_favorite_songs(response, up, playlist_id)
+
+    def request_favorite_songs(self, response, user_profile, playlist_id):
+        return self.follow(response,
+                           "/playlist?id={}".format(playlist_id),
+                           method="GET",
+                           callback=self.parse_favorite_songs,
+                           meta={
+                               'filter_user_id': user_profile['id'],
+                               'user_profile': user_profile,
+                               'as_present': True},
+                           priority=30)
 
     def parse_favorite_songs(self, response):
         up: UserProfile = response.meta.get('user_profile')
-        fav_songs = []
-        for song in response.xpath("//ul[@class='f-hide']/li/a"):
-            song_ = Song(id=int(song.xpath("@href").re("id=(.+)")
-                                [0]), name=song.xpath("text()").extract_first())
-            yield song_
-            fav_songs.append(song_['id'])
-        up['favorite_songs'] = fav_songs
+        songs = nem_page.scan_favorite_songs(response.text)
+        if songs is None:  # not of the shape expected, see `common.nem_page`
+            self.crawler.stats.inc_value('user/extract/fallback/favorite_songs', spider=self)
+            songs = nem_page.select_favorite_songs(response)
+        if self.settings.getbool('SONG_BATCH'):
+            if songs:
+                yield SongBatch(items=[{'id': song_id, 'name': name} for song_id, name in songs])
+        else:
+            for song_id, name in songs:
+                yield Song(id=song_id, name=name)
+        up['favorite_songs'] = [song_id for song_id, _ in songs]
         yield up
 
     def parse_play_histroy(self, response):
@@ -132,25 +192,186 @@ for each follower |    |parse_favorite_songs|
             # request followers and following of the user
             yield self.request_follow(follow_type, *args, **kwargs)
 
-    def request_follow(self, follow_type, response, user_id, offset=0, limit=100):
-        """Request generator for followers or following according to `follow_type`."""
+    FOLLOW_PRIORITY = 10
+
+    def request_follow(self, follow_type, response, user_id, offset=0, limit=None, stride=None, priority=None,
+                       total=None):
+        """Request generator for followers or following according to `follow_type`.
+
+        `limit` defaults to the page size probed so far, see `follow_limit`. `priority` defaults to `FOLLOW_PRIORITY`.
+
+        The next page is requested at `offset + stride` after this one, `stride` being `limit` unless pages are
+        fanned out (see `FOLLOW_FANOUT`), in which case `total` is the number of users told by the first page. Pages
+        after the first are not filtered, or iterating the followers of a user would stop as soon as the user is
+        crawled.
+        """
         url = {'following': "/weapi/user/getfollows/{}?csrf_token=",
                'followers': "/weapi/user/getfolloweds?csrf_token="}[follow_type].format(user_id)
-        return response.follow(url,
-                               method="POST",
-                               headers={
-                                   'Content-Type': "application/x-www-form-urlencoded"},
-                               body=urlencode(common.nem.encrypt(
-                                   {"userId": str(user_id), "offset": str(
-                                       offset), "total": "false", "limit": str(limit), "csrf_token": ""}
-                               )),
-                               callback=self.parse_follow,
-                               meta={'filter_user_id': user_id,
-                                     'follow_user_id': user_id,
-                                     'follow_offset': offset,
-                                     'follow_limit': limit,
-                                     'follow_type': follow_type},
-                               priority=10)
+        if limit is None:
+            limit = self.follow_limit(follow_type)
+        meta = {'filter_user_id': user_id,
+                'follow_user_id': user_id,
+                'follow_offset': offset,
+                'follow_limit': limit,
+                'follow_type': follow_type}
+        if stride and stride != limit:
+            meta['follow_stride'] = stride
+        if total is not None:
+            meta['follow_total'] = total
+        if offset > 0:
+            meta['do_not_filter'] = True
+        # the first page tells the total when fanning out
+        ask_total = offset == 0 and self.settings.getint('FOLLOW_FANOUT') > 1
+        return self.weapi_request(response,
+                                  url,
+                                  {"userId": str(user_id), "offset": str(
+                                      offset), "total": "true" if ask_total else "false", "limit": str(limit),
+                                   "csrf_token": ""},
+                                  callback=self.parse_follow,
+                                  meta=meta,
+                                  priority=self.FOLLOW_PRIORITY if priority is None else priority)
+
+    @property
+    def compact_frontier(self):
+        """Whether to queue user-centric requests as `FrontierRecord`s, see `FRONTIER_COMPACT`."""
+        return self.settings.getbool('FRONTIER_COMPACT')
+
+    # keys in `meta` that `request_from_frontier` restores
+    FRONTIER_META_KEYS = frozenset(['filter_user_id', 'user_profile', 'follow_user_id', 'follow_offset',
+                                    'follow_limit', 'follow_stride', 'follow_total', 'follow_type', 'weapi_params',
+                                    'as_present', 'do_not_filter', 'depth'])
+
+    def frontier_record(self, request):
+        """Return the `FrontierRecord` that `request` can be rebuilt from, or `None` if it has to be kept as is.
+
+        Profiles are stored when users are found in compact mode, so the `user_profile` in `meta` only has the ID.
+        """
+        if not self.compact_frontier or request.body or request.dont_filter \
+                or not self.FRONTIER_META_KEYS.issuperset(request.meta):
+            return None
+        up = request.meta.get('user_profile')
+        if up is not None and set(up.keys()) != {'id'}:
+            return None
+        if request.callback == self.parse_playlists:
+            record = FrontierRecord(up['id'], FrontierRecord.PLAYLISTS)
+        elif request.callback == self.parse_favorite_songs:
+            playlist_id = parse_qs(urlsplit(request.url).query)['id'][0]
+            record = FrontierRecord(up['id'], FrontierRecord.FAVORITES, int(playlist_id))
+        elif request.callback == self.parse_follow:
+            kind = {'following': FrontierRecord.FOLLOWING,
+                    'followers': FrontierRecord.FOLLOWERS}[request.meta['follow_type']]
+            record = FrontierRecord(int(request.meta['follow_user_id']), kind,
+                                    request.meta['follow_offset'], request.meta['follow_limit'],
+                                    stride=request.meta.get('follow_stride', 0),
+                                    total=request.meta.get('follow_total', 0))
+        else:
+            return None
+        record.priority = request.priority
+        record.depth = request.meta.get('depth', 0)
+        return record
+
+    def request_from_frontier(self, record):
+        """Rebuild the request `record` is made from by `frontier_record`."""
+        if record.kind == FrontierRecord.PLAYLISTS:
+            request = self.request_playlists(None, UserProfile(id=record.user_id))
+        elif record.kind == FrontierRecord.FAVORITES:
+            request = self.request_favorite_songs(None, UserProfile(id=record.user_id), record.offset)
+        else:
+            follow_type = {FrontierRecord.FOLLOWING: 'following',
+                           FrontierRecord.FOLLOWERS: 'followers'}[record.kind]
+            request = self.request_follow(follow_type, None, record.user_id, record.offset, record.limit,
+                                          record.stride or None, total=record.total or None)
+        request.priority = record.priority
+        if record.depth:
+            request.meta['depth'] = record.depth
+        return request
+
+    # Requests `parse_follow` makes for a user, which `NemUserIDFilter` drops all if the user has been crawled.
+    REQUESTS_PER_FOLLOWER = 3
+    # Pages cut at the same size in a row before the page size is pinned at it, see `update_follow_limit`
+    FOLLOW_LIMIT_PIN_PAGES = 3
+    # How fast `follow_new_ratios` follows the pages parsed
+    FOLLOW_NEW_RATIO_WEIGHT = 0.05
+    # Users that `follow_new_ratios` weighs as in the share of new users expected around a user, see `follow_priority`
+    FOLLOW_NEW_RATIO_PRIOR = 10
+
+    @property
+    def user_id_filter(self):
+        """The `NemUserIDFilter` of the scheduler if it is in use, or `None`.
+
+        `NemUserIDFilter.from_crawler` registers itself on the crawler.
+        """
+        return getattr(self.crawler, 'user_id_filter', None)
+
+    def filter_crawled_users(self, profiles, found=False):
+        """Drop users that have been crawled in one batch, before requests for them are built and encrypted.
+
+        The requests skipped are counted as filtered by the dupefilter as well, as if they had reached it. With `found`,
+        users found on an earlier follow page of this run are dropped as well, their requests being queued already.
+        """
+        if not profiles or not self.settings.getbool('FOLLOW_PREFILTER', True):
+            return profiles
+        df = self.user_id_filter
+        if df is None:
+            return profiles
+        user_ids = [up['id'] for up in profiles]
+        seen = df.users_seen(user_ids)
+        if found:
+            queued = [found and not seen for found, seen in zip(df.users_found(user_ids), seen)]
+            seen = [seen or queued for seen, queued in zip(seen, queued)]
+        unseen = [up for up, seen in zip(profiles, seen) if not seen]
+        seen_count = len(profiles) - len(unseen)
+        stats = self.crawler.stats
+        if found and any(queued):
+            stats.inc_value('user/prefilter/queued', sum(queued), spider=self)
+            seen_count -= sum(queued)
+        if seen_count:
+            stats.inc_value('user/prefilter/seen', seen_count, spider=self)
+            stats.inc_value('user/prefilter/skipped', seen_count * self.REQUESTS_PER_FOLLOWER, spider=self)
+            stats.inc_value('dupefilter/NemUserIDFilter/filtered', seen_count * self.REQUESTS_PER_FOLLOWER,
+                            spider=self)
+        return unseen
+
+    @property
+    def follow_new_ratios(self):
+        """Running share of new users on the pages of each follow type, starting from an even 0.5."""
+        try:
+            return self._follow_new_ratios
+        except AttributeError:
+            self._follow_new_ratios = {"following": 0.5, "followers": 0.5}
+            return self._follow_new_ratios
+
+    def update_follow_new_ratio(self, follow_type, new, count):
+        """Move the running share of new users of `follow_type` towards `new` of `count` users on a page."""
+        if count:
+            ratios = self.follow_new_ratios
+            ratios[follow_type] += (new / count - ratios[follow_type]) * self.FOLLOW_NEW_RATIO_WEIGHT
+
+    def follow_priority(self, follow_type, degree, new=0, count=0):
+        """Rank the first page of `degree` users of `follow_type` of a user by the new users expected from it: as many
+        users as fit in a page, times the share of new users around the user.
+
+        The share is that of the `new` users of `count` on the page the user was found on, as neighbors in the graph
+        tend to have been crawled alike, smoothed towards the running share of new users on pages of `follow_type` as
+        if `FOLLOW_NEW_RATIO_PRIOR` more users were on the page.
+
+        `None` if `degree` is 0, the page not worth a request. The priority stays within 9 of `FOLLOW_PRIORITY`, below
+        that of requests completing users found before.
+        """
+        if degree is None:
+            return self.FOLLOW_PRIORITY
+        if degree <= 0:
+            return None
+        prior = self.FOLLOW_NEW_RATIO_PRIOR
+        ratio = (new + prior * self.follow_new_ratios[follow_type]) / (count + prior)
+        expected = min(degree, self.follow_limit(follow_type)) * ratio
+        return self.FOLLOW_PRIORITY + max(-9, min(9, int(math.log2(1 + expected)) - 4))
+
+    def closed(self, reason):
+        stats = self.crawler.stats
+        requests = stats.get_value('downloader/request_count')
+        if requests and stats.get_value('user/follow/new'):
+            stats.set_value('user/follow/new_per_request', stats.get_value('user/follow/new') / requests, spider=self)
 
     def parse_followers(self, response):
         """Only existing for backward compatibility. Use `request_follow` instead."""
@@ -161,43 +382,162 @@ for each follower |    |parse_favorite_songs|
         yield from self.parse_follow(response)
 
     def parse_follow(self, response):
-        d = json.loads(response.body.decode("utf-8"))
         # 'followeds' for `request_followers`, `follow` for `request_following`
         follow_type = response.meta.get("follow_type")
         key_in_data = {'followers': "followeds",
                        'following': 'follow'}[follow_type]
-        for follower in d[key_in_data]:
-            try:
-                up = UserProfile(
-                    id=int(follower['userId']),
-                    name=follower['nickname'],
-                    avatar_url=follower['avatarUrl'],
-                    description=follower['signature']
-                )
-                yield self.request_playlists(response, up)
+        page = nem_json.follow_page(response.body, key_in_data)
+        if len(page.users) < page.count:
+            self.log("Error when parsing followers, {} of {} lacking fields.".format(
+                page.count - len(page.users), page.count), logging.WARNING)
+        profiles = []
+        degrees = {}  # user ID -> numbers of following and followers, as given along with users by the API
+        for user in page.users:
+            profiles.append(UserProfile(id=user.id, name=user.name, avatar_url=user.avatar_url,
+                                        description=user.description))
+            degrees[user.id] = {'following': user.following, 'followers': user.followers}
+        if self.edge_log is not None:
+            self.edge_log.append_follows(int(response.meta.get("follow_user_id")), follow_type,
+                                         [up['id'] for up in profiles])
+        prioritize = self.settings.getbool('FOLLOW_PRIORITIZE') and self.user_id_filter is not None
+        # ranked pages find users long before they are crawled, so those found before are dropped as well
+        unseen = self.filter_crawled_users(profiles, found=prioritize)
+        if prioritize:
+            self.update_follow_new_ratio(follow_type, len(unseen), len(profiles))
+        for up in unseen:
+            if self.compact_frontier:
+                yield up
+                up = UserProfile(id=up['id'])
+            yield self.request_playlists(response, up)
+            if prioritize:
+                for type_ in ["following", "followers"]:
+                    priority = self.follow_priority(type_, degrees[up['id']][type_], len(unseen), len(profiles))
+                    if priority is not None:
+                        yield self.request_follow(type_, response, up['id'], priority=priority)
+            else:
                 yield from self.request_follows(response, up['id'])
-            except KeyError as e:
-                self.log("Error when parsing followers, error {}.".format(
-                    e), logging.WARNING)
 
-        if len(d[key_in_data]) == response.meta.get("followers_limit") and d['more'] is False:
+        if page.count == response.meta.get("follow_limit") and page.more is False:
             # This may happen when NEM change the restrict on their API.
             self.logger.warn(
                 "The number of fetched following/ers does match against the given page size.")
 
         user_id = response.meta.get("follow_user_id")
-        offset = len(d[key_in_data]) or response.meta.get("follow_offset")
+        offset = response.meta.get("follow_offset")
         limit = response.meta.get("follow_limit")
         assert not (user_id is None or offset is None or limit is None)
-        if d['more'] is True:
+        stride = response.meta.get("follow_stride") or limit
+        total = response.meta.get("follow_total")
+        priority = getattr(response.request, 'priority', None)  # of the first page, to carry on with
+        count = page.count
+        self.update_follow_limit(follow_type, limit, count, page.more is True)
+        gap = response.meta.get('follow_gap')
+        if page.more is True and 0 < count < limit:
+            if not gap and (stride == limit or (total is not None and offset + limit >= total)):
+                # The page was truncated by the API, carry on right after it in pages of what is honored. So does the
+                # last page of a chain, walking on past `total` if there are more users than told.
+                limit = stride = count
+                total = None
+            else:
+                # The same, but the next page of the chain is fixed, or the gap page ends where another page starts,
+                # so fill the gap left in pages of what is honored.
+                for gap_offset in range(offset + count, offset + limit, count):
+                    request = self.request_follow(follow_type, response, user_id, gap_offset,
+                                                  min(count, offset + limit - gap_offset), priority=priority)
+                    request.meta['follow_gap'] = True
+                    yield request
+        if gap:
+            return
+        if page.more is True:
             self.log("Fetched {number} {follow_type} of {user_id}".format(number=limit,
                                                                           follow_type=follow_type,
                                                                           user_id=user_id),
                      logging.DEBUG)
-            yield self.request_follow(follow_type, response, user_id, offset + limit, limit)
+            fanout = self.settings.getint('FOLLOW_FANOUT')
+            if offset == 0 and fanout > 1 and page.total is not None and page.total > limit:
+                yield from self.fan_out_follow(follow_type, response, user_id, limit, page.total, fanout, priority)
+            elif total is None or offset + stride < total:
+                # Also when `total` disagrees with `more`, then pages are walked through until `more` is false.
+                yield self.request_follow(follow_type, response, user_id, offset + stride, limit, stride, priority,
+                                          total)
+            elif offset + limit >= total:
+                # The last page before `total`, while there are more users than told, so walk on one page at a time.
+                yield self.request_follow(follow_type, response, user_id, offset + limit, limit, priority=priority)
+            # else the pages up to `total` left are requested by the other chains
         else:
             self.log("Finished iterating the {} of user ({}), {} total".format(
                 follow_type,
                 user_id,
-                offset + len(d[key_in_data])),
+                offset + page.count),
                 logging.DEBUG)
+
+    @property
+    def follow_limits(self):
+        """Page sizes probed for each follow type, as `{'limit': current, 'ceiling': smallest one not honored,
+        'capped': (size, pages in a row cut at it)}`.
+
+        Kept in `state`, which `SpiderState` persists in `JOBDIR`.
+        """
+        try:
+            return self._follow_limits
+        except AttributeError:
+            state = getattr(self, 'state', None)
+            limits = state.setdefault('follow_limits', {}) if state is not None else {}
+            for follow_type in ("following", "followers"):
+                limits.setdefault(follow_type, {'limit': self.settings.getint('FOLLOW_PAGE_LIMIT', 100),
+                                                'ceiling': None, 'capped': None})
+            self._follow_limits = limits
+            return limits
+
+    def follow_limit(self, follow_type):
+        """The page size to request `follow_type` with."""
+        return self.follow_limits[follow_type]['limit']
+
+    def update_follow_limit(self, follow_type, limit, count, more):
+        """Probe a larger page size while pages of `limit` are honored, up to `FOLLOW_PAGE_LIMIT_MAX`.
+
+        A page with `more` but fewer than `limit` users tells that the API may cap pages at `count`. Once
+        `FOLLOW_LIMIT_PIN_PAGES` pages in a row are cut at the same `count`, the page size is pinned at it, never
+        probing past it again. A single short page, e.g. missing deleted users, is not taken for a cap.
+        """
+        if not more or count <= 0:
+            return
+        entry = self.follow_limits[follow_type]
+        if count < limit:
+            if entry['ceiling'] is None or entry['ceiling'] > count + 1:
+                capped, pages = entry.get('capped') or (None, 0)
+                pages = pages + 1 if capped == count else 1
+                entry['capped'] = (count, pages)
+                if pages >= self.FOLLOW_LIMIT_PIN_PAGES:
+                    self.logger.info("Pages of %s seem to be capped at %d, pinning the page size from %d",
+                                     follow_type, count, entry['limit'])
+                    entry['limit'], entry['ceiling'], entry['capped'] = count, count + 1, None
+                    self.crawler.stats.inc_value('user/follow/limit_backoff', spider=self)
+        else:
+            if entry.get('capped') and entry['capped'][0] < count:
+                entry['capped'] = None  # not a cap after all
+            if limit >= entry['limit']:
+                max_limit = (self.settings.getint('FOLLOW_PAGE_LIMIT_MAX')
+                             or self.settings.getint('FOLLOW_PAGE_LIMIT', 100))
+                if entry['ceiling'] is not None:
+                    max_limit = min(max_limit, entry['ceiling'] - 1)
+                probe = min(limit * 2, max_limit)
+                if probe > entry['limit']:
+                    self.logger.debug("Pages of %d %s are honored, probing %d", limit, follow_type, probe)
+                    entry['limit'] = probe
+        self.crawler.stats.set_value('user/follow/limit/{}'.format(follow_type), entry['limit'], spider=self)
+
+    def fan_out_follow(self, follow_type, response, user_id, limit, total, fanout, priority=None):
+        """Request the pages after the first at once, in at most `fanout` interleaved chains.
+
+        Chain `k` requests pages `k`, `k + n`, `k + 2n`... for `n` chains, each page requesting the next in its chain
+        as long as `more` is true and the next page starts before `total`. So at most `fanout` pages of a user are in
+        flight, and no page past `total` is requested, but by the last page before it, which walks on one page at a
+        time if `more` is still true, as `total` is too small then. A `total` too large costs at most one empty page
+        per chain.
+        """
+        offsets = range(limit, total, limit)
+        chains = min(fanout, len(offsets))
+        self.crawler.stats.inc_value('user/follow/fanned_out', spider=self)
+        for offset in offsets[:chains]:
+            yield self.request_follow(follow_type, response, user_id, offset, limit, chains * limit, priority, total)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import os
+import pickle
+
+from queuelib import queue
+from scrapy.utils.request import request_from_dict
+
+from .common.frontier import FrontierRecord
+
+
+class CompactLifoDiskQueue(queue.LifoDiskQueue):
+    """LIFO disk queue storing user-centric requests as packed `FrontierRecord`s, others pickled.
+
+    The spider decides which requests are compact by `frontier_record(request)` and rebuilds them by
+    `request_from_frontier(record)`. Use it as `SCHEDULER_DISK_QUEUE`.
+    """
+
+    def __init__(self, crawler, key):
+        self.spider = crawler.spider
+        dirname = os.path.dirname(key)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        super().__init__(key)
+
+    @classmethod
+    def from_crawler(cls, crawler, key, *args, **kwargs):
+        return cls(crawler, key)
+
+    def encode(self, request):
+        frontier_record = getattr(self.spider, 'frontier_record', None)
+        record = frontier_record(request) if frontier_record is not None else None
+        if record is not None:
+            return record.pack()
+        return pickle.dumps(request.to_dict(spider=self.spider), protocol=4)
+
+    def decode(self, data):
+        if FrontierRecord.is_packed(data):
+            return self.spider.request_from_frontier(FrontierRecord.unpack(data))
+        return request_from_dict(pickle.loads(data), spider=self.spider)
+
+    def push(self, request):
+        super().push(self.encode(request))
+
+    def pop(self):
+        data = super().pop()
+        return self.decode(data) if data else None
+
+    def peek(self):
+        data = super().peek()
+        return self.decode(data) if data else None
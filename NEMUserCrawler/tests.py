@@ -0,0 +1,1163 @@
+#!/usr/bin/env python3
+"""Tests of the spider, pipelines, middlewares and commands, with fake responses and stub collections.
+
+    python -m pytest NEMUserCrawler/tests.py  # from the project directory
+
+The primitives in `common` are tested in `common/tests.py`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+from aiohttp.test_utils import TestClient, TestServer
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from scrapy.http import HtmlResponse, Request, TextResponse
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, task, threads
+
+from . import httpcache, settings as project_settings
+from .commands import build_follow_graph, pack_ids as pack_ids_command
+from .commands.export_csr import CSRExporter
+from .common import nem_crypto
+from .common.edge_log import FOLLOWERS, FOLLOWING, read_edges
+from .common.id_list import pack_ids, unpack_ids
+from .common.segment_store import SegmentStore
+from .common.frontier import FrontierRecord
+from .dupefilter import NemUserIDFilter
+from .httpcache import EndpointTTLCacheStorage, WeAPIRequestFingerprinter
+from .items import Song, SongBatch, UserProfile
+from .middlewares import WeAPIEncryptionMiddleware
+from .mock_server import USER_ID_BASE, MockNEMServer, SyntheticGraph
+from .pipelines import LocalStorePipeline, SongUsersIndexPipeline, TxMongoPipeline
+from .spiders.user import UserSpider
+
+PROJECT_SETTINGS = {name: getattr(project_settings, name) for name in dir(project_settings) if name.isupper()}
+
+
+def make_spider(**settings):
+    """A `UserSpider` of the project settings updated by `settings`, with no `JOBDIR` and no scheduler unless
+    `dupefilter` is given."""
+    dupefilter = settings.pop('dupefilter', None)
+    settings = dict(PROJECT_SETTINGS, JOBDIR=None, LOG_ENABLED=False, TWISTED_REACTOR=None, **settings)
+    crawler = get_crawler(UserSpider, settings)
+    spider = crawler.spider = UserSpider.from_crawler(crawler)
+    if dupefilter is not None:
+        crawler.user_id_filter = dupefilter
+    crawler.stats.open_spider(spider)
+    return spider
+
+
+def weapi_params(request, key_pool_seed, key_pool_size):
+    """Decrypt the body of a weapi `request` encrypted with seeded keys."""
+    keys = {nem_crypto.enc_sec_key_of(key): key for key in nem_crypto.seeded_keys(key_pool_seed, key_pool_size)}
+    form = dict(parse_qsl(request.body.decode("ascii")))
+    return nem_crypto.decrypt(form['params'], keys[form['encSecKey']])
+
+
+class StubCollection(object):
+    """A collection of `StubDatabase` logging writes, which return `Deferred`s fired by `StubDatabase.finish` unless
+    writes are `immediate`."""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def bulk_write(self, operations, ordered=True):
+        self.db.writes.append((self.name, operations))
+        return self.result()
+
+    def update_one(self, filter, update, upsert=False):
+        self.db.updates.append((self.name, filter, update))
+        return self.result()
+
+    def result(self):
+        if self.db.immediate:
+            return defer.succeed(types.SimpleNamespace(bulk_api_result={}))
+        d = defer.Deferred()
+        self.db.pending.append(d)
+        return d
+
+
+class StubDatabase(dict):
+    def __init__(self, immediate=True):
+        super().__init__()
+        self.immediate = immediate
+        self.writes = []
+        self.updates = []
+        self.pending = []
+
+    def __missing__(self, name):
+        return StubCollection(self, name)
+
+    def finish(self, failure=None):
+        """Fire the oldest pending write, with `failure` if given."""
+        d = self.pending.pop(0)
+        if failure is None:
+            d.callback(types.SimpleNamespace(bulk_api_result={}))
+        else:
+            d.errback(failure)
+
+
+def make_pipeline(pipeline_class=TxMongoPipeline, immediate=True, **kwargs):
+    spider = make_spider()
+    pipeline = pipeline_class("mongodb://localhost:27017", "nem", stats=spider.crawler.stats, **kwargs)
+    pipeline.db = StubDatabase(immediate)
+    return pipeline, spider
+
+
+def result_of(d):
+    """The result of a `Deferred` fired already."""
+    results = []
+    d.addBoth(results.append)
+    assert results, "{!r} has not fired".format(d)
+    return results[0]
+
+
+class WeAPIEncryptionMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=True, NEM_KEY_POOL_SIZE=4)
+        self.spider.key_pool = nem_crypto.KeyPool(4, keys=nem_crypto.seeded_keys(1, 4))
+        self.middleware = WeAPIEncryptionMiddleware()
+
+    def test_deferred_request(self):
+        request = self.spider.request_follow("followers", None, 123, offset=100, limit=50)
+        self.assertEqual(request.body, b"")
+        self.assertEqual(request.meta['weapi_params']['userId'], "123")
+        self.assertIsNone(self.middleware.process_request(request, self.spider))
+        self.assertEqual(weapi_params(request, 1, 4), request.meta['weapi_params'])
+        self.assertEqual(request.method, "POST")
+
+    def test_encrypted_once(self):
+        request = self.spider.request_follow("following", None, 123)
+        self.middleware.process_request(request, self.spider)
+        body = request.body
+        self.middleware.process_request(request, self.spider)  # e.g. retried
+        self.assertEqual(request.body, body)
+
+    def test_left_alone(self):
+        requests = [Request("http://music.163.com/playlist?id=1", meta={'weapi_params': {'id': 1}}),
+                    Request("http://example.com/weapi/user/playlist", method="POST", meta={'weapi_params': {}}),
+                    Request("http://music.163.com/weapi/user/playlist", method="POST", body="params=x&encSecKey=y",
+                            meta={'weapi_params': {}}),
+                    Request("http://music.163.com/weapi/user/playlist", method="POST")]
+        for request in requests:
+            body = request.body
+            self.assertIsNone(self.middleware.process_request(request, self.spider))
+            self.assertEqual(request.body, body)
+
+    def test_without_key_pool(self):
+        request = self.spider.request_playlists(None, {'id': 123})
+        self.middleware.process_request(request, types.SimpleNamespace())
+        form = dict(parse_qsl(request.body.decode("ascii")))
+        self.assertEqual(set(form), {'params', 'encSecKey'})
+
+    def test_not_deferred(self):
+        spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=False, NEM_KEY_POOL_SIZE=0)
+        request = spider.request_playlists(None, {'id': 123})
+        self.assertNotIn('weapi_params', request.meta)
+        self.assertTrue(request.body.startswith(b"params="))
+
+
+class FrontierTest(unittest.TestCase):
+    def setUp(self):
+        self.spider = make_spider(FRONTIER_COMPACT=True, NEM_DEFER_WEAPI_ENCRYPTION=True)
+
+    def assertSameRequest(self, request, rebuilt):
+        for attribute in ("url", "method", "body", "callback", "priority", "meta"):
+            self.assertEqual(getattr(rebuilt, attribute), getattr(request, attribute), attribute)
+
+    def test_round_trip(self):
+        spider = self.spider
+        requests = [spider.request_playlists(None, UserProfile(id=1234567890)),
+                    spider.request_favorite_songs(None, UserProfile(id=1234567890), 987654321),
+                    spider.request_follow("followers", None, 1234567890),
+                    spider.request_follow("following", None, 1234567890, offset=300, limit=100, stride=800,
+                                          priority=13, total=2345)]
+        for depth, request in enumerate(requests, 1):
+            with self.subTest(request=request):
+                request.meta['depth'] = depth * 7
+                record = spider.frontier_record(request)
+                self.assertIsNotNone(record)
+                rebuilt = spider.request_from_frontier(FrontierRecord.unpack(record.pack()))
+                self.assertSameRequest(request, rebuilt)
+
+    def test_kept_as_is(self):
+        spider = self.spider
+        full_profile = spider.request_playlists(None, UserProfile(id=1, name="n", avatar_url="a", description="d"))
+        gap = spider.request_follow("followers", None, 1, offset=100, limit=20)
+        gap.meta['follow_gap'] = True
+        for request in [full_profile, gap, Request("http://music.163.com/discover", callback=spider.parse)]:
+            self.assertIsNone(spider.frontier_record(request))
+        self.assertIsNone(make_spider(FRONTIER_COMPACT=False).frontier_record(
+            spider.request_playlists(None, UserProfile(id=1))))
+
+    def test_size(self):
+        spider = self.spider
+        profile = UserProfile(id=1234567890, name="某个用户的昵称",
+                              avatar_url="http://p1.music.126.net/AbCdEfGhIjKlMnOpQrStUv==/109951163000000000.jpg",
+                              description="这个人很懒，什么都没有留下。" * 3)
+        for request in (spider.request_follow("followers", None, 1234567890),
+                        spider.request_playlists(None, UserProfile(id=1234567890))):
+            request.meta['depth'] = 3
+            record = spider.frontier_record(request)
+            if 'user_profile' in request.meta:  # as queued without `FRONTIER_COMPACT`
+                request.meta['user_profile'] = profile
+            pickled = len(pickle.dumps(request.to_dict(spider=spider), protocol=4))
+            print("{}: bytes per queued request: {} pickled, {} packed".format(self.id(), pickled, len(record.pack())))
+            self.assertLess(len(record.pack()) * 10, pickled)
+
+def follow_response(request, users, cap=None, total=None, degree=1):
+    """A fake response to a follow `request` (with deferred encryption) of a user followed by `users` users, at most
+    `cap(offset)` per page, telling `total` (`users` by default) when asked to. The users listed have `degree` followers
+    and following each."""
+    params = request.meta['weapi_params']
+    offset, limit = int(params['offset']), int(params['limit'])
+    if cap is not None:
+        limit = min(limit, cap(offset))
+    ids = range(offset, min(offset + limit, users))
+    key = {'followers': "followeds", 'following': "follow"}[request.meta['follow_type']]
+    d = {'code': 200, key: [{'userId': 10**6 + i, 'nickname': "u{}".format(i), 'avatarUrl': "", 'signature': "",
+                             'follows': degree, 'followeds': degree} for i in ids],
+         'more': offset + limit < users}
+    if params['total'] == "true":
+        d['total'] = users if total is None else total
+    return TextResponse(request.url, body=json.dumps(d).encode(), request=request)
+
+
+class ParseFollowTest(unittest.TestCase):
+    USER_ID = 42
+
+    def setUp(self, **settings):
+        self.spider = make_spider(**dict(dict(NEM_DEFER_WEAPI_ENCRYPTION=True, FOLLOW_FANOUT=4, FOLLOW_PAGE_LIMIT=10,
+                                              FOLLOW_PAGE_LIMIT_MAX=10), **settings))
+
+    def crawl(self, users, **kwargs):
+        """Walk through the followers of a user, and return the offsets of the pages requested, and the users found
+        in the order found."""
+        pending = [self.spider.request_follow("followers", None, self.USER_ID)]
+        offsets, found = [], []
+        while pending:
+            request = pending.pop()
+            offsets.append(request.meta['follow_offset'])
+            for output in self.spider.parse_follow(follow_response(request, users, **kwargs)):
+                if isinstance(output, Request) and output.callback == self.spider.parse_follow:
+                    if output.meta['follow_user_id'] == self.USER_ID:
+                        pending.append(output)
+                    else:
+                        found.append(output.meta['follow_user_id'])
+        return sorted(offsets), found[::2]  # both following and followers are requested for each user found
+
+    def assertAllFound(self, found, users):
+        self.assertEqual(sorted(found), [10**6 + i for i in range(users)])
+
+    def test_exact_total(self):
+        offsets, found = self.crawl(95)
+        self.assertAllFound(found, 95)
+        self.assertEqual(offsets, list(range(0, 100, 10)))
+
+    def test_total_too_small(self):
+        offsets, found = self.crawl(95, total=40)
+        self.assertAllFound(found, 95)
+        self.assertEqual(offsets, list(range(0, 100, 10)))
+
+    def test_total_too_large(self):
+        offsets, found = self.crawl(35, total=95)
+        self.assertAllFound(found, 35)
+        # at most one empty page per chain
+        self.assertEqual(offsets, [0, 10, 20, 30, 40, 50, 60])
+
+    def test_sequential(self):
+        self.setUp(FOLLOW_FANOUT=1)
+        offsets, found = self.crawl(95)
+        self.assertAllFound(found, 95)
+        self.assertEqual(offsets, list(range(0, 100, 10)))
+
+    def test_truncated_in_chain(self):
+        # pages after the 4th are capped at 4 users
+        offsets, found = self.crawl(95, cap=lambda offset: 10 if offset < 40 else 4)
+        self.assertAllFound(found, 95)
+        self.assertEqual(len(offsets), len(set(offsets)))
+
+    def test_truncated_gap(self):
+        # the first page of each chain after the 4th page is truncated, and so are the gaps left by it
+        offsets, found = self.crawl(95, cap=lambda offset: 10 if offset < 40 else max(1, 7 - offset % 10))
+        self.assertAllFound(found, 95)
+        self.assertEqual(len(offsets), len(set(offsets)))
+
+    def test_truncated_first_page(self):
+        offsets, found = self.crawl(95, cap=lambda offset: 8)
+        self.assertAllFound(found, 95)
+        self.assertEqual(offsets, list(range(0, 96, 8)))
+
+    def test_truncated_last_page(self):
+        offsets, found = self.crawl(95, total=85, cap=lambda offset: 10 if offset < 80 else 3)
+        self.assertAllFound(found, 95)
+        self.assertEqual(offsets, list(range(0, 80, 10)) + list(range(80, 95, 3)))
+
+
+class FollowLimitTest(unittest.TestCase):
+    def honor(self, spider, pages, cap=None):
+        """Feed `update_follow_limit` with `pages` pages of followers requested with the page size probed, of which
+        at most `cap` users are returned, and return the page sizes requested."""
+        limits = []
+        for _ in range(pages):
+            limit = spider.follow_limit("followers")
+            limits.append(limit)
+            spider.update_follow_limit("followers", limit, min(limit, cap or limit), True)
+        return limits
+
+    def test_no_probing(self):
+        spider = make_spider(FOLLOW_PAGE_LIMIT=100)
+        self.assertEqual(self.honor(spider, 3), [100, 100, 100])
+
+    def test_probing(self):
+        spider = make_spider(FOLLOW_PAGE_LIMIT=10, FOLLOW_PAGE_LIMIT_MAX=100)
+        self.assertEqual(self.honor(spider, 6), [10, 20, 40, 80, 100, 100])
+        self.assertEqual(spider.follow_limit("following"), 10)
+        # a page of a size smaller than probed since does not hold probing back
+        spider.update_follow_limit("followers", 10, 10, True)
+        spider.update_follow_limit("followers", 40, 3, False)  # the last page
+        self.assertEqual(spider.follow_limit("followers"), 100)
+
+    def test_backoff(self):
+        spider = make_spider(FOLLOW_PAGE_LIMIT=10, FOLLOW_PAGE_LIMIT_MAX=1000)
+        # pinned once 3 pages in a row are cut at the same size
+        self.assertEqual(self.honor(spider, 8, cap=60), [10, 20, 40, 80, 80, 80, 60, 60])
+        self.assertEqual(spider.follow_limits["followers"]['ceiling'], 61)
+        self.assertEqual(spider.crawler.stats.get_value('user/follow/limit_backoff'), 1)
+        # a page requested before the back-off
+        spider.update_follow_limit("followers", 40, 40, True)
+        self.assertEqual(spider.follow_limit("followers"), 60)
+        # capped lower since
+        self.assertEqual(self.honor(spider, 5, cap=25), [60, 60, 60, 25, 25])
+
+    def test_short_pages(self):
+        spider = make_spider(FOLLOW_PAGE_LIMIT=100, FOLLOW_PAGE_LIMIT_MAX=1000)
+        # pages missing a few users, e.g. deleted ones, at different sizes
+        for count in [3, 3, 97]:
+            spider.update_follow_limit("followers", 100, count, True)
+        spider.update_follow_limit("followers", 100, 3, True)
+        self.assertEqual(spider.follow_limit("followers"), 100)
+        # a page honored in between
+        spider.update_follow_limit("followers", 100, 3, True)
+        spider.update_follow_limit("followers", 100, 100, True)
+        spider.update_follow_limit("followers", 100, 3, True)
+        self.assertEqual(self.honor(spider, 4), [200, 400, 800, 1000])
+        self.assertIsNone(spider.follow_limits["followers"]['ceiling'])
+
+
+class FollowPriorityTest(unittest.TestCase):
+    def setUp(self):
+        self.dupefilter = NemUserIDFilter()
+        self.spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=True, FOLLOW_PRIORITIZE=True, FOLLOW_PAGE_LIMIT=20,
+                                  dupefilter=self.dupefilter)
+        self.dupefilter.stats = self.spider.crawler.stats
+
+    def found(self, user_id, users):
+        """Parse a page of `users` followers of `user_id`, and return the users requested playlists for."""
+        response = follow_response(self.spider.request_follow("followers", None, user_id), users)
+        return [output.meta['filter_user_id'] for output in self.spider.parse_follow(response)
+                if isinstance(output, Request) and output.callback == self.spider.parse_playlists]
+
+    def test_found_once(self):
+        self.assertEqual(len(self.found(1, 10)), 10)
+        # the first 10 are queued already
+        self.assertEqual(self.found(2, 15), [10**6 + i for i in range(10, 15)])
+        self.assertEqual(self.spider.crawler.stats.get_value('user/prefilter/queued'), 10)
+
+    def test_new_counted_once(self):
+        request = self.spider.request_favorite_songs(None, UserProfile(id=7), 70)
+        self.assertFalse(self.dupefilter.request_seen(request))
+        self.assertTrue(self.dupefilter.request_seen(request))
+        self.assertEqual(self.spider.crawler.stats.get_value('user/follow/new'), 1)
+
+    def test_priority(self):
+        priority = self.spider.follow_priority
+        self.assertIsNone(priority("followers", 0))
+        self.assertEqual(priority("followers", None), self.spider.FOLLOW_PRIORITY)
+        # no more than a page is expected of a request
+        self.assertEqual(priority("followers", 10**6), priority("followers", 20))
+        self.assertGreater(priority("followers", 20), priority("followers", 2))
+        for _ in range(50):  # pages of following found nothing new
+            self.spider.update_follow_new_ratio("following", 0, 100)
+        self.assertGreater(priority("followers", 20), priority("following", 20))
+        # users found among new users rank above those found among users crawled before
+        self.assertGreater(priority("followers", 20, 20, 20), priority("followers", 20, 0, 20))
+        self.assertGreater(priority("following", 20, 20, 20), priority("following", 20))
+
+    def test_neighborhood(self):
+        """Users found on a page of new users are requested ahead of those on a page of users crawled before."""
+        def priorities(user_id, offset):
+            request = self.spider.request_follow("followers", None, user_id, offset=offset, limit=20)
+            return {output.priority for output in self.spider.parse_follow(follow_response(request, 40, degree=20))
+                    if isinstance(output, Request) and output.callback == self.spider.parse_follow}
+
+        new = priorities(1, 0)
+        for i in range(20, 35):
+            self.dupefilter.request_seen(crawled(10**6 + i))
+        mostly_crawled = priorities(2, 20)
+        self.assertEqual(len(new), 1)
+        self.assertEqual(len(mostly_crawled), 1)
+        self.assertGreater(new.pop(), mostly_crawled.pop())
+
+    def test_registered(self):
+        crawler = get_crawler(UserSpider, dict(PROJECT_SETTINGS, JOBDIR=None, TWISTED_REACTOR=None))
+        dupefilter = NemUserIDFilter.from_crawler(crawler)
+        spider = UserSpider.from_crawler(crawler)
+        self.assertIs(spider.user_id_filter, dupefilter)
+        self.assertIsNone(make_spider().user_id_filter)
+
+
+def crawled(user_id):
+    """A request marking `user_id` as crawled in `NemUserIDFilter`, as for favorite songs."""
+    return Request("http://music.163.com/playlist?id=1", meta={'filter_user_id': user_id, 'as_present': True})
+
+
+class DupefilterCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.compactions = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def dupefilter(self, **kwargs):
+        return NemUserIDFilter(self.dir.name, **kwargs)
+
+    def crawl(self, dupefilter, user_ids):
+        for user_id in user_ids:
+            self.assertFalse(dupefilter.request_seen(crawled(user_id)))
+
+    def assertCrawled(self, user_ids, crawled=True):
+        """Assert that a dupefilter opened anew, as after a crash, has crawled `user_ids`."""
+        self.assertEqual(list(self.dupefilter().users_seen(user_ids)), [crawled] * len(user_ids))
+
+    def defer_to_thread(self, f, *args):
+        """Stand in for `threads.deferToThread`, leaving `f` to `run_compaction`."""
+        d = defer.Deferred()
+        self.compactions.append((f, args, d))
+        return d
+
+    def run_compaction(self):
+        f, args, d = self.compactions.pop(0)
+        f(*args)
+        d.callback(None)
+
+    def test_periodic(self):
+        clock = task.Clock()
+        looping_call = task.LoopingCall
+
+        def clocked(f):
+            loop = looping_call(f)
+            loop.clock = clock
+            return loop
+        dupefilter = self.dupefilter(checkpoint_interval=60)
+        with mock.patch.object(task, 'LoopingCall', clocked):
+            dupefilter.open()
+        self.crawl(dupefilter, [1, 2, 10**9])
+        clock.advance(59)
+        self.assertFalse(os.path.exists(dupefilter.delta_path))
+        clock.advance(1)
+        self.assertCrawled([1, 2, 10**9])
+        dupefilter.checkpoint_loop.stop()
+
+    def test_id_count(self):
+        dupefilter = self.dupefilter(checkpoint_ids=3)
+        self.crawl(dupefilter, [1, 2])
+        self.assertTrue(dupefilter.request_seen(crawled(2)))  # not counted again
+        self.assertFalse(os.path.exists(dupefilter.delta_path))
+        self.crawl(dupefilter, [3])
+        self.assertEqual(dupefilter.new_id_count, 0)
+        self.assertCrawled([1, 2, 3])
+
+    def test_replay(self):
+        dupefilter = self.dupefilter()
+        self.crawl(dupefilter, [1, 2])
+        dupefilter.checkpoint()
+        os.rename(dupefilter.delta_path, dupefilter.compacting_path)  # as left by a compaction interrupted
+        self.crawl(dupefilter, [10**9 + 3])
+        dupefilter.checkpoint()
+        self.crawl(dupefilter, [4])  # never checkpointed
+        self.assertEqual(list(self.dupefilter().users_seen([1, 2, 10**9 + 3, 4])), [True, True, True, False])
+        # folded into the base file on opening
+        self.assertTrue(os.path.exists(dupefilter.file_path))
+        self.assertFalse(os.path.exists(dupefilter.compacting_path))
+        self.assertFalse(os.path.exists(dupefilter.delta_path))
+
+    def test_compaction(self):
+        dupefilter = self.dupefilter(compact_size=1)
+        with mock.patch.object(threads, 'deferToThread', self.defer_to_thread):
+            self.crawl(dupefilter, [1])
+            dupefilter.checkpoint()
+            self.assertTrue(os.path.exists(dupefilter.compacting_path))
+            self.assertFalse(os.path.exists(dupefilter.delta_path))
+            # checkpoints go to a new delta file meanwhile, without another compaction
+            self.crawl(dupefilter, [2])
+            dupefilter.checkpoint()
+            self.assertEqual(len(self.compactions), 1)
+            self.assertTrue(os.path.exists(dupefilter.delta_path))
+        self.run_compaction()
+        self.assertIsNone(dupefilter.compacting)
+        self.assertFalse(os.path.exists(dupefilter.compacting_path))
+        self.assertTrue(os.path.exists(dupefilter.delta_path))
+        self.assertCrawled([1, 2])
+
+    def test_close_while_compacting(self):
+        dupefilter = self.dupefilter(compact_size=1)
+        with mock.patch.object(threads, 'deferToThread', self.defer_to_thread):
+            self.crawl(dupefilter, [1])
+            dupefilter.checkpoint()
+        self.crawl(dupefilter, [2])
+        closed = dupefilter.close("finished")
+        self.assertIsNotNone(closed)
+        self.assertTrue(os.path.exists(dupefilter.compacting_path))  # left to the compaction
+        self.run_compaction()
+        self.assertIsNone(result_of(closed))
+        self.assertFalse(os.path.exists(dupefilter.compacting_path))
+        self.assertFalse(os.path.exists(dupefilter.delta_path))
+        self.assertCrawled([1, 2])
+
+
+class DupefilterMmapTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "crawled_user_ids")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_migrate(self):
+        dupefilter = NemUserIDFilter(self.dir.name)
+        for user_id in [1, 10**9]:
+            dupefilter.request_seen(crawled(user_id))
+        dupefilter.close("finished")
+        dupefilter = NemUserIDFilter(self.dir.name, use_mmap=True)
+        self.assertEqual(list(dupefilter.users_seen([1, 10**9, 2])), [True, True, False])
+        self.assertTrue(os.path.exists(self.path + ".mmap"))
+        self.assertTrue(os.path.exists(self.path + ".old"))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(dupefilter.request_seen(crawled(2)))
+        dupefilter.close("finished")
+        # not migrated again
+        with open(self.path + ".old", "rb") as file:
+            dump = file.read()
+        dupefilter = NemUserIDFilter(self.dir.name, use_mmap=True)
+        self.assertEqual(list(dupefilter.users_seen([1, 10**9, 2])), [True, True, True])
+        dupefilter.close("finished")
+        with open(self.path + ".old", "rb") as file:
+            self.assertEqual(file.read(), dump)
+
+    def test_reopen(self):
+        dupefilter = NemUserIDFilter(self.dir.name, use_mmap=True)
+        for user_id in [5, 10**9 + 5]:
+            self.assertFalse(dupefilter.request_seen(crawled(user_id)))
+        dupefilter.checkpoint()  # a flush of the map
+        dupefilter.close("finished")
+        dupefilter.close("finished")  # closing twice is harmless
+        self.assertFalse(os.path.exists(self.path))  # nothing dumped
+        dupefilter = NemUserIDFilter(self.dir.name, use_mmap=True)
+        self.assertTrue(dupefilter.request_seen(crawled(5)))
+        self.assertTrue(dupefilter.request_seen(crawled(10**9 + 5)))
+        self.assertFalse(dupefilter.request_seen(crawled(6)))
+        dupefilter.close("finished")
+
+
+class TxMongoPipelineBufferTest(unittest.TestCase):
+    def profile(self, user_id):
+        return UserProfile(id=user_id, name="u{}".format(user_id))
+
+    def test_size(self):
+        pipeline, spider = make_pipeline(buffer_size=3)
+        for user_id in range(1, 3):
+            result_of(pipeline.process_item(self.profile(user_id), spider))
+        self.assertEqual(pipeline.db.writes, [])
+        result_of(pipeline.process_item(self.profile(3), spider))
+        [(collection_name, operations)] = pipeline.db.writes
+        self.assertEqual(collection_name, "users")
+        self.assertEqual(operations, [UpdateOne({'_id': i}, {'$set': {'_id': i, 'name': "u{}".format(i)}}, upsert=True)
+                                      for i in range(1, 4)])
+        self.assertEqual((pipeline.buffer, pipeline.buffer_count), ({}, 0))
+        self.assertEqual(spider.crawler.stats.get_value('txmongo/flush/operations'), 3)
+
+    def test_age(self):
+        pipeline, spider = make_pipeline(buffer_size=100, buffer_max_age=10)
+        result_of(pipeline.process_item(self.profile(1), spider))
+        pipeline.flush_stale_buffer()
+        self.assertEqual(pipeline.db.writes, [])
+        pipeline.buffer_started -= 10
+        pipeline.flush_stale_buffer()
+        self.assertEqual(len(pipeline.db.writes), 1)
+        self.assertIsNone(pipeline.flush_stale_buffer())  # nothing buffered
+
+    def test_inflight_limit(self):
+        pipeline, spider = make_pipeline(immediate=False, buffer_size=2, max_inflight_flushes=2)
+        processed = [pipeline.process_item(self.profile(user_id), spider) for user_id in range(1, 7)]
+        # the 3rd flush waits for a slot, holding back the item filling the buffer
+        self.assertEqual(len(pipeline.db.writes), 2)
+        self.assertEqual(len(pipeline.inflight_flushes), 2)
+        self.assertFalse(processed[5].called)
+        self.assertTrue(all(d.called for d in processed[:5]))
+        pipeline.db.finish()
+        self.assertEqual(len(pipeline.db.writes), 3)
+        self.assertTrue(processed[5].called)
+        pipeline.db.finish()
+        pipeline.db.finish()
+        self.assertEqual(pipeline.inflight_flushes, set())
+        self.assertEqual(spider.crawler.stats.get_value('txmongo/flush/count'), 3)
+
+    def test_close(self):
+        pipeline, spider = make_pipeline(immediate=False, buffer_size=2)
+        for user_id in range(1, 4):
+            pipeline.process_item(self.profile(user_id), spider)
+        closed = pipeline.close_spider(spider)
+        # the rest of the buffer is flushed once the flush in flight is done, and closing waits for both
+        self.assertEqual(len(pipeline.db.writes), 1)
+        pipeline.db.finish()
+        self.assertEqual(len(pipeline.db.writes), 2)
+        self.assertFalse(closed.called)
+        pipeline.db.finish()
+        self.assertTrue(closed.called)
+        self.assertEqual([len(operations) for _, operations in pipeline.db.writes], [2, 1])
+
+
+class WriteOnceTest(unittest.TestCase):
+    def process(self, pipeline, spider, *songs):
+        for song_id, name in songs:
+            result_of(pipeline.process_item(Song(id=song_id, name=name), spider))
+
+    def written_ids(self, pipeline):
+        return [operation._filter['_id'] for _, operations in pipeline.db.writes for operation in operations]
+
+    def suppressed(self, spider):
+        return spider.crawler.stats.get_value('pipeline/txmongo/songs/suppressed', 0)
+
+    def test_written_once(self):
+        pipeline, spider = make_pipeline(write_once=True, buffer_size=2)
+        self.process(pipeline, spider, (1, "a"), (1, "a"), (2, "b"), (1, "a"), (2, "b"), (3, "c"))
+        self.assertEqual(self.written_ids(pipeline), [1, 2])
+        self.assertEqual(self.suppressed(spider), 3)
+        self.assertEqual(pipeline.buffer_count, 1)
+
+    def test_failed_write(self):
+        pipeline, spider = make_pipeline(immediate=False, write_once=True, buffer_size=2)
+        self.process(pipeline, spider, (1, "a"), (1, "a"), (2, "b"))
+        # suppressed while being written, but written again once the write fails
+        self.assertEqual(self.suppressed(spider), 1)
+        pipeline.db.finish(ConnectionError())
+        self.assertNotIn(1, pipeline.stored_ids_of("songs"))
+        self.process(pipeline, spider, (1, "a"), (2, "b"))
+        self.assertEqual(self.written_ids(pipeline), [1, 2, 1, 2])
+        self.assertEqual(pipeline.pending_names["songs"], {1: None, 2: None})
+
+    def test_partially_failed_write(self):
+        pipeline, spider = make_pipeline(immediate=False, write_once=True, buffer_size=3)
+        self.process(pipeline, spider, (1, "a"), (2, "b"), (3, "c"))
+        pipeline.db.finish(BulkWriteError({'writeErrors': [{'index': 1, 'code': 11000}], 'writeConcernErrors': []}))
+        self.assertEqual([song_id in pipeline.stored_ids_of("songs") for song_id in (1, 2, 3)], [True, False, True])
+        self.process(pipeline, spider, (1, "a"), (2, "b"), (3, "c"))
+        self.assertEqual(self.written_ids(pipeline), [1, 2, 3])
+        self.assertEqual(pipeline.buffer["songs"][0]._filter, {'_id': 2})
+
+    def test_refresh_names(self):
+        pipeline, spider = make_pipeline(write_once=True, refresh_names=True)
+        self.process(pipeline, spider, (1, "a"), (1, "a"), (1, "b"), (1, "b"))
+        self.assertEqual([(filter_, update['$set']['name']) for _, filter_, update in pipeline.db.updates],
+                         [({'_id': 1}, "a"), ({'_id': 1}, "b")])
+        self.assertEqual(self.suppressed(spider), 2)
+        self.assertEqual(pipeline.pending_names["songs"], {})
+
+
+class SongBatchTest(unittest.TestCase):
+    SONGS = [(1001, "歌曲 &amp; 1"), (1002, "歌曲 2"), (1003, "歌曲 3")]
+
+    def favorite_songs(self, spider, songs):
+        request = spider.request_favorite_songs(None, UserProfile(id=42), 7)
+        body = '<html><body><ul class="f-hide">{}</ul></body></html>'.format("".join(
+            '<li><a href="/song?id={}">{}</a></li>'.format(song_id, name) for song_id, name in songs))
+        return list(spider.parse_favorite_songs(HtmlResponse(request.url, body=body.encode(), request=request)))
+
+    def test_spider(self):
+        batch, up = self.favorite_songs(make_spider(SONG_BATCH=True), self.SONGS)
+        self.assertIsInstance(batch, SongBatch)
+        self.assertEqual(batch['items'], [{'id': 1001, 'name': "歌曲 & 1"}, {'id': 1002, 'name': "歌曲 2"},
+                                          {'id': 1003, 'name': "歌曲 3"}])
+        self.assertEqual(up['favorite_songs'], [1001, 1002, 1003])
+        [up] = self.favorite_songs(make_spider(SONG_BATCH=True), [])
+        self.assertEqual(up['favorite_songs'], [])
+
+    def test_spider_without_batches(self):
+        *songs, up = self.favorite_songs(make_spider(SONG_BATCH=False), self.SONGS)
+        self.assertTrue(all(type(song) is Song for song in songs))
+        self.assertEqual([(song['id'], song['name']) for song in songs],
+                         [(1001, "歌曲 & 1"), (1002, "歌曲 2"), (1003, "歌曲 3")])
+
+    def batch(self, *song_ids):
+        return SongBatch(items=[{'id': song_id, 'name': "s{}".format(song_id)} for song_id in song_ids])
+
+    def test_pipeline(self):
+        pipeline, spider = make_pipeline(write_once=True)
+        batch = self.batch(1, 2, 3)
+        self.assertIs(result_of(pipeline.process_item(batch, spider)), batch)
+        result_of(pipeline.process_item(self.batch(2, 3, 4, 4), spider))
+        self.assertEqual(pipeline.db.writes, [
+            ("songs", [UpdateOne({'_id': i}, {'$set': {'name': "s{}".format(i), '_id': i}}, upsert=True)
+                       for i in (1, 2, 3)]),
+            ("songs", [UpdateOne({'_id': 4}, {'$set': {'name': "s4", '_id': 4}}, upsert=True)])])
+        stats = spider.crawler.stats
+        self.assertEqual(stats.get_value('pipeline/txmongo/songs'), 4)
+        self.assertEqual(stats.get_value('pipeline/txmongo/songs/suppressed'), 3)
+
+    def test_pipeline_buffered(self):
+        pipeline, spider = make_pipeline(buffer_size=5)
+        result_of(pipeline.process_item(self.batch(1, 2, 3), spider))
+        self.assertEqual((pipeline.db.writes, pipeline.buffer_count), ([], 3))
+        result_of(pipeline.process_item(UserProfile(id=42, favorite_songs=[1, 2, 3]), spider))
+        result_of(pipeline.process_item(self.batch(4, 5), spider))
+        self.assertEqual([(collection_name, len(operations)) for collection_name, operations in pipeline.db.writes],
+                         [("songs", 5), ("users", 1)])
+
+
+class LocalStorePipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.spider = make_spider(LOCAL_STORE_PATH=self.dir.name, LOCAL_STORE_BATCH_SIZE=4)
+        self.pipeline = LocalStorePipeline.from_crawler(self.spider.crawler)
+        self.pipeline.open_spider(self.spider)
+
+    def tearDown(self):
+        if self.pipeline.store._writer.is_alive():
+            self.pipeline.store.close()
+        self.dir.cleanup()
+
+    def close(self):
+        with mock.patch.object(threads, 'deferToThread', defer.maybeDeferred):
+            result_of(self.pipeline.close_spider(self.spider))
+
+    def read(self, collection_name):
+        return list(SegmentStore(self.dir.name).read(collection_name))
+
+    def test_song_batch(self):
+        batch = SongBatch(items=[{'id': song_id, 'name': "s{}".format(song_id)} for song_id in (1, 2, 3)])
+        self.assertIs(self.pipeline.process_item(batch, self.spider), batch)
+        self.pipeline.process_item(UserProfile(id=42, favorite_songs=[1, 2, 3]), self.spider)
+        self.close()
+        self.assertEqual(self.read("songs"), [{'_id': i, 'name': "s{}".format(i)} for i in (1, 2, 3)])
+        self.assertEqual(self.read("users"), [{'_id': 42, 'favorite_songs': [1, 2, 3]}])
+        self.assertEqual(self.spider.crawler.stats.get_value('pipeline/localstore/songs'), 3)
+
+    def test_batches(self):
+        for song_id in range(3):
+            self.pipeline.process_item(Song(id=song_id, name="s"), self.spider)
+        self.assertEqual((self.pipeline.batch_count, os.listdir(self.dir.name)), (3, []))
+        # the 4th document fills the batch, handed over to the writer thread as a whole
+        self.pipeline.process_item(UserProfile(id=42), self.spider)
+        self.assertEqual((self.pipeline.batch_count, self.pipeline.batches), (0, {}))
+        self.pipeline.store.flush()
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["songs", "users"])
+        self.close()
+        self.assertEqual(len(self.read("songs")), 3)
+
+    def test_writer_error(self):
+        # the directory of the collection cannot be created
+        open(os.path.join(self.dir.name, "songs"), "w").close()
+        for song_id in range(4):
+            self.pipeline.process_item(Song(id=song_id, name="s"), self.spider)
+        with self.assertRaises(OSError):
+            self.pipeline.store.flush()
+        for song_id in range(3):
+            self.pipeline.process_item(Song(id=song_id, name="s"), self.spider)
+        with self.assertRaises(OSError):
+            self.pipeline.process_item(Song(id=3, name="s"), self.spider)
+        with self.assertRaises(OSError):
+            self.pipeline.store.close()
+
+    def test_compact_on_close(self):
+        self.pipeline.segment_size = 1
+        self.pipeline.store.close()
+        self.pipeline.open_spider(self.spider)  # a segment for every batch
+        for name in ("a", "b"):
+            for song_id in range(4):
+                self.pipeline.process_item(Song(id=song_id, name=name), self.spider)
+            self.pipeline.store.flush()
+        self.assertEqual(len(self.pipeline.store.segments("songs")), 2)
+        self.close()
+        self.assertEqual(len(self.pipeline.store.segments("songs")), 1)
+        self.assertEqual(self.read("songs"), [{'_id': i, 'name': "b"} for i in range(4)])
+
+
+class MemoryCollection(object):
+    """A `pymongo` collection in memory for commands, which knows only queries of `$type`s under `$or`."""
+    TYPES = {4: list, 5: bytes}
+
+    def __init__(self, documents):
+        self.documents = {document['_id']: dict(document) for document in documents}
+
+    def find(self, query, projection):
+        for document in self.documents.values():
+            if query and not any(isinstance(document.get(field), self.TYPES[condition['$type']])
+                                 for clause in query['$or'] for field, condition in clause.items()):
+                continue
+            yield dict({field: document[field] for field in projection if field in document}, _id=document['_id'])
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.documents[operation._filter['_id']].update(operation._doc['$set'])
+        return types.SimpleNamespace(modified_count=len(operations))
+
+
+class PackIdsTest(unittest.TestCase):
+    def test_pipeline(self):
+        pipeline, spider = make_pipeline(pack_id_lists=True)
+        result_of(pipeline.process_item(UserProfile(id=42, name="u", favorite_songs=[3, 1, 2]), spider))
+        result_of(pipeline.process_item(UserProfile(id=43, favorite_songs=[]), spider))
+        [(_, _, update), (_, _, empty)] = pipeline.db.updates
+        packed = update['$set']['favorite_songs']
+        self.assertIsInstance(packed, Binary)
+        self.assertEqual(packed.subtype, USER_DEFINED_SUBTYPE)
+        self.assertEqual(unpack_ids(packed), [3, 1, 2])
+        self.assertEqual(update['$set']['name'], "u")
+        self.assertEqual(unpack_ids(empty['$set']['favorite_songs']), [])
+        # as they are without `MONGO_PACK_IDS`
+        pipeline, spider = make_pipeline()
+        result_of(pipeline.process_item(UserProfile(id=42, favorite_songs=[3, 1, 2]), spider))
+        self.assertEqual(pipeline.db.updates[0][2]['$set']['favorite_songs'], [3, 1, 2])
+
+    def run_command(self, collection, *argv):
+        command = pack_ids_command.Command()
+        command.settings = Settings()
+        parser = argparse.ArgumentParser()
+        command.add_options(parser)
+        with mock.patch.object(pack_ids_command, 'mongo_collection', return_value=collection):
+            command.run([], parser.parse_args(list(argv)))
+
+    def test_command(self):
+        users = [{'_id': 1, 'name': "a", 'favorite_songs': [5, 3, 2**40]},
+                 {'_id': 2, 'name': "b", 'favorite_songs': []},
+                 {'_id': 3, 'name': "c"},
+                 {'_id': 4, 'favorite_songs': Binary(pack_ids([7]), USER_DEFINED_SUBTYPE)}]
+        collection = MemoryCollection(users)
+        self.run_command(collection, "--batch-size", "1")
+        self.assertEqual([type(collection.documents[user_id].get('favorite_songs')) for user_id in (1, 2, 3, 4)],
+                         [Binary, Binary, type(None), Binary])
+        self.assertEqual(unpack_ids(collection.documents[1]['favorite_songs']), [5, 3, 2**40])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.jsonl")
+            self.run_command(collection, "-o", path)
+            with open(path, encoding="utf-8") as file:
+                self.assertEqual([json.loads(line) for line in file],
+                                 [{'_id': 1, 'favorite_songs': [5, 3, 2**40]}, {'_id': 2, 'favorite_songs': []},
+                                  {'_id': 3}, {'_id': 4, 'favorite_songs': [7]}])
+        self.run_command(collection, "--unpack")
+        self.assertEqual(list(collection.documents.values()), [dict(users[0]), users[1], users[2],
+                                                               {'_id': 4, 'favorite_songs': [7]}])
+
+
+class FingerprintsTest(unittest.TestCase):
+    def process(self, pipeline, spider, *profiles):
+        for user_id, name in profiles:
+            result_of(pipeline.process_item(UserProfile(id=user_id, name=name), spider))
+
+    def written(self, pipeline):
+        return [(operation._filter['_id'], operation._doc['$set']['name'])
+                for _, operations in pipeline.db.writes for operation in operations]
+
+    def test_unchanged(self):
+        pipeline, spider = make_pipeline(fingerprints=True, buffer_size=1)
+        self.process(pipeline, spider, (1, "a"), (1, "a"), (1, "b"), (2, "a"), (1, "b"))
+        self.assertEqual(self.written(pipeline), [(1, "a"), (1, "b"), (2, "a")])
+        self.assertEqual(spider.crawler.stats.get_value('pipeline/txmongo/users/unchanged'), 2)
+        self.assertEqual(pipeline.pending_fingerprints, {("users", ("name",)): {}})
+
+    def test_failed_write(self):
+        pipeline, spider = make_pipeline(immediate=False, fingerprints=True, buffer_size=2)
+        self.process(pipeline, spider, (1, "a"), (1, "a"), (2, "a"))
+        # unchanged while being written, but written again once the write fails
+        self.assertEqual(spider.crawler.stats.get_value('pipeline/txmongo/users/unchanged'), 1)
+        pipeline.db.finish(ConnectionError())
+        self.assertEqual(len(pipeline.fingerprint_tables[("users", ("name",))]), 0)
+        self.process(pipeline, spider, (1, "a"), (2, "a"))
+        pipeline.db.finish()
+        self.assertEqual(self.written(pipeline), [(1, "a"), (2, "a")] * 2)
+        self.assertEqual(len(pipeline.fingerprint_tables[("users", ("name",))]), 2)
+
+    def test_with_write_once(self):
+        pipeline, spider = make_pipeline(immediate=False, write_once=True, fingerprints=True, buffer_size=1)
+        for _ in range(2):
+            result_of(pipeline.process_item(Song(id=1, name="a"), spider))
+            pipeline.db.finish(ConnectionError())
+        self.assertEqual(len(pipeline.db.writes), 2)
+        self.assertEqual((pipeline.pending_names["songs"], pipeline.pending_fingerprints[("songs", ("name",))]),
+                         ({}, {}))
+
+
+class SongUsersIndexTest(unittest.TestCase):
+    def index(self, *users, bucket_size=2):
+        """Index the favorite songs of `users`, `(user ID, song IDs)`s, and return the buckets as MongoDB would update
+        them, and the number of updates rejected by the unique index."""
+        pipeline, spider = make_pipeline(SongUsersIndexPipeline, bucket_size=bucket_size, buffer_size=1)
+        for user_id, song_ids in users:
+            result_of(pipeline.process_item(UserProfile(id=user_id, favorite_songs=song_ids), spider))
+        buckets = []
+        rejected = 0
+        for _, operations in pipeline.db.writes:
+            for operation in operations:
+                query, update = operation._filter, operation._doc
+                song_id, user_id = query['song'], query['users']['$ne']
+                if any(bucket['song'] == song_id and user_id in bucket['users'] for bucket in buckets):
+                    rejected += 1  # by the unique index, either as updated or as upserted
+                    continue
+                for bucket in buckets:
+                    if bucket['song'] == song_id and bucket['count'] < query['count']['$lt']:
+                        break
+                else:  # upserted
+                    bucket = {'song': song_id, 'users': [], 'count': 0}
+                    buckets.append(bucket)
+                bucket['users'].append(update['$push']['users'])
+                bucket['count'] += update['$inc']['count']
+        return buckets, rejected
+
+    def test_index(self):
+        self.assertEqual(self.index((1, [10, 11]), (2, [10]), (3, [10])),
+                         ([{'song': 10, 'users': [1, 2], 'count': 2}, {'song': 11, 'users': [1], 'count': 1},
+                           {'song': 10, 'users': [3], 'count': 1}], 0))
+
+    def test_crawled_again(self):
+        # 2 is in a full bucket of 11 when crawled again, 1 in buckets with room
+        self.assertEqual(self.index((1, [10, 11]), (2, [11]), (1, [10, 11, 12]), (2, [11])),
+                         ([{'song': 10, 'users': [1], 'count': 1}, {'song': 11, 'users': [1, 2], 'count': 2},
+                           {'song': 12, 'users': [1], 'count': 1}], 3))
+
+    def test_ignored(self):
+        self.assertEqual(self.index((1, [])), ([], 0))
+
+    def test_rejected(self):
+        pipeline, spider = make_pipeline(SongUsersIndexPipeline, immediate=False, buffer_size=2)
+        result_of(pipeline.process_item(UserProfile(id=1, favorite_songs=[10, 11]), spider))
+        with self.assertNoLogs(pipeline.logger, "ERROR"):
+            pipeline.db.finish(BulkWriteError({'writeErrors': [{'index': 1, 'code': 11000}], 'writeConcernErrors': []}))
+        self.assertEqual(spider.crawler.stats.get_value('song_users/flush/ignored_errors'), 1)
+        result_of(pipeline.process_item(UserProfile(id=1, favorite_songs=[10, 11]), spider))
+        with self.assertLogs(pipeline.logger, "ERROR"):
+            pipeline.db.finish(BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}, {'index': 1, 'code': 2}],
+                                               'writeConcernErrors': []}))
+        self.assertEqual(spider.crawler.stats.get_value('song_users/flush/ignored_errors'), 2)
+
+class CSRExporterTest(unittest.TestCase):
+    USERS = [{'_id': 10 + i, 'favorite_songs': [(i * 7 + j) % 13 + 100 for j in range(i % 5)]} for i in range(11)]
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def export(self, path, users, crash_after=None):
+        """Export `users` after the checkpoint in `path`, as the command does, failing after `crash_after` users."""
+        exporter = CSRExporter(path, chunk_size=3)
+
+        def cursor():
+            for n, user in enumerate(user for user in users if last_id is None or user['_id'] > last_id):
+                if n == crash_after:
+                    raise ConnectionError()
+                yield user
+        last_id = exporter.last_id
+        exporter.export(cursor())
+        exporter.merge()
+        return exporter
+
+    def load(self, path):
+        return {name: np.load(os.path.join(path, name + ".npy")).tolist()
+                for name in ("indptr", "indices", "user_ids", "song_ids")}
+
+    def test_export(self):
+        users = [dict(user) for user in self.USERS]
+        users[3]['favorite_songs'] = pack_ids(users[3]['favorite_songs'])
+        exporter = self.export(self.path, users)
+        arrays = self.load(self.path)
+        self.assertEqual((exporter.chunk, exporter.nnz), (4, len(arrays['indices'])))
+        self.assertEqual(arrays['user_ids'], [user['_id'] for user in self.USERS])
+        for i, user in enumerate(self.USERS):
+            row = arrays['indices'][arrays['indptr'][i]:arrays['indptr'][i + 1]]
+            self.assertEqual([arrays['song_ids'][index] for index in row], user['favorite_songs'])
+        self.assertEqual(sorted(arrays['song_ids']), sorted({song for user in self.USERS
+                                                             for song in user['favorite_songs']}))
+
+    def test_resume(self):
+        with self.assertRaises(ConnectionError):
+            self.export(self.path, self.USERS, crash_after=7)
+        # the 3rd chunk was cut by the crash, so it resumes after the 2nd
+        with open(os.path.join(self.path, CSRExporter.CHECKPOINT)) as file:
+            self.assertEqual(json.load(file)['last_id'], self.USERS[5]['_id'])
+        exporter = self.export(self.path, self.USERS)
+        self.assertEqual(exporter.chunk, 4)
+        with tempfile.TemporaryDirectory() as path:
+            self.export(path, self.USERS)
+            self.assertEqual(self.load(self.path), self.load(path))
+        # and nothing is left to export
+        self.assertEqual(self.export(self.path, self.USERS).chunk, 4)
+
+
+class FollowGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "edges.bin")
+        self.dupefilter = NemUserIDFilter()
+        self.spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=True, EDGE_LOG_PATH=self.path, EDGE_LOG_SYNC_INTERVAL=0,
+                                  dupefilter=self.dupefilter)
+        self.dupefilter.stats = self.spider.crawler.stats
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def parse(self, follow_type, user_id, users):
+        """Parse a page of `users` of `follow_type` of `user_id`, and return the users requested playlists for."""
+        response = follow_response(self.spider.request_follow(follow_type, None, user_id), users)
+        return [output.meta['filter_user_id'] for output in self.spider.parse_follow(response)
+                if isinstance(output, Request) and output.callback == self.spider.parse_playlists]
+
+    def log_edges(self):
+        self.dupefilter.request_seen(crawled(10**6 + 1))
+        self.assertEqual(self.parse("followers", 42, 3), [10**6, 10**6 + 2])
+        self.assertEqual(self.parse("following", 43, 2), [])
+        self.parse("followers", 42, 3)  # parsed again, e.g. after a resume
+        self.spider.close_edge_log(self.spider)
+
+    def test_parse_follow(self):
+        self.log_edges()
+        followers = [(10**6 + i, 42, FOLLOWERS) for i in range(3)]
+        # users seen before are logged as well
+        self.assertEqual([tuple(int(value) for value in edge) for edge in read_edges(self.path)],
+                         followers + [(43, 10**6, FOLLOWING), (43, 10**6 + 1, FOLLOWING)] + followers)
+
+    def build(self, *options):
+        command = build_follow_graph.Command()
+        command.settings = Settings()
+        parser = argparse.ArgumentParser()
+        command.add_options(parser)
+        directory = os.path.join(self.dir.name, "graph")
+        command.run([self.path, directory], parser.parse_args(list(options)))
+        return [np.load(os.path.join(directory, name)).tolist() for name in ("node_ids.npy", "indptr.npy",
+                                                                            "indices.npy")]
+
+    def test_command(self):
+        self.log_edges()
+        node_ids = [42, 43, 10**6, 10**6 + 1, 10**6 + 2]
+        # 43 follows the first two users found, and the three found follow 42, once each
+        self.assertEqual(self.build(), [node_ids, [0, 0, 2, 3, 4, 5], [2, 3, 0, 0, 0]])
+        self.assertEqual(self.build("--reverse"), [node_ids, [0, 3, 3, 4, 5, 5], [2, 3, 4, 1, 1]])
+
+
+class MockServerTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = SyntheticGraph(users=300, songs=1000, seed=0)
+        self.server = MockNEMServer(self.graph, nem_crypto.seeded_keys(2, 4), page_limit_max=10)
+        self.spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=False, NEM_KEY_POOL_SIZE=4, FOLLOW_FANOUT=4)
+        self.spider.key_pool = nem_crypto.KeyPool(4, keys=nem_crypto.seeded_keys(2, 4))
+        self.index = max(range(self.graph.users), key=lambda i: len(self.graph.followers[i]))
+
+    def post(self, request):
+        """Send a weapi `request` to the server, and return the status and the JSON body of the response."""
+        async def post():
+            async with TestClient(TestServer(self.server.application())) as client:
+                url = urlsplit(request.url)
+                response = await client.post("{}?{}".format(url.path, url.query), data=request.body,
+                                             headers={'Content-Type': "application/x-www-form-urlencoded"})
+                return response.status, await response.json() if response.status == 200 else None
+        return asyncio.run(post())
+
+    def test_follow_pages(self):
+        followers = self.graph.followers[self.index]
+        self.assertGreater(len(followers), 10)
+        # the limit asked is capped by `page_limit_max`, and the first page tells the total with fanning out
+        request = self.spider.request_follow("followers", None, USER_ID_BASE + self.index, limit=20)
+        self.assertEqual(weapi_params(request, 2, 4)['userId'], str(USER_ID_BASE + self.index))
+        status, page = self.post(request)
+        self.assertEqual(status, 200)
+        self.assertEqual([user['userId'] for user in page['followeds']],
+                         [USER_ID_BASE + i for i in followers[:10]])
+        self.assertTrue(page['more'])
+        self.assertEqual(page['total'], len(followers))
+        # the last page
+        request = self.spider.request_follow("followers", None, USER_ID_BASE + self.index,
+                                             offset=len(followers) - 3, limit=10)
+        status, page = self.post(request)
+        self.assertEqual(len(page['followeds']), 3)
+        self.assertFalse(page['more'])
+        self.assertNotIn('total', page)
+
+    def test_following_size(self):
+        following = self.graph.following[self.index]
+        status, page = self.post(self.spider.request_follow("following", None, USER_ID_BASE + self.index, limit=10))
+        self.assertEqual(len(page['follow']), min(len(following), 10))
+        self.assertEqual(page['more'], len(following) > 10)
+        self.assertEqual(page['size'], len(following))
+
+    def test_unknown_key(self):
+        spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=False, NEM_KEY_POOL_SIZE=0)
+        status, page = self.post(spider.request_follow("followers", None, USER_ID_BASE + self.index))
+        self.assertEqual(status, 400)
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.spider = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=True, HTTPCACHE_DIR=self.dir.name,
+                                  HTTPCACHE_EXPIRATION_SECS=3600)
+        self.fingerprinter = self.spider.crawler.request_fingerprinter
+        self.storage = EndpointTTLCacheStorage(self.spider.settings)
+        self.storage.open_spider(self.spider)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_fingerprint(self):
+        fingerprint = self.fingerprinter.fingerprint
+        request = self.spider.request_follow("followers", None, 123)
+        again = self.spider.request_follow("followers", None, 123)
+        again.meta['weapi_params']['csrf_token'] = "token"
+        self.assertIsInstance(self.fingerprinter, WeAPIRequestFingerprinter)
+        self.assertEqual(fingerprint(request), fingerprint(again))
+        self.assertNotEqual(fingerprint(request), fingerprint(self.spider.request_follow("followers", None, 124)))
+        self.assertNotEqual(fingerprint(request), fingerprint(self.spider.request_follow("following", None, 123)))
+        # encrypted when built, with a random key every time
+        encrypted = make_spider(NEM_DEFER_WEAPI_ENCRYPTION=False).request_follow
+        self.assertNotEqual(fingerprint(encrypted("followers", None, 123)),
+                            fingerprint(encrypted("followers", None, 123)))
+
+    def retrieved(self, request, age):
+        """Store a response to `request`, and retrieve it `age` seconds later."""
+        self.storage.store_response(self.spider, request, TextResponse(request.url, body=b"{}", request=request))
+        with mock.patch.object(httpcache, 'time', return_value=time.time() + age):
+            return self.storage.retrieve_response(self.spider, request.copy())
+
+    def test_endpoint_ttl(self):
+        follow = self.spider.request_follow("followers", None, 123)
+        self.assertIsNotNone(self.retrieved(follow, 5 * 3600))
+        self.assertIsNone(self.retrieved(follow, 7 * 3600))
+        user_page = Request("https://music.163.com/user/home?id=123")
+        self.assertIsNotNone(self.retrieved(user_page, 6 * 24 * 3600))
+        self.assertIsNone(self.retrieved(user_page, 8 * 24 * 3600))
+
+    def test_default_ttl(self):
+        request = Request("https://music.163.com/discover")
+        self.assertEqual(self.retrieved(request, 0).body, b"{}")
+        # longer than `HTTPCACHE_EXPIRATION_SECS`, shorter than the TTLs of endpoints
+        self.assertIsNone(self.retrieved(request, 2 * 3600))
+        self.assertIsNone(self.storage.retrieve_response(self.spider, Request("https://music.163.com/not_cached")))
+
+
+if __name__ == "__main__":
+    unittest.main()
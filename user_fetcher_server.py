@@ -1,24 +1,26 @@
 import json
-import re
+import os
 from aiohttp import web
 import aiohttp
 import asyncio
-from urllib.parse import urlencode
-from NEMUserCrawler.common.nem_crypto import encrypt as nem_encrypt
+from urllib.parse import urlencode, urlsplit
+from NEMUserCrawler.common.nem_crypto import encrypt as nem_encrypt, KeyPool, seeded_keys
+from NEMUserCrawler.common.nem_page import ld_json_of, user_profile_of, favorite_songs_of
 
 
 
-NEM_URL = "https://music.163.com"
+# Both can be set to point to `NEMUserCrawler.mock_server` on this host, e.g.
+# NEM_URL=http://127.0.0.1:8163 NEM_MOCK_KEY_SEED=0, for it to decrypt requests. Seeded keys are predictable, so they
+# are refused for any other host.
+NEM_URL = os.environ.get("NEM_URL", "https://music.163.com")
+if "NEM_MOCK_KEY_SEED" in os.environ:
+    if urlsplit(NEM_URL).hostname not in ("127.0.0.1", "localhost", "::1"):
+        raise SystemExit("NEM_MOCK_KEY_SEED is for a mock server on this host only, not {}".format(NEM_URL))
+    KEY_POOL = KeyPool(64, keys=seeded_keys(int(os.environ["NEM_MOCK_KEY_SEED"]), 64))
+else:
+    KEY_POOL = KeyPool(64)
 
 
-def str_between(s, left, right):
-    try:
-        start = s.index(left) + len(left)
-        end = s.index(right, start + 1)
-        return s[start:end]
-    except ValueError:
-        return ""
-
 async def get(session: aiohttp.ClientSession, *args, **kwargs):
     async with session.get(*args, **kwargs) as response:
         return await response.text()
@@ -31,24 +33,18 @@ async def post(session: aiohttp.ClientSession, *args, **kwargs):
 async def index(request):
     return web.Response(text="NEM user fetcher server is up.")
 
-SONGS_LIST = re.compile(
-    r'(?<=\<li\>\<a href="\/song\?id=)(?P<song_id>\d+)(?:"\>)(?P<song_name>.+?)(?=\<\/a\>\<\/li\>)')
-
-
 async def fetch_user(user_id):
     try:
         async with aiohttp.ClientSession(headers={'User-Agent': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36"}) as session:
             result = await get(session, NEM_URL + "/user/home?id={}".format(user_id))
             if '<p class="note s-fc3">很抱歉，你要查找的网页找不到</p>' in result:
                 return False, "USER_NOT_EXISTING"
-            d = json.loads(str_between(
-                result, '<script type="application/ld+json">', '</script>'))
-            user_profile = {
-                'id': user_id,
-                'name': d['title'],
-                'avatar_url': d['images'][0] if d['images'] else "",
-                'description': d['description'].rstrip("{}的最近常听、歌单、DJ节目、音乐口味、动态。".format(d['title']))
-            }
+            d = ld_json_of(result)
+            if d is None:
+                raise ValueError
+            user_profile = dict(user_profile_of(d), id=user_id)
+            user_profile['description'] = user_profile['description'].rstrip(
+                "{}的最近常听、歌单、DJ节目、音乐口味、动态。".format(d['title']))
 
             result = await post(session,
                                 NEM_URL + "/weapi/user/playlist?csrf_token=",
@@ -56,19 +52,18 @@ async def fetch_user(user_id):
                                     'Content-Type': "application/x-www-form-urlencoded"},
                                 data=urlencode(nem_encrypt(
                                     {"uid": str(user_profile['id']), "wordwrap": "99", "offset": "0",
-                                     "total": "true", "limit": "5", "csrf_token": ""}
+                                     "total": "true", "limit": "5", "csrf_token": ""},
+                                    key_pool=KEY_POOL
                                 )))
             d = json.loads(result)
             if "喜欢的音乐" not in d['playlist'][0]['name']:
                 raise ValueError
 
             result = await get(session, NEM_URL + "/playlist?id={}".format(d['playlist'][0]['id']))
-            result = str_between(result, '<ul class="f-hide">', '</ul>')
-            songs = []
-            for song_match in SONGS_LIST.finditer(result):
-                songs.append((song_match.group('song_id'),
-                              song_match.group('song_name')))
-            user_profile['favorite_songs'] = songs
+            songs = favorite_songs_of(result)
+            if songs is None:
+                raise ValueError
+            user_profile['favorite_songs'] = [(str(song_id), name) for song_id, name in songs]
             return True, user_profile
     except (KeyError, ValueError, json.JSONDecodeError, aiohttp.ClientError) as e:
         return False, "UPSTREAM_INVALID_RESPONSE"
@@ -102,7 +97,8 @@ async def search_user(name, limit=100, offset=0):
                                 headers={
                                     'Content-Type': "application/x-www-form-urlencoded"},
                                 data=urlencode(nem_encrypt(
-                                    {'s': name, 'limit': limit, 'csrf_token': "", 'type': 1002, 'offset': offset})))
+                                    {'s': name, 'limit': limit, 'csrf_token': "", 'type': 1002, 'offset': offset},
+                                    key_pool=KEY_POOL)))
             d = json.loads(result)
             user_profiles = []
             for user_profile in d['result']['userprofiles']: